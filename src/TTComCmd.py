@@ -20,15 +20,20 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 import gzip
 import time
 from datetime import datetime
-import os, sys, re, socket, shlex
+import os, sys, re, socket, shlex, json
 import threading
+from collections import OrderedDict
 from tt_attrdict import AttrDict
 from ttapi import TeamtalkServer
 import player
-from mplib.mycmd import MyCmd, say as mycmd_say, classproperty, ArgumentParser, CommandError
+from mplib.mycmd import MyCmd, say as mycmd_say, classproperty, ArgumentParser, CommandError, mq, setWrapWidth
+from mplib import speech
 from mplib.TableFormatter import TableFormatter
 from conf import conf
 from triggers import Triggers
+from connmgr import StartupLogin, reconnects
+import perfstats, diag, metrics
+from userindex import userIndex
 from parmline import ParmLine, TTParms, KeywordParm, IntParm, StringParm, ListParm
 from mplib.textblock import TextBlock
 
@@ -51,10 +56,131 @@ class NullLog(object):
 	def write(self, *args, **kwargs):
 		return
 
+def filterText(parms):
+	"""Return the lower-cased text that TTComCmd.filterPasses() searches for plain filters.
+	parms can be a dict or a list of values.
+	"""
+	if isinstance(parms, dict): vals = list(parms.values())
+	else: vals = parms
+	try: vals = ", ".join(vals)
+	except TypeError:
+		vals1 = []
+		for val in vals:
+			val1 = None
+			try: val1 = str(val)
+			except: pass
+			if val1 is None: continue
+			vals1.append(val1)
+		vals = ", ".join(vals1)
+	return repr(vals).lower()
+
+_parsedFilters = {}
+
+def parseFilters(filters):
+	"""Return filters as a list of (fieldname, value, invert) tuples, cached by filter list.
+	fieldname is None for plain filters, whose value is lower-cased.
+	"""
+	key = tuple(filters)
+	result = _parsedFilters.get(key)
+	if result is not None: return result
+	result = []
+	for filter in filters:
+		# ToDo: Bit of a kludge here.
+		if filter.startswith('"') and filter.endswith('"'): filter = filter[1:-1]
+		elif filter.endswith('"') and '="' in filter: filter = filter.replace('="', '=', 1)[:-1]
+		if "=" in filter:
+			fname,fvalWanted = filter.split("=", 1)
+			invert = False
+			if fname.startswith("!"):
+				fname = fname[1:]
+				invert = True
+			result.append((fname, fvalWanted, invert))
+		else:
+			result.append((None, filter.lower(), False))
+	if len(_parsedFilters) > 100: _parsedFilters.clear()
+	_parsedFilters[key] = result
+	return result
+
+class AccountCache(object):
+	"""One server's account list as of its last listaccounts, reused for ttl seconds.
+	Accounts this client deletes are dropped in place.
+	Accounts it adds or modifies are kept as sent and marked partial,
+	since the server fills in fields that were not sent, until the next full fetch.
+	"""
+	# Seconds a fetched list stays usable; set from the accountCacheSecs option.
+	ttl = 60.0
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.invalidate()
+
+	def invalidate(self):
+		with self.lock:
+			self.accounts = None
+			self.fetched = 0.0
+			# Username -> filterText() of its parms, made on first use.
+			self.texts = {}
+			# Usernames whose entries are only what this client sent.
+			self.partial = set()
+
+	def get(self, complete=True):
+		"""Return a copy of the username -> ParmLine dict, or None if it must be fetched.
+		With complete=False, partial entries are acceptable.
+		"""
+		with self.lock:
+			if self.accounts is None or time.monotonic() -self.fetched >= self.ttl: return None
+			if complete and self.partial: return None
+			return dict(self.accounts)
+
+	def set(self, accounts):
+		with self.lock:
+			self.accounts = dict(accounts)
+			self.fetched = time.monotonic()
+			self.texts = {}
+			self.partial = set()
+
+	def text(self, username, parms):
+		"""Return filterText(parms) for an account, computing it once per fetch.
+		"""
+		with self.lock:
+			text = self.texts.get(username)
+			if text is None:
+				text = filterText(parms)
+				if self.accounts is not None and username in self.accounts: self.texts[username] = text
+			return text
+
+	def sent(self, line):
+		"""Apply a newaccount or delaccount command that this client sent to the server.
+		Other commands are ignored.
+		"""
+		line = str(line).strip()
+		cmd = line.split(None, 1)[0].lower() if line else ""
+		if cmd not in ["newaccount", "delaccount"]: return
+		parms = ParmLine(line).parms
+		username = parms.get("username")
+		if username is None:
+			self.invalidate()
+			return
+		with self.lock:
+			if self.accounts is None: return
+			self.texts.pop(username, None)
+			if cmd == "delaccount":
+				self.accounts.pop(username, None)
+				self.partial.discard(username)
+				return
+			old = self.accounts.get(username)
+			if old is not None:
+				merged = AttrDict(old.parms)
+				merged.update(parms)
+				parms = merged
+			self.accounts[username] = ParmLine("useraccount", parms)
+			self.partial.add(username)
+
 class MyTeamtalkServer(TeamtalkServer):
 	def __init__(self, parent, *args, **kwargs):
 		# This is a TTComCmd object.
 		self.parent = parent
+		self.accountCache = AccountCache()
 		self.silent = 0
 		self.hidden = 0
 		self.encrypted = False
@@ -63,6 +189,13 @@ class MyTeamtalkServer(TeamtalkServer):
 		# command processor object.
 		TeamtalkServer.__init__(self, *args, **kwargs)
 
+	def event_error(self, parms):
+		"""An error does not say which command it answers,
+		so a newaccount or delaccount just applied to the account cache may have failed.
+		"""
+		self.accountCache.invalidate()
+		return TeamtalkServer.event_error(self, parms)
+
 	def outputFromEvent(self, line, raw=False):
 		"""For event output. See output() for details.
 		Only outputs for current and non-silenced servers,
@@ -70,7 +203,7 @@ class MyTeamtalkServer(TeamtalkServer):
 		if self.silent > 1:
 			# Unconditional silence, even if it's the current server.
 			return
-		if self.silent and self.shortname != self.parent.curServer.shortname:
+		if self.silent and self.shortname != self.parent._curShortname:
 			# Silence unless it's the current server.
 			return
 		TeamtalkServer.outputFromEvent(self, line, raw)
@@ -83,11 +216,13 @@ class MyTeamtalkServer(TeamtalkServer):
 		"""
 		TeamtalkServer.hookEvents(self, eventline, afterDispatch)
 		if not afterDispatch:
+			tStart = time.perf_counter_ns()
 			self.logstream.write("%s\n  %s: %s\n" % (
 				datetime.now().ctime(),
 				self.shortname,
 				eventline.initLine.rstrip()
 			))
+			self.perf.logWrites.record(time.perf_counter_ns() -tStart)
 			return
 		if eventline.event in ["userbanned", "useraccount"]:
 			# These events are responses to listing commands and
@@ -102,6 +237,9 @@ class Servers(dict):
 		# This is a TTComCmd object.
 		self.parent = parent
 		self.logfilename = "ttcom.log"
+		if parent.shard:
+			# Shard worker processes keep separate logs; see shards.py.
+			self.logfilename = "ttcom.shard%d.log" % (parent.shard[0])
 		self.logstream = NullLog()
 		if os.path.exists(self.logfilename):
 			self.logstream = open(self.logfilename, "a", encoding="utf-8")
@@ -165,15 +303,21 @@ class TTComCmd(MyCmd):
 		"Whether to speak events."
 		return conf.option("speakEvents")
 
-	def __init__(self, noAutoLogins=False, logins=[]):
+	# (index, count) in a shard worker process, which handles only its share of the servers.
+	shard = None
+
+	def __init__(self, noAutoLogins=False, logins=[], shard=None):
 		if logins:
 			noAutoLogins = True
 		self.noAutoLogins = noAutoLogins
+		self.shard = shard
 		self.servers = Servers(self)
 		self._curShortname = ""
 		MyCmd.__init__(self)
 		TeamtalkServer.write = self.msg
 		TeamtalkServer.writeEvent = self.msgFromEvent
+		for opt in ["coalesceEvents", "wrapWidth", "speechMaxAge", "reconnectConcurrency", "metricsPort", "accountCacheSecs"]:
+			self.applyOption(opt, conf.option(opt))
 		self.readServers(logins)
 
 	@property
@@ -201,6 +345,10 @@ class TTComCmd(MyCmd):
 	def readServers(self, logins=[]):
 		waitFors = []
 		curservers = conf.servers()
+		if self.shard:
+			from shards import shardOf
+			index,count = self.shard
+			curservers = OrderedDict((k,v) for k,v in curservers.items() if shardOf(k, count) == index)
 		curset = set(curservers.keys())
 		oldset = set(self.servers.keys())
 		anyDel = False
@@ -247,16 +395,8 @@ class TTComCmd(MyCmd):
 					if v.lower() in ["1", "true"]: encrypted = True
 					elif v.lower() in ["0", "false"]: encrypted = False
 					else: encrypted  = False
-				elif k.lower().startswith("match ") or k.lower().startswith("action "):
-					which,what = k.split(None, 1)
-					if "." in what:
-						triggerName,subname = what.split(".", 1)
-					else:
-						triggerName,subname = what,""
-					if which.lower() == "match":
-						triggers.addMatch(triggerName, ParmLine(v), subname)
-					else:  # action
-						triggers.addAction(triggerName, v, subname)
+				elif triggers.addConfigLine(k, v):
+					pass
 				else:
 					loginParms[k.lower()] = v
 			newServer = MyTeamtalkServer(self, host, tcpport, shortname, loginParms)
@@ -306,6 +446,10 @@ class TTComCmd(MyCmd):
 				if oldServer.hidden != newServer.hidden:
 					if not reconfig: print("hidden for %s changing to %d" % (shortname, newServer.hidden))
 				oldServer.hidden = newServer.hidden
+				if oldServer.soundsdir != newServer.soundsdir:
+					if not reconfig: print("soundsdir for %s changing to %s" % (shortname, newServer.soundsdir))
+					oldServer.changeSoundsdir(newServer.soundsdir)
+				oldServer.sound_volume = newServer.sound_volume
 				if oldServer.triggers != newServer.triggers:
 					if not reconfig: print("Updating triggers for %s" % (shortname))
 				oldServer.triggers = newServer.triggers
@@ -320,26 +464,20 @@ class TTComCmd(MyCmd):
 			if not doLogin and shortname in logins:
 				doLogin = newServer
 			if doLogin:
-				doLogin.login(True)
 				waitFors.append(doLogin)
-		halfsecs = 0
-		incomplete = False
-		while any([server.state != "loggedIn" for server in waitFors]):
-			halfsecs += 1
-			if halfsecs == 20:
-				incomplete = True
-				break
-			time.sleep(0.5)
-		time.sleep(0.5)
+		if waitFors:
+			try: limit = int(conf.option("loginConcurrency") or 8)
+			except ValueError: limit = 8
+			startup = StartupLogin(waitFors, limit).start()
+			startup.wait(10)
 		Triggers.loadCustomCode()
 		#self.do_shortSummary()
-		unfinished = []
-		for server in waitFors:
-			if server.state != "loggedIn":
-				unfinished.append(server.shortname)
-		if len(unfinished):
-			print("Servers that did not connect: " +", ".join(unfinished))
-		if not len(self.servers):
+		if waitFors:
+			print(startup.report())
+			unfinished = [server.shortname for server in startup.unfinished()]
+			if len(unfinished):
+				print("Servers that did not connect: " +", ".join(unfinished))
+		if not len(self.servers) and not self.shard:
 			print("Warning: No servers defined. Make sure you have created and filled out the configuration file " +conf.inipath)
 
 	def userMatch(self, u, checkAll=False):
@@ -350,22 +488,21 @@ class TTComCmd(MyCmd):
 		number sign ("#") followed with no spaces by the userid;
 		example: #247. If the userid matches a user, that user is used.
 		"""
-		# If checkAll is True, all servers' users are checked (not well tested or used).
+		# If checkAll is True, all servers' users are checked,
+		# by nickname, username, and IP address through the global user index.
 		if checkAll:
-			users = []
-			list(map(lambda s: users.extend(s.users),
-				self.servers
-			))
-		else:
-			users = self.curServer.users
+			if u.startswith("#") and u[1:].isdigit():
+				pairs = [(server, server.snapshot().users.get(u[1:])) for server in self.servers.values()]
+			else:
+				pairs = [(row[0], row[0].snapshot().users.get(row[1])) for row in userIndex.search(u)[1]]
+			pairs = [pair for pair in pairs if pair[1]]
+			flt = lambda pair: pair[0].shortname +"/" +pair[0].nonEmptyNickname(pair[1], True)
+			return self.selectMatch(pairs, "Select a User", flt)[1]
 		if u.startswith("#") and u[1:].isdigit():
-			users = [u1 for u1 in users.values() if u1.userid == u[1:]]
+			users = [u1 for u1 in [self.curServer.snapshot().users.get(u[1:])] if u1]
 		else:
-			users = [u1 for u1 in users.values() if u.lower() in self.curServer.nonEmptyNickname(u1, True).lower()]
-		if checkAll:
-			flt = lambda u1: u1.server.shortname +"/" +self.curServer.nonEmptyNickname(u1, True)
-		else:
-			flt = lambda u1: self.curServer.nonEmptyNickname(u1, True)
+			users = self.curServer.matchUsers(u)
+		flt = lambda u1: self.curServer.nonEmptyNickname(u1, True)
 		return self.selectMatch(users, "Select a User", flt)
 
 	def channelMatch(self, c, noPrompt=False):
@@ -380,21 +517,21 @@ class TTComCmd(MyCmd):
 		channel exactly, except for case.
 		If noPrompt is passed and True, a KeyError is thrown if more than one channel matches.
 		"""
-		channels = self.curServer.channels
+		server = self.curServer
 		if c == "/":
-			return channels["1"]
+			return server.snapshot().channels["1"]
 		elif c.startswith("/") and c.endswith("/"):
 			# Exact match (except for case) required.
-			channels = [c1 for c1 in channels.values() if c.lower() == self.curServer.channelname(c1["channelid"]).lower()]
+			channels = [c1 for c1 in server.matchChannels(c) if c.lower() == server.channelname(c1["channelid"]).lower()]
 		elif "=" in c:
 			# Specific parameter search like chanid=5.
-			channels = [chan for chan in channels.values() if self.filterPasses(chan, [c])]
+			channels = [chan for chan in server.snapshot().channels.values() if self.filterPasses(chan, [c])]
 		elif "/" in c:
 			# Containment match against full channel paths, case ignored.
-			channels = [c1 for c1 in channels.values() if c.lower() in self.curServer.channelname(c1["channelid"]).lower()]
+			channels = server.matchChannels(c)
 		else:
 			# Match against channel names (no paths), case and final / ignored.
-			channels = [c1 for c1 in channels.values() if c.lower() in self.curServer.channelname(c1["channelid"])[:-1].rpartition("/")[2].lower()]
+			channels = server.matchChannels(c, False)
 		# selectMatch handles the 0 and 1 match cases properly without prompting.
 		if not noPrompt or len(channels) <= 1:
 			return self.selectMatch(channels, "Select a Channel",
@@ -539,104 +676,121 @@ TTCom version %ver%
 		"""Summarize user/channel info on all connected servers.
 		Servers marked hidden in the config file are omitted.
 		"""
-		if len(self.servers) == 0:
-			print("No servers.")
-			return
-		offs = {}
-		empties = []
-		sums = []
-		serverCount = 0
-		stateCounts = {}
-		for shortname in sorted(self.servers):
-			server = self.servers[shortname]
-			stateCounts.setdefault(server.state, 0)
-			stateCounts[server.state] += 1
-			serverCount += 1
-			if server.hidden: continue
-			if server.state != "loggedIn":
-				offs.setdefault(server.state, [])
-				offs[server.state].append(shortname)
-			elif len(server.users) <= 1:
-				# 1 allows for this user.
-				empties.append(shortname)
-			else:
-				sums.append(shortname)
-		if len(offs):
-			for k in sorted(offs.keys()):
-				print("%s: %s" % (
-					k,
-					", ".join(offs[k])
-				))
-		if len(empties):
-			print("No users: " +", ".join(empties))
-		for shortname in sums:
-			server = self.servers[shortname]
-			server.summarizeChannels()
-		print("Server count {0:d}: {1}".format(
-			serverCount,
-			", ".join(["{0:d} {1}".format(stateCounts[state], state) for state in stateCounts])
-		))
+		self.printSummary(self.summaryData(), False)
 
 	def do_shortSummary(self, line=""):
 		"""Short summary of who's on all logged-in servers with people.
 		Servers marked hidden in the config file are omitted.
 		"""
-		if len(self.servers) == 0:
-			print("No servers.")
-			return
-		offs = {}
-		sums = []
-		serverCount = 0
-		stateCounts = {}
+		self.printSummary(self.summaryData(True), True)
+
+	def summaryData(self, short=False):
+		"""Return what allSummarize, or with short=True shortSummary, prints, as a dict of plain data.
+		Summaries from shard worker processes are merged from these; see shards.py.
+		"""
+		data = {"servers": 0, "stateCounts": OrderedDict(), "offs": {}, "empties": [], "sums": [], "linkWarnings": []}
+		stateCounts = data["stateCounts"]
 		for shortname in sorted(self.servers):
 			server = self.servers[shortname]
 			stateCounts.setdefault(server.state, 0)
 			stateCounts[server.state] += 1
-			serverCount += 1
+			data["servers"] += 1
 			if server.hidden: continue
 			if server.state != "loggedIn":
-				if server.state == "disconnected" and not server.autoLogin:
-					continue
 				state = server.state
-				if server.conn and server.conn.state and server.conn.state != state:
-					state += self.conn.state
-				offs.setdefault(state, [])
-				offs[state].append(shortname)
-			elif len(server.users) <= 1:
-				# 1 allows for this user.
+				if short:
+					if server.state == "disconnected" and not server.autoLogin:
+						continue
+					if server.conn and server.conn.state and server.conn.state != state:
+						state += "/" +server.conn.state
+				data["offs"].setdefault(state, [])
+				data["offs"][state].append(shortname)
 				continue
+			if server.conn and server.conn.linkWarning:
+				data["linkWarnings"].append("%s (%s)" % (shortname, server.conn.linkWarning))
+			if len(server.users) <= 1:
+				# 1 allows for this user.
+				if not short: data["empties"].append(shortname)
+			elif short:
+				line = self.shortSumLine(server)
+				if line: data["sums"].append((shortname, line))
 			else:
-				sums.append(shortname)
-		if len(offs):
-			for k in sorted(offs.keys()):
-				print("%s: %s" % (
-					k,
-					", ".join(offs[k])
-				))
-		for shortname in sums:
-			server = self.servers[shortname]
-			self.oneShortSum(server)
+				data["sums"].append((shortname, "[%s] %s" % (shortname, server.channelSummary())))
+		return data
+
+	def printSummary(self, data, short=False):
+		"""Print a summary from summaryData().
+		"""
+		if not data["servers"]:
+			print("No servers.")
+			return
+		offs = data["offs"]
+		for k in sorted(offs.keys()):
+			print("%s: %s" % (
+				k,
+				", ".join(offs[k])
+			))
+		if data["empties"]:
+			print("No users: " +", ".join(data["empties"]))
+		for shortname,text in data["sums"]:
+			if short: print(text)
+			else: self.msg(text)
+		if data["linkWarnings"]:
+			print("Links that may be failing: " +", ".join(data["linkWarnings"]))
+		stateCounts = data["stateCounts"]
 		print("Server count {0:d}: {1}".format(
-			serverCount,
+			data["servers"],
 			", ".join(["{0:d} {1}".format(stateCounts[state], state) for state in stateCounts])
 		))
 
-	def oneShortSum(self, server):
-		"""Short-form summary for one server.
+	def shortSumLine(self, server):
+		"""Short-form summary line for one server, or "" if nobody is in a channel.
 		"""
 		# Users other than me and that are actuallly in a channel.
-		users = [u for u in server.users.values() if (u.get("channelid") or u.get("chanid"))
+		users = [u for u in server.snapshot().users.values() if (u.get("channelid") or u.get("chanid"))
 			and u.userid != server.me.userid]
 		if not len(users):
-			return
+			return ""
 		users = [server.nonEmptyNickname(u, shortenFacebook=True) for u in users]
 		users.sort(key=lambda u: u.lower())
-		line = "%s (%d): %s" % (
+		return "%s (%d): %s" % (
 			server.shortname,
 			len(users),
 			", ".join(users)
 		)
-		print(line)
+
+	def do_find(self, line=""):
+		"""Find users on all servers by nickname, username, or IP address.
+		Usage: find [-p] [-n count] text
+		Lists users with text anywhere in one of those fields, case ignored;
+		with -p, only those with a field starting with text.
+		At most 100 users are listed unless -n gives another count (0 for all).
+		"""
+		parser = ArgumentParser(prog="find", description="Find users on all servers by nickname, username, or IP address.", epilog="Examples: find bob, find -p 192.168., find -n 0 guest")
+		parser.add_argument("-p", "--prefix", action="store_true", help="Match only at the start of a field.")
+		parser.add_argument("-n", "--count", type=int, default=100, help="Most users to list, 0 for all (default 100).")
+		parser.add_argument("text", nargs="+", help="Text to find. Quote text that contains spaces.")
+		opts = parser.parse_args(shlex.split(line))
+		total,rows = self.findUsers(" ".join(opts.text), opts.prefix, opts.count if opts.count > 0 else None)
+		if not rows:
+			self.msg("No users found.")
+			return
+		tbl = TableFormatter("Users Found", ["Server", "Userid", "Nickname", "Username", "IP Address"])
+		for row in rows:
+			ipaddr = row[4]
+			if ipaddr.lower().startswith("::ffff:"): ipaddr = ipaddr[7:]
+			tbl.addRow(list(row[:4]) +[ipaddr])
+		buf = tbl.format(2)
+		if total > len(rows):
+			buf += "\n{0} of {1} users listed; use -n for more.".format(len(rows), total)
+		self.msg(buf)
+
+	def findUsers(self, text, prefix=False, limit=None):
+		"""Return (total, rows) for find, where rows are (shortname, userid, nickname, username, ipaddr) tuples,
+		at most limit of them if limit is given.
+		"""
+		total,rows = userIndex.search(text, prefix, limit)
+		return total, [(row[0].shortname,) +row[1:] for row in rows]
 
 	def do_join(self, line):
 		"""Join a channel.
@@ -710,6 +864,88 @@ TTCom version %ver%
 		"""
 		self.curServer.logout()
 
+	def do_reconnects(self, line=""):
+		"""Show automatic reconnect state for servers that have dropped:
+		whether each is waiting, connecting, or has its circuit open after repeated failures,
+		its consecutive failures, attempts, and seconds until its next attempt.
+		"""
+		self.msg(reconnects.report())
+
+	def do_diag(self, line=""):
+		"""Runtime diagnostics: threads, queue depths, user/channel/file counts,
+		approximate memory, time since the last event, and ping round trips for each server,
+		plus process-wide message, speech, trigger, and reconnect queues.
+		Run without arguments for a list of subcommands, or type a subcommand and -h for help with that subcommand.
+		Example: diag list -h.
+		"""
+		args = TTParms(line, True)
+		self.dispatchSubcommand("diag_", args)
+
+	def diag_list(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="diag list", description="Show runtime diagnostics by server, then process-wide queues.", epilog="Examples: diag list, diag li -s memory -n 10")
+		parser.add_argument("-s", "--sort", default="name", choices=sorted(diag.Diagnostics.sortKeys), help="Sort servers by this, largest first (default name).")
+		parser.add_argument("-n", "--limit", type=int, default=0, help="Show only this many servers.")
+		opts = parser.parse_args(args)
+		diags = diag.Diagnostics([self.servers[k] for k in sorted(self.servers)])
+		self.msg(diags.serverTable(opts.sort, opts.limit))
+		self.msg(diags.globalReport())
+
+	def diag_server(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="diag server", description="Show runtime diagnostics, including thread names, for one server.", epilog="Examples: diag server, diag se myserver")
+		parser.add_argument("server", nargs="?", default="", help="Server to show instead of the current one.")
+		opts = parser.parse_args(args)
+		if opts.server: server = self.serverMatch(opts.server)
+		else: server = self.curServer
+		diags = diag.Diagnostics([server])
+		self.msg(diags.serverDetail(diags.servers[0]))
+
+	def do_perf(self, line=""):
+		"""Event processing timings: p50, p99, and maximum microseconds per event type,
+		for the whole event and for each phase:
+		parse, hookPre (logging), handler, output, and hookPost (triggers).
+		Run without arguments for a list of subcommands, or type a subcommand and -h for help with that subcommand.
+		Example: perf show -h.
+		"""
+		args = TTParms(line, True)
+		self.dispatchSubcommand("perf_", args)
+
+	def perfServers(self, opts):
+		"""Return the servers a perf subcommand applies to: all with -a, the one named, or the current one.
+		"""
+		if opts.all: return [self.servers[k] for k in sorted(self.servers)]
+		elif opts.server: return [self.serverMatch(opts.server)]
+		return [self.curServer]
+
+	def perf_show(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="perf show", description="Show event processing time by event type.", epilog="Examples: perf show, perf sh -a, perf sh -a -j perf.json, perf sh myserver")
+		parser.add_argument("-a", "--all", action="store_true", help="Combine all servers instead of just the current one.")
+		parser.add_argument("-j", "--json", default="", help="Also write per-server timings, including histogram buckets in nanoseconds, to this JSON file.")
+		parser.add_argument("server", nargs="?", default="", help="Server to show instead of the current one.")
+		opts = parser.parse_args(args)
+		servers = self.perfServers(opts)
+		if opts.json:
+			with open(opts.json, "w") as f:
+				json.dump(dict((s.shortname, s.perf.toDict()) for s in servers), f, indent=1, sort_keys=True)
+		if opts.all:
+			combined = perfstats.ServerPerf()
+			for server in servers: combined.merge(server.perf)
+			self.msg(combined.report("Event Processing, All Servers"))
+		else:
+			self.msg(servers[0].perf.report("Event Processing, %s" % (servers[0].shortname)))
+
+	def perf_reset(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="perf reset", description="Clear event processing timings.", epilog="Examples: perf reset, perf res -a, perf res myserver")
+		parser.add_argument("-a", "--all", action="store_true", help="Clear timings for all servers instead of just the current one.")
+		parser.add_argument("server", nargs="?", default="", help="Server to clear instead of the current one.")
+		opts = parser.parse_args(args)
+		servers = self.perfServers(opts)
+		for server in servers: server.perf.reset()
+		self.msg("Timings cleared for %s." % ("all servers" if opts.all else servers[0].shortname))
+
 	def do_broadcast(self, line):
 		"""Send a broadcast message to all people on a server,
 		even those who are currently not in a channel. The message
@@ -741,8 +977,9 @@ TTCom version %ver%
 		for u in args[:-1]:
 			if u.startswith("@"):
 				chan = self.channelMatch(u[1:])
-				cid = self.curServer.channels[chan["channelid"]]["channelid"]
-				for u1 in self.curServer.users.values():
+				snap = self.curServer.snapshot()
+				cid = snap.channels[chan["channelid"]]["channelid"]
+				for u1 in snap.users.values():
 					if u1.get("channelid") == cid:
 						users.append(u1)
 			else:
@@ -1001,7 +1238,7 @@ TTCom version %ver%
 		parser.add_argument("-k", "--kick", action="store_true", help="Also kick the user(s) being banned.")
 		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific user field, or just value to match against any field. Fields include userid, username, usertype, userdata, nickname, ipaddr, udpaddr, clientname, version, packetprotocol, statusmode, statusmsg, sublocal, and subpeer (not all of these are likely to prove useful).  More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, a plain integer like 295 matches an exact userid.')
 		opts = parser.parse_args(args)
-		users = self.curServer.users
+		users = self.curServer.snapshot().users
 		parmsets = []
 		for user in users:
 			parms = users[user]
@@ -1049,11 +1286,18 @@ TTCom version %ver%
 		"""
 		self.do_ban("add -k "+str(line))
 
-	def getAccounts(self):
+	def getAccounts(self, complete=True, refresh=False):
 		"""Return the set of accounts on this server.
 		Returns a dict of ParmLines, one for each account.
 		The keys are the usernames.
+		The list is reused for accountCacheSecs seconds (see AccountCache).
+		complete=False accepts accounts known only from what this client sent,
+		and refresh=True always asks the server.
 		"""
+		cache = self.curServer.accountCache
+		if not refresh:
+			d = cache.get(complete)
+			if d is not None: return d
 		accts = self.request("listaccounts")
 		# Remove the final Ok event.
 		resp = accts.pop()
@@ -1064,6 +1308,7 @@ TTCom version %ver%
 		for acct in accts:
 			if acct.event == "ok": continue
 			d[acct.parms.username] = acct
+		cache.set(d)
 		return d
 
 	def getBans(self, chan=None):
@@ -1085,7 +1330,7 @@ TTCom version %ver%
 		Warning: This may take a while on a server with hundreds of channels.
 		"""
 		bans = []
-		[bans.extend(self.getBans(channel)) for channel in self.curServer.channels]
+		[bans.extend(self.getBans(channel)) for channel in self.curServer.snapshot().channels]
 		return bans
 
 	def do_account(self, line):
@@ -1096,42 +1341,20 @@ TTCom version %ver%
 		args = TTParms(line, True)
 		self.dispatchSubcommand("account_", args)
 
-	def filterPasses(self, parms, filters, nullIsAnonymousAccount=False):
+	def filterPasses(self, parms, filters, nullIsAnonymousAccount=False, text=None):
 		"""Returns True if the given parameter set passes the given filter list and False if not.
+		text, if given, must be filterText(parms), e.g., as kept by an AccountCache.
 		"""
 		if not filters: return True
-		if isinstance(parms, dict): vals = list(parms.values())
-		else: vals = parms
-		try: vals = ", ".join(vals)
-		except TypeError:
-			vals1 = []
-			for val in vals:
-				val1 = None
-				try: val1 = str(val)
-				except:
-					try: val1 = str(val)
-					except: pass
-				if val1 is None: continue
-				vals1.append(val1)
-			vals = ", ".join(vals1)
-		for filter in filters:
-			# ToDo: Bit of a kludge here.
-			if filter.startswith('"') and filter.endswith('"'): filter = filter[1:-1]
-			elif filter.endswith('"') and '="' in filter: filter = filter.replace('="', '=', 1)[:-1]
-			if "=" in filter:
-				fname,fvalWanted = filter.split("=", 1)
-				invert = False
-				if fname.startswith("!"):
-					fname = fname[1:]
-					invert = True
-				fvalActual = parms[fname]
-				if not invert and fvalActual != fvalWanted: return False
-				elif invert and fvalActual == fvalWanted: return False
-			elif filter == "" and nullIsAnonymousAccount:
+		for fname,fval,invert in parseFilters(filters):
+			if fname is not None:
+				if (parms[fname] == fval) == invert: return False
+			elif fval == "" and nullIsAnonymousAccount:
 				# Special case for matching the anonymous account in an account list.
 				if parms["username"] != "": return False
 			else:
-				if filter.lower() not in repr(vals).lower(): return False
+				if text is None: text = filterText(parms)
+				if fval not in text: return False
 		return True
 
 	def account_list(self, args):
@@ -1141,17 +1364,19 @@ TTCom version %ver%
 		parser.add_argument("-l", "--long", action="store_true", help="Long listing; include all non-empty fields except passwords.")
 		parser.add_argument("-e", "--everything", action="store_true", help="Full listing; include all fields, even empty fields, except passwords. Useful for determining what fields exist.")
 		parser.add_argument("-p", "--passwords", action="store_true", help="Includes passwords in output.")
+		parser.add_argument("-r", "--refresh", action="store_true", help="Ask the server for the list even if a recent copy is cached (see the accountCacheSecs option).")
 		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Fields include username, password, usertype, userdata, userrights, note, initchan, opchannels, and audiocodeclimit. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces. As a special case, "" matches the anonymous account.')
 		opts = parser.parse_args(args)
 		if opts.admin: opts.filter.append("usertype=2")
-		accts = self.getAccounts()
+		accts = self.getAccounts(refresh=opts.refresh)
+		cache = self.curServer.accountCache
 		if opts.filter: ttl = "Matching User Accounts"
 		else: ttl = "User Accounts"
 		parmsets = []
 		for username in sorted(accts):
 			acct = accts[username]
 			parms = acct.parms
-			if not self.filterPasses(parms, opts.filter, True): continue
+			if not self.filterPasses(parms, opts.filter, True, cache.text(username, parms)): continue
 			parmsets.append(parms)
 		if not opts.long and not opts.everything:
 			# Short, tabular listing.
@@ -1196,7 +1421,8 @@ TTCom version %ver%
 		parser.add_argument("usertype", help="1 for regular account, 2 for admin account, or the username of an account to use for user rights (TT5 only).")
 		parser.add_argument("field", nargs="*", help="fieldname=value pairs to set other fields for the account. More than one pair may be specified. Example fields include note and userdata. Use quotes if a field value contains spaces. Warning: If you specify an invalid field name, such as by misspelling a field name, the field value will be ignored and will not be set on the account.")
 		opts = parser.parse_args(args)
-		acctDict = self.getAccounts()
+		# Only names and the rights of existing accounts are needed here, so accounts just added will do.
+		acctDict = self.getAccounts(False)
 		pat = r'''[\s.,?/;:@#$%^&*'"!+=_-]+'''
 		u0 = re.sub(pat, '', opts.username.lower())
 		for username in acctDict.keys():
@@ -1249,11 +1475,12 @@ TTCom version %ver%
 		opts = parser.parse_args(args)
 		if opts.admin: opts.filter.append("usertype=2")
 		accts = self.getAccounts()
+		cache = self.curServer.accountCache
 		acctDict = {}
 		for username in sorted(accts):
 			acct = accts[username]
 			parms = acct.parms
-			if not self.filterPasses(parms, opts.filter, True): continue
+			if not self.filterPasses(parms, opts.filter, True, cache.text(username, parms)): continue
 			acctDict[username] = parms
 		if not acctDict:
 			raise CommandError("No matching accounts")
@@ -1313,7 +1540,7 @@ TTCom version %ver%
 		parser.add_argument("-p", "--passwords", action="store_true", help="Includes passwords in output.")
 		parser.add_argument("filter", nargs="*", help='fieldname=value to match exactly against a specific field, or just value to match against any field. Useful fields include name, topic, protected, maxusers, and type. More than one filter can be given. Prefix fieldname with "!" to select mismatches instead of matches. Quote any values that contain spaces.')
 		opts = parser.parse_args(args)
-		chans = self.curServer.channels
+		chans = self.curServer.snapshot().channels
 		if opts.filter: ttl = "Matching Channels"
 		else: ttl = "Channels"
 		parmsets = []
@@ -1402,17 +1629,76 @@ TTCom version %ver%
 		with open(fname, "w", encoding="utf-8") as f:
 			f.write(tt)
 
+	def do_triggers(self, line):
+		"""Trigger management and profiling.
+		Run without arguments for a list of subcommands, or type a subcommand and -h for help with that subcommand.
+		Example: triggers stats -h.
+		"""
+		args = TTParms(line, True)
+		self.dispatchSubcommand("triggers_", args)
+
+	def triggers_stats(self, args):
+		"Use -h to get a full syntax description for this subcommand."
+		parser = ArgumentParser(prog="triggers stats", description="Show evaluation, hit, and timing counts for config file triggers and ttcom_triggers classes, costliest first.", epilog="Examples: triggers stats, trig st -n 5, trig st -a, trig st -r")
+		parser.add_argument("-n", "--count", type=int, default=10, help="How many triggers to list (default 10). Use 0 for all.")
+		parser.add_argument("-a", "--all", action="store_true", help="Include triggers from all servers instead of just the current one.")
+		parser.add_argument("-r", "--reset", action="store_true", help="Reset the counters after printing them.")
+		opts = parser.parse_args(args)
+		if opts.all: servers = [self.servers[s] for s in sorted(self.servers)]
+		else: servers = [self.curServer]
+		# Rank whole triggers by cost, then list each one's matches under it.
+		ranked = []
+		for server in servers:
+			triggers = getattr(server, "triggers", None)
+			if not triggers: continue
+			matchRows = {}
+			for name,matchName,stats in triggers.statRows():
+				if matchName:
+					matchRows.setdefault(name, []).append((matchName, stats))
+				else:
+					ranked.append((server.shortname, name, stats, matchRows.setdefault(name, [])))
+		ranked.sort(key=lambda r: r[2].cost(), reverse=True)
+		if opts.count > 0: ranked = ranked[:opts.count]
+		ms = lambda ns: "{0:.3f}".format(ns / 1000000.0)
+		tbl = TableFormatter("Trigger Statistics", [
+			"Server", "Trigger", "Evals", "Hits", "Match ms", "Action ms", "Total ms"
+		])
+		for shortname,name,stats,matches in ranked:
+			tbl.addRow([shortname, name, stats.evals, stats.hits,
+				ms(stats.matchNs), ms(stats.actionNs), ms(stats.cost())
+			])
+			for matchName,mstats in sorted(matches, key=lambda m: m[1].cost(), reverse=True):
+				tbl.addRow(["", "  " +matchName, mstats.evals, mstats.hits,
+					ms(mstats.matchNs), ms(mstats.actionNs), ms(mstats.cost())
+				], True)
+		self.msg(tbl.format(2))
+		if opts.reset:
+			for server in servers:
+				triggers = getattr(server, "triggers", None)
+				if triggers: triggers.resetStats()
+			self.msg("Trigger statistics reset.")
+
 	def do_say(self, line):
 		"""Say the given line if possible.
 		Quoting is not necessary or desirable.
+		Without a line, shows the speech queue state.
 		"""
+		if not line.strip():
+			self.msg(speech.speaker.status())
+			return
 		mycmd_say(line)
 
 	def do_play(self, line):
-		"""Play a sound file via the SoX play command. Requires the play command to be on the path.
+		"""Play a sound file via the SoX play command. Requires the play and sox commands to be on the path.
 		Files are played in the order received, in their own thread to avoid delaying the entire application.
-		When the queue of files to play grows, files will be batched onto multi-file play commands for speed.
+		One play process is kept running and fed audio as files arrive, so there is no startup delay per file.
+		Sounds are converted once, with the rest of their directory, and kept in memory for later plays.
+		Without a file name, shows the play queue depth and play latency.
 		"""
+		line = self.dequote(line.strip())
+		if not line:
+			self.msg(player.getWorker().status())
+			return
 		player.sendFile(line)
 
 	def do_system(self, line):
@@ -1491,7 +1777,7 @@ TTCom version %ver%
 			buf += "\nOn channel %s (%s)" % (channelid, channel)
 		server = u.pop("server", None)
 		if server:
-			channels = list(server.channels.values())
+			channels = list(server.snapshot().channels.values())
 		else:
 			channels = []
 		for which in [
@@ -1568,9 +1854,10 @@ TTCom version %ver%
 		line = line.strip()
 		if not line:
 			# List all ops on server.
-			for u in sorted(list(server.users.values()), key=lambda u1: server.nonEmptyNickname(u1)):
+			snap = server.snapshot()
+			for u in sorted(list(snap.users.values()), key=lambda u1: server.nonEmptyNickname(u1)):
 				userid = u.userid
-				matches = [c for c in server.channels.values() if userid in (c.get(k) or [])]
+				matches = [c for c in snap.channels.values() if userid in (c.get(k) or [])]
 				matches = ", ".join([c.channel for c in matches])
 				if matches:
 					self.msg("%s: %s" % (
@@ -1614,7 +1901,7 @@ TTCom version %ver%
 			# Let the op list print after those modifications.
 		# List ops for just this user.
 		userid = u.userid
-		matches = [c for c in server.channels.values() if userid in (c.get(k) or [])]
+		matches = [c for c in server.snapshot().channels.values() if userid in (c.get(k) or [])]
 		matches = ", ".join([c.channel for c in matches])
 		if matches:
 			self.msg("%s: %s" % (
@@ -1626,7 +1913,7 @@ TTCom version %ver%
 		"""List the admins currently on server and where they are and come from.
 		"""
 		channelname = self.curServer.channelname
-		for u in self.curServer.users.values():
+		for u in self.curServer.snapshot().users.values():
 			if not u.usertype or int(u.usertype) != 2: continue
 			ch = None
 			if u.chanid: ch = channelname(u.chanid)
@@ -1644,6 +1931,7 @@ TTCom version %ver%
 
 	def do_run(self, fname):
 		"""Run, or replay, a file of raw TeamTalk API commands at the current server.
+		Commands are sent in order, coalesced into as few network writes as possible.
 		"""
 		if not fname:
 			print("No file name specified.")
@@ -1653,6 +1941,7 @@ TTCom version %ver%
 		if not os.path.exists(fname):
 			print("File %s not found." % (fname))
 			return
+		lines = []
 		for line in open(fname, encoding="utf-8"):
 			line = line.strip()
 			if line.startswith("addchannel"):
@@ -1667,9 +1956,14 @@ TTCom version %ver%
 				line1,sep,rest = line[i:].partition(" ")
 				line = line[:i-1] +rest
 				line1 = "updateserver " +line1
-				self.rawSend(line1)
-			self.rawSend(line)
-		return
+				lines.append(line1)
+			lines.append(line)
+		conn = self.curServer.conn
+		if not conn or not conn.sendLines(lines):
+			print("Connection lost during replay.")
+			return
+		conn.outbound.drain(60)
+		self.msg(conn.outbound.status())
 
 	def rawSend(self, line):
 		"""Send a raw line to the server.
@@ -1685,6 +1979,8 @@ TTCom version %ver%
 			self.curServer.shortname,
 			"_send_ " +str(line)
 		))
+		# Before sending, so an error reply can still invalidate the change (see MyTeamtalkServer.event_error).
+		self.curServer.accountCache.sent(line)
 		self.curServer.sendWithWait(line)
 
 	def request(self, line):
@@ -1693,11 +1989,48 @@ TTCom version %ver%
 		"""
 		return self.curServer.sendWithWait(line, True)
 
+	def applyOption(self, opt, val):
+		"""Make an option value take effect.
+		"""
+		if opt == "coalesceEvents":
+			mq.setCoalescing(val)
+		elif opt == "wrapWidth":
+			try: setWrapWidth(val if val.strip() else 79)
+			except ValueError: print("Invalid wrapWidth value: " +val)
+		elif opt == "speechMaxAge":
+			try: speech.speaker.maxAge = float(val) if val.strip() else 30.0
+			except ValueError: print("Invalid speechMaxAge value: " +val)
+		elif opt == "reconnectConcurrency":
+			try: reconnects.setMaxConcurrent(int(val) if val.strip() else 4)
+			except ValueError: print("Invalid reconnectConcurrency value: " +val)
+		elif opt == "accountCacheSecs":
+			try: AccountCache.ttl = float(val) if val.strip() else 60.0
+			except ValueError: print("Invalid accountCacheSecs value: " +val)
+		elif opt == "metricsPort" and not self.shard:
+			try: result = metrics.setExporter(val, lambda: list(self.servers.values()))
+			except (ValueError, OSError) as e: result = "Metrics exporter not started for %s: %s" % (val, str(e))
+			if val.strip(): print(result)
+
 	def do_option(self, line=""):
 		"""Get or set a TTCom option by its name.  Valid options:
 			queueMessages: Set non-zero to make messages print only when Enter is pressed.
 				This keeps events from disrupting input lines.
-			speakEvents: Set non-zero to make events speak through MacOS on arrival.
+			loginConcurrency: How many servers may connect and log in at once at startup (default 8).
+			reconnectConcurrency: How many dropped servers may reconnect at once (default 4).
+			speakEvents: Set non-zero to make events speak on arrival.
+			speechMaxAge: Seconds an event may wait to be spoken before it is skipped (default 30).
+				0 never skips.
+			coalesceEvents: Set to a message rate per second above which
+				bursts of joins, leaves, logins, and logouts print as counts, e.g., "37 users joined /lobby/".
+				0 or unset prints every event.
+			wrapWidth: Column at which output lines wrap (default 79).
+				0 turns wrapping off, which suits logging and piping output.
+			metricsPort: Port, or host:port, on which to serve Prometheus metrics at /metrics.
+				The host defaults to 127.0.0.1 (this computer only). 0 or unset serves nothing.
+			accountCacheSecs: Seconds a server's account list is reused before it is requested again (default 60).
+				0 requests it every time.
+			controlSocket: Unix domain socket path for daemon mode (ttcom.py -d), ttcom.sock by default.
+				Takes effect when the daemon next starts.
 		Type with no parameters for a list of all options and their values.
 		"""
 		optname,sep,newval = line.partition(" ")
@@ -1706,7 +2039,15 @@ TTCom version %ver%
 		if not newval: newval = None
 		opts = [
 			("queueMessages", "Queue messages on arrival and print on Enter."),
-			("speakEvents", "Speak events through MacOS on arrival")
+			("loginConcurrency", "How many servers may connect and log in at once at startup"),
+			("reconnectConcurrency", "How many dropped servers may reconnect at once"),
+			("speakEvents", "Speak events on arrival"),
+			("speechMaxAge", "Seconds an event may wait to be spoken before it is skipped"),
+			("coalesceEvents", "Event rate per second above which join/leave/login/logout bursts print as counts"),
+			("wrapWidth", "Column at which output wraps, 0 for no wrapping"),
+			("metricsPort", "Port or host:port for the Prometheus metrics listener, 0 for none"),
+			("accountCacheSecs", "Seconds an account list is reused, 0 for no reuse"),
+			("controlSocket", "Socket path for daemon mode")
 		]
 		if not optname:
 			lst = []
@@ -1721,8 +2062,10 @@ TTCom version %ver%
 		f = lambda o: ": ".join(o)
 		opts = [o for o in opts if optname.lower() in o[0].lower()]
 		opt = self.selectMatch(opts, "Select an Option:", f)[0]
+		val = conf.option(opt, newval)
+		self.applyOption(opt, val)
 		self.msg("%s = %s" % (
 			opt,
-			conf.option(opt, newval)
+			val
 		))
 
@@ -0,0 +1,5 @@
+"""Offline benchmarks for TTCom.
+Run these from the src directory as modules; e.g.,
+	python -m benchmarks.sound_latency
+Each module's doc string describes its options.
+"""
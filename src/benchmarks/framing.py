@@ -0,0 +1,153 @@
+"""Inbound line framing throughput over a loopback socket.
+
+A stand-in server thread streams a TeamTalk-style login snapshot
+(channels, users, id blocks, and pongs) and closes the connection.
+The client side reads it three ways and reports lines and megabytes per second:
+	makefile: The old watcher loop: socket.makefile("r") with rstrip().lower() per line.
+	reader: framing.LineReader with the watcher's bytes-level pong and begin/end checks.
+	connection: A real TeamTalkServerConnection, from welcome line to EOF, with a counting callback.
+
+Usage (from the src directory):
+	python -m benchmarks.framing [-c channels] [-u users] [-r repeat]
+-c: Channels in the snapshot (default 2000).
+-u: Users in the snapshot (default 20000).
+-r: Times to stream the snapshot per mode (default 3).
+"""
+
+import argparse
+import socket, threading, time
+
+from framing import LineReader
+from ttapi import TeamTalkServerConnection
+
+
+def makeSnapshot(channels, users):
+	"""Return the bytes of a login snapshot like a large server sends.
+	"""
+	lines = ['serverupdate servername="Bench" maxusers=20000 motd="Welcome to the benchmark"']
+	lines.append("begin id=1")
+	for c in range(1, channels +1):
+		lines.append('addchannel chanid=%d channel="/room %d/" parentid=1 topic="Topic for room %d" password="" protected=0 type=0 maxusers=1000' % (c, c, c))
+	for u in range(1, users +1):
+		lines.append('loggedin userid=%d nickname="User %d" username="user%d" ipaddr="10.0.%d.%d" version="5.8.1" packetprotocol=1 usertype=1 statusmode=0 statusmsg=""' % (u, u, u, u // 256 % 256, u % 256))
+		lines.append("adduser userid=%d chanid=%d" % (u, u % channels +1))
+		if u % 500 == 0: lines.append("pong")
+	lines.append("end id=1")
+	lines.append("ok")
+	return ("\r\n".join(lines) +"\r\n").encode("utf-8")
+
+
+class Streamer(object):
+	"""Loopback stand-in server that sends a welcome line and payload to each client, then closes.
+	"""
+	welcome = b'teamtalk userid=1 servername="Bench" usertimeout=60 protocol="5.6"\r\n'
+
+	def __init__(self, payload, welcome=True):
+		self.payload = payload
+		self.sendWelcome = welcome
+		self.lsock = socket.socket()
+		self.lsock.bind(("127.0.0.1", 0))
+		self.lsock.listen(5)
+		self.port = self.lsock.getsockname()[1]
+		th = threading.Thread(target=self.serve, name="streamer")
+		th.daemon = True
+		th.start()
+
+	def serve(self):
+		while True:
+			conn,addr = self.lsock.accept()
+			th = threading.Thread(target=self.stream, args=(conn,), name="streamerClient")
+			th.daemon = True
+			th.start()
+
+	def stream(self, conn):
+		"""Send to one client, then drain what it sends (pings) until it closes.
+		Closing with unread input would reset the connection and lose unsent data.
+		"""
+		try:
+			if self.sendWelcome: conn.sendall(self.welcome)
+			conn.sendall(self.payload)
+			conn.shutdown(socket.SHUT_WR)
+			while conn.recv(4096): pass
+		except OSError:
+			pass
+		finally:
+			conn.close()
+
+
+def readMakefile(port):
+	sock = socket.create_connection(("127.0.0.1", port))
+	count = 0
+	curid = None
+	for line in sock.makefile("r", encoding="utf-8"):
+		ll = line.rstrip().lower()
+		if ll.startswith("begin id="):
+			curid = ll.split("=")[1]
+		elif ll.startswith("end id="):
+			curid = None
+		elif not curid and ll == "pong":
+			continue
+		count += 1
+	sock.close()
+	return count
+
+
+def readLineReader(port):
+	sock = socket.create_connection(("127.0.0.1", port))
+	count = 0
+	curid = None
+	markerStarts = TeamTalkServerConnection.markerStarts
+	for bline in LineReader(sock):
+		if bline[:1] in markerStarts:
+			ll = bline.rstrip().lower()
+			if ll == b"pong":
+				if not curid: continue
+			elif ll.startswith(b"begin id="): curid = ll[9:]
+			elif ll.startswith(b"end id="): curid = None
+		bline.decode("utf-8", "replace")
+		count += 1
+	sock.close()
+	return count
+
+
+def readConnection(port):
+	done = threading.Event()
+	counter = [0]
+	def callback(line):
+		if line.startswith("_disconnected_"): done.set()
+		else: counter[0] += 1
+	conn = TeamTalkServerConnection(None, "bench", "127.0.0.1", port, False, callback)
+	conn.connect()
+	done.wait()
+	conn.terminate()
+	return counter[0]
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="benchmarks.framing", description="Inbound line framing throughput over a loopback socket.")
+	parser.add_argument("-c", "--channels", type=int, default=2000, help="Channels in the snapshot.")
+	parser.add_argument("-u", "--users", type=int, default=20000, help="Users in the snapshot.")
+	parser.add_argument("-r", "--repeat", type=int, default=3, help="Times to stream the snapshot per mode.")
+	opts = parser.parse_args(args)
+	payload = makeSnapshot(opts.channels, opts.users)
+	plain = Streamer(payload, welcome=False)
+	welcomed = Streamer(payload)
+	print("Snapshot: %d lines, %.1f MB" % (payload.count(b"\n"), len(payload) / 1e6))
+	modes = [
+		("makefile", readMakefile, plain),
+		("reader", readLineReader, plain),
+		("connection", readConnection, welcomed),
+	]
+	for name,func,streamer in modes:
+		best = None
+		for i in range(opts.repeat):
+			t0 = time.perf_counter()
+			count = func(streamer.port)
+			elapsed = time.perf_counter() -t0
+			if best is None or elapsed < best: best = elapsed
+		print("%-10s %9.0f lines/s  %6.1f MB/s  (%d lines passed on, best of %d)" % (
+			name, count / best, len(payload) / best / 1e6, count, opts.repeat
+		))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,104 @@
+"""Throughput of MyCmd.msg() for event output.
+
+Sends a mix of short event lines and longer wrapped lines through
+MyCmd.msg(..., fromEvent=True), with stdout replaced by a sink that
+only counts bytes, and reports messages per second for each formatting mode:
+	textwrap: Every line through textwrap, as format() did before its fast path.
+	wrap: format() as shipped: lines that fit skip textwrap.
+	nowrap: Wrapping turned off (wrapWidth 0), as for log and pipe consumers.
+
+Usage (from the src directory):
+	python -m benchmarks.msg_throughput [-n messages] [-l percent]
+-n: Messages per mode (default 50000).
+-l: Percentage of messages long enough to need wrapping (default 5).
+"""
+
+import argparse
+import sys, textwrap, time
+
+from mplib import mycmd
+
+
+class CountingSink(object):
+	"""Stand-in for stdout that counts writes and bytes.
+	"""
+	def __init__(self):
+		self.writes = 0
+		self.bytes = 0
+
+	def write(self, s):
+		self.writes += 1
+		self.bytes += len(s)
+		return len(s)
+
+	def flush(self):
+		pass
+
+
+def legacyFormat(text, indent1=None, indent2=None, width=79):
+	"""format() as it was before the fast path: one shared TextWrapper, every line wrapped.
+	"""
+	fmt = legacyFormat.fmt
+	if indent1 is None:
+		indent1 = ""
+		indent2 = "   "
+	elif indent2 is None:
+		indent2 = indent1 +"   "
+	fmt.width = width
+	wlines = []
+	for line in text.splitlines():
+		lineIndent = " " * (len(line) -len(line.lstrip()))
+		fmt.initial_indent = indent1
+		fmt.subsequent_indent = indent2 +lineIndent
+		wlines.append("\n".join(fmt.wrap(line)))
+	return "\n".join(wlines)
+legacyFormat.fmt = textwrap.TextWrapper()
+
+
+def makeMessages(count, longPct):
+	"""Return count event-like messages, longPct percent of them long.
+	"""
+	msgs = []
+	longEvery = int(100 / longPct) if longPct else 0
+	for i in range(count):
+		if longEvery and i % longEvery == 0:
+			msgs.append("[srv%d] User %d: " % (i % 8, i) +"a fairly long text message that goes on " * 3)
+		else:
+			msgs.append("[srv%d] User %d joined /lobby/" % (i % 8, i))
+	return msgs
+
+
+def run(msgs):
+	"""Send msgs through MyCmd.msg() and return (seconds, sink).
+	"""
+	sink = CountingSink()
+	stdout = sys.stdout
+	sys.stdout = sink
+	try:
+		t0 = time.perf_counter()
+		for m in msgs:
+			mycmd.MyCmd.msg(m, fromEvent=True)
+		elapsed = time.perf_counter() -t0
+	finally:
+		sys.stdout = stdout
+	return elapsed, sink
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="benchmarks.msg_throughput", description="Throughput of MyCmd.msg() for event output.")
+	parser.add_argument("-n", "--messages", type=int, default=50000, help="Messages per mode.")
+	parser.add_argument("-l", "--long", type=float, default=5, help="Percentage of messages that need wrapping.")
+	opts = parser.parse_args(args)
+	msgs = makeMessages(opts.messages, opts.long)
+	realFormat = mycmd.format
+	for mode in ["textwrap", "wrap", "nowrap"]:
+		mycmd.format = legacyFormat if mode == "textwrap" else realFormat
+		mycmd.setWrapWidth(0 if mode == "nowrap" else 79)
+		try: elapsed,sink = run(msgs)
+		finally:
+			mycmd.format = realFormat
+			mycmd.setWrapWidth(79)
+		print("%-8s %8.0f msgs/s, %d writes, %d bytes" % (mode, len(msgs) / elapsed, sink.writes, sink.bytes))
+
+if __name__ == "__main__":
+	main()
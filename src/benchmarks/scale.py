@@ -0,0 +1,92 @@
+"""Many TeamtalkServer connections against a local stand-in server.
+
+Starts a ttstandin.StandinServer, logs in the requested number of TeamtalkServer objects
+through connmgr.StartupLogin, then runs a storm and reports how fast the clients keep up.
+Event output is discarded and the null sound backend is used.
+
+Usage (from the src directory):
+	python -m benchmarks.scale [-n clients] [-j concurrency] [-c channels] [-u users] [-k kind] [-r rate] [-d seconds]
+-n: TeamtalkServer connections (default 20).
+-j: How many log in at once (default 8).
+-c, -u: Channels and users in the stand-in's snapshot (default 50 and 2000).
+-k: Storm kind: joins, logins, or messages (default joins).
+-r: Storm steps per second (default 500).
+-d: Storm duration in seconds (default 5).
+"""
+
+import argparse
+import time
+
+from conf import conf
+from sound import backend
+from ttstandin import StandinServer
+
+
+def makeServerClass():
+	from ttapi import TeamtalkServer
+	class ScaleServer(TeamtalkServer):
+		"""TeamtalkServer that counts dispatched events and prints nothing.
+		"""
+		def __init__(self, *args, **kwargs):
+			TeamtalkServer.__init__(self, *args, **kwargs)
+			self.events = 0
+			self.lastEvent = 0.0
+
+		def outputFromEvent(self, line, raw=False): pass
+		def errorFromEvent(self, line, raw=False): pass
+
+		def hookEvents(self, parmline, afterDispatch):
+			if afterDispatch:
+				self.events += 1
+				self.lastEvent = time.perf_counter()
+	return ScaleServer
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="benchmarks.scale", description="Many TeamtalkServer connections against a local stand-in server.")
+	parser.add_argument("-n", "--clients", type=int, default=20, help="TeamtalkServer connections.")
+	parser.add_argument("-j", "--concurrency", type=int, default=8, help="How many log in at once.")
+	parser.add_argument("-c", "--channels", type=int, default=50, help="Channels in the snapshot.")
+	parser.add_argument("-u", "--users", type=int, default=2000, help="Users in the snapshot.")
+	parser.add_argument("-k", "--kind", default="joins", choices=["joins", "logins", "messages"], help="Storm kind.")
+	parser.add_argument("-r", "--rate", type=float, default=500, help="Storm steps per second.")
+	parser.add_argument("-d", "--duration", type=float, default=5, help="Storm duration in seconds.")
+	opts = parser.parse_args(args)
+	conf.version = "bench"
+	backend.setBackend("null")
+	from connmgr import StartupLogin
+	standin = StandinServer(channels=opts.channels, users=opts.users).start()
+	ScaleServer = makeServerClass()
+	servers = [ScaleServer("127.0.0.1", standin.port, "scale%d" % (i), {"nickname": "Scale %d" % (i)}) for i in range(opts.clients)]
+	t0 = time.perf_counter()
+	startup = StartupLogin(servers, opts.concurrency).start()
+	if not startup.wait(120):
+		print("Not all clients logged in within 120 s.")
+	loginSecs = time.perf_counter() -t0
+	print(startup.report())
+	times = sorted([r.loginSecs for r in startup.results if r.loginSecs is not None])
+	if times:
+		print("All logins in %.2f s; login p50 %.3f s, max %.3f s" % (loginSecs, times[len(times) // 2], times[-1]))
+	base = sum(s.events for s in servers)
+	t0 = time.perf_counter()
+	storm = standin.storm(opts.kind, opts.rate, opts.duration)
+	storm.join()
+	sent = time.perf_counter()
+	# Wait for clients to finish processing what was sent.
+	linesPerStep = {"joins": 2, "logins": 2, "messages": 1}[opts.kind]
+	expected = base +(storm.steps -storm.skipped) * linesPerStep * len([s for s in servers if s.state == "loggedIn"])
+	deadline = sent +30
+	while sum(s.events for s in servers) < expected and time.perf_counter() < deadline:
+		time.sleep(0.05)
+	done = max([s.lastEvent for s in servers] +[sent])
+	events = sum(s.events for s in servers) -base
+	print("Storm %s: %d steps in %.2f s to %d clients" % (opts.kind, storm.steps, sent -t0, len(servers)))
+	print("Events processed %d of %d expected, %.0f/s; last event %.3f s after the storm ended" % (
+		events, expected -base, events / (done -t0), max(0.0, done -sent)
+	))
+	for s in servers:
+		s.terminate()
+	standin.stop()
+
+if __name__ == "__main__":
+	main()
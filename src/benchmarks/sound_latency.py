@@ -0,0 +1,116 @@
+"""Event-to-sound dispatch latency under synthetic event floods.
+
+Feeds join/leave/login/logout lines straight into TeamtalkServer.processLine(),
+one thread per simulated server, and measures the time from the start of
+processLine() to the moment the sound backend is told to play.
+No audio device is needed; the null sound backend is used.
+
+Usage (from the src directory):
+	python -m benchmarks.sound_latency [-n events] [-s servers] [-r rate] [-v voices]
+-n: Events per server (default 5000).
+-s: Number of simulated servers, each in its own thread (default 4).
+-r: Events per second per server; 0 (the default) means as fast as possible.
+-v: SoundPool voice limit (default: the pool's own).
+"""
+
+import argparse
+import threading, time
+
+from sound import backend
+from conf import conf
+
+
+class TimingBackend(backend.NullBackend):
+	"""Null backend that records dispatch latency relative to the current event's start.
+	"""
+	def __init__(self):
+		backend.NullBackend.__init__(self)
+		self.local = threading.local()
+		self.latencies = []
+		self._lock = threading.Lock()
+
+	def dispatched(self, stream):
+		backend.NullBackend.dispatched(self, stream)
+		start = getattr(self.local, "start", None)
+		if start is None: return
+		with self._lock:
+			self.latencies.append(self.lastDispatch -start)
+
+
+def percentile(values, pct):
+	"""Return the pct percentile (0-100) of a sorted list.
+	"""
+	if not values: return 0.0
+	i = int(round((len(values) -1) * pct / 100.0))
+	return values[i]
+
+
+def makeServer(n):
+	"""Make an offline, logged-in, silent server with one channel.
+	"""
+	from ttapi import TeamtalkServer
+	from tt_attrdict import AttrDict
+	class BenchServer(TeamtalkServer):
+		def outputFromEvent(self, line, raw=False): pass
+		def errorFromEvent(self, line, raw=False): pass
+	server = BenchServer("localhost", 10333, "bench%d" % (n), {})
+	server.state = "loggedIn"
+	server.play_sounds = 1
+	server.info = AttrDict({"userid": "1", "version": "5.8"})
+	server.me = AttrDict({"userid": "1"})
+	server.users["1"] = server.me
+	server.channels["1"] = AttrDict({"chanid": "1", "channel": "/", "parentid": "0"})
+	server.channels["2"] = AttrDict({"chanid": "2", "channel": "/lobby/", "parentid": "1", "name": "lobby"})
+	return server
+
+
+def flood(server, timing, count, rate):
+	"""Feed count synthetic events to server, paced at rate per second if rate is non-zero.
+	"""
+	interval = 1.0 / rate if rate else 0.0
+	nextTime = time.perf_counter()
+	for i in range(count):
+		userid = str(100 +(i // 4) % 500)
+		kind = i % 4
+		if kind == 0: line = 'loggedin userid=%s nickname="User %s" username="u%s" usertype=1' % (userid, userid, userid)
+		elif kind == 1: line = "adduser userid=%s chanid=2" % (userid)
+		elif kind == 2: line = "removeuser userid=%s chanid=2" % (userid)
+		else: line = "loggedout userid=%s" % (userid)
+		if interval:
+			nextTime += interval
+			delay = nextTime -time.perf_counter()
+			if delay > 0: time.sleep(delay)
+		timing.local.start = time.perf_counter()
+		server.processLine(line)
+		timing.local.start = None
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="benchmarks.sound_latency", description="Event-to-sound dispatch latency under synthetic event floods.")
+	parser.add_argument("-n", "--events", type=int, default=5000, help="Events per server.")
+	parser.add_argument("-s", "--servers", type=int, default=4, help="Number of simulated servers.")
+	parser.add_argument("-r", "--rate", type=float, default=0, help="Events per second per server, 0 for unpaced.")
+	parser.add_argument("-v", "--voices", type=int, default=0, help="SoundPool voice limit.")
+	opts = parser.parse_args(args)
+	conf.version = "bench"
+	timing = backend.setBackend(TimingBackend())
+	import ttapi
+	if opts.voices:
+		ttapi.pool.set_max_voices(opts.voices)
+	servers = [makeServer(n) for n in range(opts.servers)]
+	threads = [threading.Thread(target=flood, args=(s, timing, opts.events, opts.rate)) for s in servers]
+	t0 = time.perf_counter()
+	for th in threads: th.start()
+	for th in threads: th.join()
+	elapsed = time.perf_counter() -t0
+	lat = sorted(timing.latencies)
+	total = opts.events * opts.servers
+	ms = lambda s: s * 1000.0
+	print("Events %d in %.3f s (%.0f/s), servers %d" % (total, elapsed, total / elapsed, opts.servers))
+	print("Sounds dispatched %d, coalesced %d, voices stolen %d" % (timing.dispatches, ttapi.pool.coalesced, ttapi.pool.stolen))
+	print("Dispatch latency ms: p50 %.3f, p90 %.3f, p99 %.3f, max %.3f" % (
+		ms(percentile(lat, 50)), ms(percentile(lat, 90)), ms(percentile(lat, 99)), ms(lat[-1] if lat else 0.0)
+	))
+
+if __name__ == "__main__":
+	main()
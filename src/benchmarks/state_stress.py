@@ -0,0 +1,122 @@
+"""Stress test of server state reads while events change it.
+
+Logs one TeamtalkServer into a local ttstandin.StandinServer, runs a login/logout storm
+(users come and go, so the users dict changes size constantly),
+and meanwhile has reader threads walk users and channels the way command handlers do.
+Reports read errors, reads that saw users in unknown channels, reads per second, how long snapshot copies held the event thread,
+and whether the client kept up with the storm.
+With --live, readers iterate the live dicts instead of snapshots, to show the failures snapshots prevent.
+
+Usage (from the src directory):
+	python -m benchmarks.state_stress [-t readers] [-u users] [-r rate] [-d seconds] [--live]
+-t: Reader threads (default 4).
+-u: Users in the stand-in's snapshot (default 2000).
+-r: Storm steps per second, 0 for as fast as possible (default 0).
+-d: Storm duration in seconds (default 5).
+"""
+
+import argparse
+import threading, time
+
+from conf import conf
+from sound import backend
+from ttstandin import StandinServer
+from benchmarks.scale import makeServerClass
+
+
+def timeSnapshots(server):
+	"""Wrap server._makeSnapshot() so the time spent copying, with stateLock held, is recorded.
+	Returns the list the times (in seconds) are appended to.
+	"""
+	copies = []
+	makeSnapshot = server._makeSnapshot
+	def timedMakeSnapshot():
+		t0 = time.perf_counter()
+		snap = makeSnapshot()
+		copies.append(time.perf_counter() -t0)
+		return snap
+	server._makeSnapshot = timedMakeSnapshot
+	return copies
+
+
+def consistent(users, channels):
+	"""Return True if every user is filed under its own userid and is in a known channel or none.
+	"""
+	for userid,u in list(users.items()):
+		if u.get("userid") != userid: return False
+		chanid = u.get("channelid")
+		if chanid is not None and chanid not in channels: return False
+	return True
+
+
+def reader(server, live, stop, counts):
+	"""Walk users and channels as summaries and userMatch do, until stop is set.
+	Counts reads that raise and reads that find users and channels out of step.
+	"""
+	while not stop.is_set():
+		try:
+			if live: users,channels = server.users,server.channels
+			else:
+				snap = server.snapshot()
+				users,channels = snap.users,snap.channels
+			if not consistent(users, channels): counts["inconsistent"] += 1
+			counts["reads"] += 1
+		except RuntimeError:
+			counts["errors"] += 1
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="benchmarks.state_stress", description="Server state reads while events change it.")
+	parser.add_argument("-t", "--readers", type=int, default=4, help="Reader threads.")
+	parser.add_argument("-u", "--users", type=int, default=2000, help="Users in the snapshot.")
+	parser.add_argument("-r", "--rate", type=float, default=0, help="Storm steps per second, 0 for as fast as possible.")
+	parser.add_argument("-d", "--duration", type=float, default=5, help="Storm duration in seconds.")
+	parser.add_argument("--live", action="store_true", help="Read the live dicts instead of snapshots.")
+	opts = parser.parse_args(args)
+	conf.version = "bench"
+	backend.setBackend("null")
+	from connmgr import StartupLogin
+	standin = StandinServer(channels=50, users=opts.users).start()
+	ScaleServer = makeServerClass()
+	server = ScaleServer("127.0.0.1", standin.port, "stress", {"nickname": "Stress"})
+	if not StartupLogin([server], 1).start().wait(60):
+		print("Did not log in within 60 s.")
+		standin.stop()
+		return
+	copies = timeSnapshots(server)
+	stop = threading.Event()
+	counts = {"reads": 0, "errors": 0, "inconsistent": 0}
+	threads = [threading.Thread(target=reader, args=(server, opts.live, stop, counts), name="reader%d" % (i)) for i in range(opts.readers)]
+	base = server.events
+	t0 = time.perf_counter()
+	for th in threads: th.start()
+	storm = standin.storm("logins", opts.rate, opts.duration)
+	storm.join()
+	sent = time.perf_counter()
+	# Each step is two lines: userloggedin and adduser, or removeuser and loggedout.
+	expected = base +(storm.steps -storm.skipped) * 2
+	while server.events < expected and time.perf_counter() < sent +30:
+		time.sleep(0.05)
+	stop.set()
+	for th in threads: th.join()
+	elapsed = time.perf_counter() -t0
+	events = server.events -base
+	print("Reading %s: %d readers, %d reads (%.0f/s), %d errors, %d inconsistent" % (
+		"live dicts" if opts.live else "snapshots", opts.readers, counts["reads"], counts["reads"] / elapsed,
+		counts["errors"], counts["inconsistent"]
+	))
+	print("Events processed %d of %d expected, %.0f/s" % (events, expected -base, events / elapsed))
+	if copies:
+		copies.sort()
+		print("Snapshots made %d; lock held p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+			len(copies), copies[len(copies) // 2] * 1000, copies[int(len(copies) * 0.99)] * 1000, copies[-1] * 1000
+		))
+	# Let the event thread drain what is still queued, so disconnecting does not clear state under it.
+	deadline = time.perf_counter() +30
+	while time.perf_counter() -server.lastEvent < 0.5 and time.perf_counter() < deadline:
+		time.sleep(0.1)
+	server.terminate()
+	standin.stop()
+
+if __name__ == "__main__":
+	main()
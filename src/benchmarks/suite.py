@@ -0,0 +1,158 @@
+"""Timing suite for the event pipeline's hot paths, with baseline comparison.
+
+Each benchmark runs against synthetic fixtures at several scales:
+an offline server logged into a stand-in snapshot of N users in N/10 channels (at least 10).
+Times are per operation, the best of several timeit repeats.
+	parmline: Parse a loggedin line with ParmLine.
+	processLine: Dispatch an adduser/removeuser pair through processLine().
+	updateParms: Merge an updateuser parameter set into a user record.
+	nonEmptyNickname: Format a user's display name.
+	summarizeChannels: Summarize who is where on the whole server.
+	triggers: Apply a set of config-file triggers to an event.
+	format: Format a short and a long message for output.
+
+Usage (from the src directory):
+	python -m benchmarks.suite [-s scales] [-k filter] [-o results.json] [-b baseline.json] [-t threshold] [-q]
+-s: Comma-separated scales (default 100,1000,10000).
+-k: Run only benchmarks whose name contains this text.
+-o: Write results as JSON; use this to save a baseline.
+-b: Compare with a saved JSON baseline; exits with status 1 if any benchmark is slower by more than threshold.
+-t: Allowed slowdown as a fraction (default 0.2, i.e., 20%).
+-q: Quick run: fewer repeats, noisier numbers.
+Baselines are machine-specific; compare only with one saved on the same machine.
+"""
+
+import argparse
+import json, platform, sys, time, timeit
+
+from conf import conf
+
+
+def makeFixture(users):
+	"""Return an offline server logged into a stand-in snapshot with the given number of users.
+	"""
+	from ttstandin import StandinServer
+	from ttreplay import makeReplayServerClass
+	ReplayServer = makeReplayServerClass()
+	class SuiteServer(ReplayServer):
+		def output(self, line, raw=False, fromEvent=False): pass
+	standin = StandinServer(channels=max(10, users // 10), users=users)
+	server = SuiteServer("suite", 10333, "suite", {})
+	server.processLine('welcome userid=1 servername="Suite" usertimeout=60 protocol="5.6" version="5.8.0"')
+	server.processLine('accepted userid=1 nickname="Me" username="me" usertype=2 userrights=262143')
+	for line in standin.snapshot(): server.processLine(line)
+	server.processLine("ok")
+	return server
+
+
+def makeTriggers(server):
+	from triggers import Triggers
+	from parmline import ParmLine
+	triggers = Triggers(lambda line: None)
+	triggers.addMatch("joins", ParmLine("adduser chanid=3"), "room3")
+	triggers.addMatch("joins", ParmLine('adduser nickname="Nobody.*"'), "nobody")
+	triggers.addMatch("logins", ParmLine('loggedin username="admin.*"'))
+	triggers.addMatch("text", ParmLine('line match=".*password.*"'))
+	triggers.addAction("joins", "say joined")
+	triggers.server = server
+	return triggers
+
+
+def benchmarks(server):
+	"""Return (name, callable) pairs to time against server.
+	"""
+	from parmline import ParmLine
+	from mplib import mycmd
+	userid = sorted(server.users)[len(server.users) // 2]
+	user = server.users[userid]
+	chanid = user.get("chanid") or "2"
+	loggedin = 'loggedin userid=%s nickname="User %s" username="user%s" usertype=1 ipaddr="10.0.0.1" version="5.8.0"' % (userid, userid, userid)
+	add = "adduser userid=%s chanid=%s" % (userid, chanid)
+	remove = "removeuser userid=%s chanid=%s" % (userid, chanid)
+	update = ParmLine('updateuser userid=%s nickname="User %s" statusmode=0 statusmsg="Busy" chanid=%s' % (userid, userid, chanid)).parms
+	triggers = makeTriggers(server)
+	event = ParmLine(add)
+	short = "[suite] User 1234 joined /Room 3/"
+	long = "[suite] User message from User 1234:\n" +"A long message that needs wrapping. " * 6
+	def processLine():
+		server.processLine(remove)
+		server.processLine(add)
+	def fmt():
+		mycmd.format(short)
+		mycmd.format(long)
+	return [
+		("parmline", lambda: ParmLine(loggedin)),
+		("processLine", processLine),
+		("updateParms", lambda: server.updateParms("Update user", user, update, silent=True)),
+		("nonEmptyNickname", lambda: server.nonEmptyNickname(userid, shortenFacebook=True)),
+		("summarizeChannels", server.summarizeChannels),
+		("triggers", lambda: triggers.apply(event)),
+		("format", fmt),
+	]
+
+
+def timeOne(func, repeat, minTime):
+	"""Return the best seconds per call of func.
+	"""
+	timer = timeit.Timer(func)
+	number = 1
+	while True:
+		if timer.timeit(number) >= minTime: break
+		number *= 4
+	return min(timer.repeat(repeat, number)) / number
+
+
+def compare(results, baseline, threshold):
+	"""Return (name, baseline, current, ratio) rows and whether any is a regression.
+	"""
+	rows = []
+	regressed = False
+	for name,secs in sorted(results.items()):
+		old = baseline.get(name)
+		if not old: continue
+		ratio = secs / old
+		if ratio > 1.0 +threshold: regressed = True
+		rows.append((name, old, secs, ratio))
+	return rows, regressed
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="benchmarks.suite", description="Timing suite for the event pipeline's hot paths.")
+	parser.add_argument("-s", "--scales", default="100,1000,10000", help="Comma-separated user counts.")
+	parser.add_argument("-k", "--filter", default="", help="Run only benchmarks whose name contains this.")
+	parser.add_argument("-o", "--output", default="", help="Write results to this JSON file.")
+	parser.add_argument("-b", "--baseline", default="", help="Compare with this JSON baseline.")
+	parser.add_argument("-t", "--threshold", type=float, default=0.2, help="Allowed slowdown fraction.")
+	parser.add_argument("-q", "--quick", action="store_true", help="Fewer repeats.")
+	opts = parser.parse_args(args)
+	conf.version = "suite"
+	from sound import backend
+	backend.setBackend("null")
+	repeat,minTime = (3, 0.02) if opts.quick else (7, 0.1)
+	results = {}
+	for scale in [int(s) for s in opts.scales.split(",") if s.strip()]:
+		server = makeFixture(scale)
+		for name,func in benchmarks(server):
+			if opts.filter and opts.filter not in name: continue
+			key = "%s@%d" % (name, scale)
+			results[key] = timeOne(func, repeat, minTime)
+			print("%-28s %12.2f us" % (key, results[key] * 1e6))
+			sys.stdout.flush()
+	if opts.output:
+		with open(opts.output, "w") as f:
+			json.dump({
+				"meta": {"python": sys.version.split()[0], "platform": platform.platform(), "time": time.ctime()},
+				"results": results
+			}, f, indent=1, sort_keys=True)
+	if not opts.baseline: return 0
+	with open(opts.baseline) as f:
+		baseline = json.load(f)["results"]
+	rows,regressed = compare(results, baseline, opts.threshold)
+	print("\nCompared with %s (threshold +%d%%):" % (opts.baseline, opts.threshold * 100))
+	for name,old,new,ratio in rows:
+		flag = "  REGRESSION" if ratio > 1.0 +opts.threshold else ""
+		print("%-28s %10.2f -> %10.2f us  %+6.1f%%%s" % (name, old * 1e6, new * 1e6, (ratio -1.0) * 100, flag))
+	return 1 if regressed else 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,417 @@
+"""Connection management helpers: retry backoff, parallel startup login, reconnect scheduling, and link health.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import heapq, random, time
+import threading
+from collections import deque
+from mplib.TableFormatter import TableFormatter
+
+
+class Backoff(object):
+	"""Exponential backoff with jitter.
+	Delays start at base seconds and grow by factor per attempt up to cap.
+	Each delay is reduced by a random amount of up to jitter times itself,
+	so servers that failed together do not retry together.
+	"""
+	def __init__(self, base=2.0, cap=60.0, factor=2.0, jitter=0.5):
+		self.base = base
+		self.cap = cap
+		self.factor = factor
+		self.jitter = jitter
+		self.attempts = 0
+
+	def next(self):
+		"""Return the delay before the next attempt and count the attempt.
+		"""
+		delay = min(self.cap, self.base * self.factor ** self.attempts)
+		self.attempts += 1
+		return delay * (1.0 -self.jitter * random.random())
+
+	def reset(self):
+		self.attempts = 0
+
+
+class PingTracker(object):
+	"""Matches keepalive pings to their pongs and keeps round trip statistics for one connection.
+	Pongs arrive in ping order, so the oldest unanswered ping is the one answered.
+	The ping thread calls sent() and the watcher thread calls answered(); each counter has one writer.
+	ewma is an exponentially weighted moving average with weight alpha for the newest round trip.
+	health() flags a link as failing when missLimit or more pings have gone unanswered for a full ping interval,
+	or when the latest round trip is more than slowFactor times the minimum and over slowFloor seconds.
+	"""
+	def __init__(self, alpha=0.2, missLimit=2, slowFactor=5.0, slowFloor=1.0):
+		self.alpha = alpha
+		self.missLimit = missLimit
+		self.slowFactor = slowFactor
+		self.slowFloor = slowFloor
+		# perf_counter() times of unanswered pings, oldest first.
+		self.pending = deque(maxlen=64)
+		self.pings = 0
+		self.pongs = 0
+		self.last = None
+		self.ewma = None
+		self.min = None
+		self.max = None
+
+	def sent(self):
+		self.pending.append(time.perf_counter())
+		self.pings += 1
+
+	def answered(self):
+		"""Record a pong and return its round trip in seconds, or None if no ping was waiting.
+		"""
+		try: t0 = self.pending.popleft()
+		except IndexError: return None
+		rtt = time.perf_counter() -t0
+		self.pongs += 1
+		self.last = rtt
+		if self.ewma is None:
+			self.ewma = self.min = self.max = rtt
+		else:
+			self.ewma += self.alpha * (rtt -self.ewma)
+			self.min = min(self.min, rtt)
+			self.max = max(self.max, rtt)
+		return rtt
+
+	def missed(self, interval):
+		"""Return how many pings have waited longer than interval seconds for a pong.
+		"""
+		cutoff = time.perf_counter() -interval
+		return len([t for t in list(self.pending) if t < cutoff])
+
+	def health(self, interval):
+		"""Return "" for a healthy link or a short description of why it looks to be failing.
+		interval is the time between pings.
+		"""
+		missed = self.missed(interval)
+		if missed >= self.missLimit:
+			return "%d pings unanswered" % (missed)
+		if self.last is not None and self.last > self.slowFloor and self.last > self.slowFactor * self.min:
+			return "ping %.0f ms, %.0f times its minimum" % (self.last * 1000, self.last / self.min)
+		return ""
+
+	def summary(self):
+		"""Return a short description like "ping 42 ms (min 30, max 120)", or "" before the first pong.
+		"""
+		if self.ewma is None: return ""
+		return "ping %.0f ms (min %.0f, max %.0f)" % (self.ewma * 1000, self.min * 1000, self.max * 1000)
+
+
+class LoginResult(object):
+	"""Timings for one server's startup login.
+	"""
+	def __init__(self, server):
+		self.server = server
+		self.attempts = 0
+		self.started = None
+		self.connected = None
+		self.finished = None
+
+	@property
+	def connectSecs(self):
+		if self.connected is None: return None
+		return self.connected -self.started
+
+	@property
+	def loginSecs(self):
+		if self.finished is None or self.connected is None: return None
+		return self.finished -self.connected
+
+
+class StartupLogin(object):
+	"""Log a set of servers in, at most limit of them connecting or logging in at once.
+	Connection failures are retried with Backoff, without holding a slot while waiting.
+	onServerDone(result) is called as each server finishes,
+	and onDone(self) once all have; wait() blocks until then or a timeout.
+	Servers still retrying after a timeout keep trying in the background.
+	"""
+	def __init__(self, servers, limit=8, onServerDone=None, onDone=None):
+		self.results = [LoginResult(server) for server in servers]
+		self.limit = max(1, limit)
+		self.onServerDone = onServerDone
+		self.onDone = onDone
+		self.slots = threading.BoundedSemaphore(self.limit)
+		self.done = threading.Event()
+		self._remaining = len(self.results)
+		self._lock = threading.Lock()
+		self.started = None
+		self.cancelled = False
+
+	def start(self):
+		"""Start logging in all servers and return at once.
+		"""
+		self.started = time.perf_counter()
+		if not self.results:
+			self._finishAll()
+			return self
+		for result in self.results:
+			th = threading.Thread(target=self._loginOne, args=(result,))
+			th.name = "startupLogin_" +result.server.shortname
+			th.daemon = True
+			th.start()
+		return self
+
+	def wait(self, timeout=None):
+		"""Wait for all servers to finish. Returns True if they did.
+		"""
+		return self.done.wait(timeout)
+
+	def cancel(self):
+		"""Stop retrying servers that have not connected yet.
+		"""
+		self.cancelled = True
+
+	def _loginOne(self, result):
+		server = result.server
+		backoff = Backoff()
+		try:
+			while not self.cancelled:
+				self.slots.acquire()
+				try:
+					if result.started is None: result.started = time.perf_counter()
+					result.attempts += 1
+					connected = server.connect()
+					if connected:
+						result.connected = time.perf_counter()
+						server.login()
+						result.finished = time.perf_counter()
+						break
+				except Exception:
+					# Such as a lost connection during login; retry from a new connection.
+					result.connected = None
+					try: server.disconnect()
+					except Exception: pass
+				finally:
+					self.slots.release()
+				time.sleep(backoff.next())
+		finally:
+			try:
+				if self.onServerDone: self.onServerDone(result)
+			finally:
+				with self._lock:
+					self._remaining -= 1
+					last = (self._remaining == 0)
+				if last: self._finishAll()
+
+	def _finishAll(self):
+		self.done.set()
+		if self.onDone: self.onDone(self)
+
+	def unfinished(self):
+		"""Return the servers not logged in.
+		"""
+		return [r.server for r in self.results if r.server.state != "loggedIn"]
+
+	def report(self):
+		"""Return a table of per-server connect and login durations.
+		"""
+		fmt = lambda secs: "" if secs is None else "{0:.2f}".format(secs)
+		tbl = TableFormatter("Startup Login ({0} at a time)".format(self.limit), [
+			"Server", "State", "Tries", "Connect s", "Login s"
+		])
+		for r in sorted(self.results, key=lambda r: r.server.shortname):
+			tbl.addRow([
+				r.server.shortname, r.server.state, str(r.attempts),
+				fmt(r.connectSecs), fmt(r.loginSecs)
+			])
+		return tbl.format(2)
+
+
+class ReconnectEntry(object):
+	"""Reconnect state for one server.
+	"""
+	def __init__(self, server, backoff):
+		self.server = server
+		self.backoff = backoff
+		# Monotonic time of the next attempt, or None when none is scheduled.
+		self.due = None
+		self.force = False
+		self.connecting = False
+		self.failures = 0
+		self.attempts = 0
+		# Monotonic time until which the circuit is open (no automatic attempts before then).
+		self.openUntil = 0.0
+		self.lastResult = ""
+
+
+class ReconnectScheduler(object):
+	"""Schedules reconnects for servers that drop, from one thread.
+	Each server backs off exponentially with jitter between failed attempts,
+	and no more than maxConcurrent attempts run at once.
+	After breakerThreshold consecutive failures a server's circuit opens:
+	it is left alone for breakerCooldown seconds, then tried once;
+	success closes the circuit, failure opens it again.
+	"""
+	def __init__(self, maxConcurrent=4, base=5.0, cap=300.0, breakerThreshold=8, breakerCooldown=900.0):
+		self.maxConcurrent = maxConcurrent
+		self.base = base
+		self.cap = cap
+		self.breakerThreshold = breakerThreshold
+		self.breakerCooldown = breakerCooldown
+		self.entries = {}
+		# (due, seq, entry); entries whose due no longer matches are stale and skipped.
+		self.heap = []
+		self._seq = 0
+		self.active = 0
+		self.cond = threading.Condition()
+		self.thread = None
+
+	def entry(self, server):
+		"""Return the entry for server, making one if needed. Call with self.cond held.
+		"""
+		e = self.entries.get(server.shortname)
+		if e is None or e.server is not server:
+			e = ReconnectEntry(server, Backoff(self.base, self.cap))
+			self.entries[server.shortname] = e
+		return e
+
+	def schedule(self, server, force=False, delay=None):
+		"""Schedule a reconnect for server after its backoff delay or the given delay.
+		An attempt already scheduled sooner is left alone.
+		If force is False, the attempt is skipped if autoLogin is off or the user stopped it by then.
+		"""
+		with self.cond:
+			e = self.entry(server)
+			if delay is None: delay = e.backoff.next()
+			due = max(time.monotonic() +delay, e.openUntil)
+			e.force = e.force or force
+			if e.connecting or (e.due is not None and e.due <= due): return
+			self._push(e, due)
+			if not self.thread:
+				self.thread = threading.Thread(target=self.run, name="reconnects")
+				self.thread.daemon = True
+				self.thread.start()
+			self.cond.notify()
+
+	def cancel(self, server):
+		"""Drop any scheduled reconnect for server.
+		"""
+		with self.cond:
+			e = self.entries.pop(server.shortname, None)
+			if e: e.due = None
+
+	def setMaxConcurrent(self, n):
+		"""Change how many attempts may run at once, waking the scheduler so a higher limit takes effect now.
+		"""
+		with self.cond:
+			self.maxConcurrent = max(1, n)
+			self.cond.notify_all()
+
+	def scheduled(self):
+		"""Return how many servers have a reconnect attempt scheduled.
+		"""
+		with self.cond:
+			return len([e for e in self.entries.values() if e.due is not None])
+
+	def _push(self, e, due):
+		e.due = due
+		self._seq += 1
+		heapq.heappush(self.heap, (due, self._seq, e))
+
+	def _popDue(self):
+		"""Wait for and return the next due entry with a free attempt slot.
+		Call with self.cond held.
+		"""
+		while True:
+			while self.heap and self.heap[0][2].due != self.heap[0][0]:
+				heapq.heappop(self.heap)
+			if not self.heap:
+				self.cond.wait()
+				continue
+			wait = self.heap[0][0] -time.monotonic()
+			if wait > 0:
+				self.cond.wait(wait)
+				continue
+			if self.active >= self.maxConcurrent:
+				self.cond.wait()
+				continue
+			due,seq,e = heapq.heappop(self.heap)
+			e.due = None
+			return e
+
+	def run(self):
+		"""Start due attempts. Runs in its own thread.
+		"""
+		while True:
+			with self.cond:
+				e = self._popDue()
+				server = e.server
+				if not e.force and (not server.autoLogin or server.manualCM):
+					e.lastResult = "stopped"
+					continue
+				e.connecting = True
+				self.active += 1
+			th = threading.Thread(target=self._attempt, args=(e,))
+			th.name = "reconnect_" +server.shortname
+			th.daemon = True
+			th.start()
+
+	def _attempt(self, e):
+		server = e.server
+		ok = False
+		e.lastResult = ""
+		try:
+			e.attempts += 1
+			server.reconnectAttempts += 1
+			if server.state == "loggedIn" or server.connect():
+				if server.state != "loggedIn": server.login()
+				ok = (server.state == "loggedIn")
+		except Exception as ex:
+			e.lastResult = str(ex)
+		with self.cond:
+			e.connecting = False
+			self.active -= 1
+			if ok:
+				e.failures = 0
+				e.force = False
+				e.openUntil = 0.0
+				e.backoff.reset()
+				e.lastResult = "ok"
+			else:
+				e.failures += 1
+				server.reconnectFailures += 1
+				if not e.lastResult or e.lastResult == "ok": e.lastResult = server.state
+				if e.failures >= self.breakerThreshold:
+					e.openUntil = time.monotonic() +self.breakerCooldown
+					e.lastResult = "circuit open"
+				self._push(e, max(time.monotonic() +e.backoff.next(), e.openUntil))
+			self.cond.notify()
+
+	def report(self):
+		"""Return a table of reconnect state by server.
+		"""
+		now = time.monotonic()
+		with self.cond:
+			entries = sorted(self.entries.values(), key=lambda e: e.server.shortname)
+			tbl = TableFormatter("Reconnects ({0} of {1} attempts running)".format(self.active, self.maxConcurrent), [
+				"Server", "Status", "Failures", "Tries", "Next in s", "Last result"
+			])
+			for e in entries:
+				if e.connecting: status = "connecting"
+				elif e.openUntil > now: status = "circuit open"
+				elif e.due is not None: status = "waiting"
+				else: status = "idle"
+				tbl.addRow([
+					e.server.shortname, status, str(e.failures), str(e.attempts),
+					"" if e.due is None else "{0:.1f}".format(max(0.0, e.due -now)),
+					e.lastResult
+				])
+		return tbl.format(2)
+
+reconnects = ReconnectScheduler()
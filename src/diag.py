@@ -0,0 +1,210 @@
+"""Runtime diagnostics: threads, queues, and memory by server.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys, time
+import threading
+from mplib.TableFormatter import TableFormatter
+
+
+def deepSize(obj, seen=None):
+	"""Return the approximate bytes held by obj and everything it contains,
+	counting each object once. Follows dicts (including AttrDicts), lists, tuples, and sets;
+	other objects count only their own size.
+	"""
+	if seen is None: seen = set()
+	total = 0
+	stack = [obj]
+	while stack:
+		o = stack.pop()
+		if id(o) in seen: continue
+		seen.add(id(o))
+		total += sys.getsizeof(o)
+		if isinstance(o, dict):
+			for k,v in list(o.items()):
+				stack.append(k)
+				stack.append(v)
+		elif isinstance(o, (list, tuple, set, frozenset)):
+			stack.extend(list(o))
+		elif hasattr(o, "__dict__") and o.__class__.__module__ == "parmline":
+			# Parmlines held in output collections.
+			stack.append(o.__dict__)
+	return total
+
+
+def threadServer(name):
+	"""Return the shortname part of a server connection thread name, or "".
+	Connection threads are named shortname_target_threadname; see TeamTalkServerConnection.newThread().
+	"""
+	parts = name.rsplit("_", 2)
+	if len(parts) < 3: return ""
+	return parts[0]
+
+
+class ServerDiag(object):
+	"""Diagnostic figures for one server, gathered at construction.
+	"""
+	def __init__(self, server, threadsByServer):
+		self.server = server
+		self.shortname = server.shortname
+		self.state = server.state
+		conn = server.conn
+		current = set()
+		self.threadNames = []
+		self.inboundBytes = 0
+		self.outboundLines = 0
+		self.outboundBytes = 0
+		self.ping = None
+		self.pingSummary = ""
+		self.linkWarning = ""
+		if conn:
+			self.ping = conn.pings.ewma
+			self.pingSummary = conn.pings.summary()
+			self.linkWarning = conn.linkWarning
+			for th in list(conn.threads.values()):
+				if th.is_alive():
+					current.add(th.name)
+					self.threadNames.append(th.name)
+			reader = conn.sockfile
+			if reader is not None and hasattr(reader, "end"):
+				self.inboundBytes = reader.end -reader.start
+			writer = conn.outbound
+			if writer is not None:
+				self.outboundLines = len(writer.q)
+				self.outboundBytes = writer.queued
+		# Live threads named for this server that its current connection does not own,
+		# e.g., left over from earlier connections.
+		self.staleThreadNames = [n for n in threadsByServer.get(self.shortname, []) if n not in current]
+		self.users = len(server.users)
+		self.channels = len(server.channels)
+		self.files = len(server.files)
+		self.collected = len(server._outputCollection)
+		triggers = getattr(server, "triggers", None)
+		self.triggerQueue = len(triggers._q) if triggers else 0
+		self.memory = deepSize([server.users, server.channels, server.files, server._outputCollection])
+		last = getattr(server, "lastEventNs", None)
+		self.idleSecs = (time.perf_counter_ns() -last) / 1e9 if last else None
+
+
+class Diagnostics(object):
+	"""Gathers diagnostics for a set of servers and the process-wide queues.
+	"""
+	sortKeys = {
+		"name": lambda d: d.shortname.lower(),
+		"memory": lambda d: -d.memory,
+		"threads": lambda d: -(len(d.threadNames) +len(d.staleThreadNames)),
+		"users": lambda d: -d.users,
+		"idle": lambda d: -(d.idleSecs if d.idleSecs is not None else float("inf")),
+		"queues": lambda d: -(d.inboundBytes +d.outboundBytes +d.collected +d.triggerQueue),
+		"ping": lambda d: (not d.linkWarning, -(d.ping or 0.0)),
+	}
+
+	def __init__(self, servers):
+		threads = threading.enumerate()
+		self.threadCount = len(threads)
+		threadsByServer = {}
+		names = set(s.shortname for s in servers)
+		self.otherThreads = []
+		for th in threads:
+			shortname = threadServer(th.name)
+			if shortname in names: threadsByServer.setdefault(shortname, []).append(th.name)
+			else: self.otherThreads.append(th.name)
+		self.servers = [ServerDiag(s, threadsByServer) for s in servers]
+
+	def globalReport(self):
+		"""Return lines describing process-wide queues and memory.
+		"""
+		from mplib.mycmd import mq
+		from mplib.speech import speaker
+		from connmgr import reconnects
+		buf = []
+		buf.append("Threads: %d total, %d not tied to a listed server: %s" % (
+			self.threadCount, len(self.otherThreads), ", ".join(sorted(self.otherThreads))
+		))
+		buf.append("Message queue: %d pending, %d coalescing groups held" % (len(mq), len(mq._buckets)))
+		buf.append("Speech queue: %d pending" % (speaker.pending()))
+		buf.append("Trigger queues: %d pending" % (sum(d.triggerQueue for d in self.servers)))
+		buf.append("Reconnects: %d scheduled, %d running" % (reconnects.scheduled(), reconnects.active))
+		buf.append("Outbound queues: %d lines, %d bytes; inbound buffers %d bytes" % (
+			sum(d.outboundLines for d in self.servers),
+			sum(d.outboundBytes for d in self.servers),
+			sum(d.inboundBytes for d in self.servers)
+		))
+		memory = "Server data: %.1f MB" % (sum(d.memory for d in self.servers) / 1e6)
+		try:
+			import tracemalloc
+			if tracemalloc.is_tracing():
+				current,peak = tracemalloc.get_traced_memory()
+				memory += "; traced Python memory %.1f MB, peak %.1f MB" % (current / 1e6, peak / 1e6)
+		except ImportError:
+			pass
+		try:
+			import resource
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			# Linux reports kilobytes, MacOS bytes.
+			if sys.platform != "darwin": rss *= 1024
+			memory += "; peak process memory %.1f MB" % (rss / 1e6)
+		except ImportError:
+			pass
+		buf.append(memory)
+		return "\n".join(buf)
+
+	def serverTable(self, sortBy="name", limit=0):
+		"""Return a table with one row per server, sorted by one of sortKeys.
+		"""
+		diags = sorted(self.servers, key=self.sortKeys[sortBy])
+		if limit: diags = diags[:limit]
+		tbl = TableFormatter("Server Diagnostics", [
+			"Server", "State", "Threads", "Stale", "In B", "Out lines", "Out B",
+			"Users", "Chans", "Files", "Collect", "Trig q", "Mem KB", "Idle s", "Ping ms", "Link"
+		])
+		for d in diags:
+			tbl.addRow([
+				d.shortname, d.state, str(len(d.threadNames)), str(len(d.staleThreadNames)),
+				str(d.inboundBytes), str(d.outboundLines), str(d.outboundBytes),
+				str(d.users), str(d.channels), str(d.files), str(d.collected), str(d.triggerQueue),
+				"{0:.0f}".format(d.memory / 1024.0),
+				"" if d.idleSecs is None else "{0:.1f}".format(d.idleSecs),
+				"" if d.ping is None else "{0:.0f}".format(d.ping * 1000),
+				d.linkWarning or "ok"
+			])
+		return tbl.format(2)
+
+	def serverDetail(self, d):
+		"""Return a multi-line description of one server's diagnostics.
+		"""
+		buf = ["%s (%s):" % (d.shortname, d.state)]
+		buf.append("  Threads: %s" % (", ".join(d.threadNames) or "none"))
+		if d.staleThreadNames:
+			buf.append("  Stale threads: %s" % (", ".join(d.staleThreadNames)))
+		buf.append("  Inbound buffered: %d bytes" % (d.inboundBytes))
+		buf.append("  Outbound queued: %d lines, %d bytes" % (d.outboundLines, d.outboundBytes))
+		if d.server.conn:
+			pings = d.server.conn.pings
+			buf.append("  Pings: %d sent, %d answered; %s" % (pings.pings, pings.pongs, d.pingSummary or "no round trips yet"))
+		if d.linkWarning:
+			buf.append("  Link may be failing: %s" % (d.linkWarning))
+		if d.server.conn and d.server.conn.outbound:
+			buf.append("  Outbound: %s" % (d.server.conn.outbound.status()))
+		buf.append("  Users %d, channels %d, files %d, collected lines %d, trigger queue %d" % (
+			d.users, d.channels, d.files, d.collected, d.triggerQueue
+		))
+		buf.append("  Approximate memory for these: %.1f KB" % (d.memory / 1024.0))
+		if d.idleSecs is None: buf.append("  No events yet")
+		else: buf.append("  Last event %.1f seconds ago" % (d.idleSecs))
+		return "\n".join(buf)
@@ -0,0 +1,226 @@
+"""Line framing for TeamTalk protocol sockets.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import select, threading, time
+from collections import deque
+
+class LineReader(object):
+	"""Reads lines from a socket in large chunks into one reusable buffer.
+	Lines end with \\r\\n (a bare \\n is also accepted) and are returned as bytes without the line ending.
+	The buffer grows only when a single line is longer than it.
+	Socket errors and timeouts propagate to the caller.
+	"""
+	def __init__(self, sock, bufsize=65536):
+		self.sock = sock
+		self.buf = bytearray(bufsize)
+		# Unconsumed data is buf[start:end].
+		self.start = 0
+		self.end = 0
+		self.eof = False
+		self.bytesRead = 0
+		self.reads = 0
+
+	def _fill(self):
+		"""Read more data into the buffer, compacting or growing it as needed.
+		Returns False at end of stream.
+		"""
+		buf = self.buf
+		if self.start:
+			n = self.end -self.start
+			buf[:n] = buf[self.start:self.end]
+			self.start,self.end = 0,n
+		if self.end == len(buf):
+			buf.extend(bytes(len(buf)))
+		with memoryview(buf) as view:
+			n = self.sock.recv_into(view[self.end:])
+		self.reads += 1
+		if not n:
+			self.eof = True
+			return False
+		self.end += n
+		self.bytesRead += n
+		return True
+
+	def readline(self):
+		"""Return the next line as bytes, or None at end of stream.
+		A final unterminated line is returned before None.
+		"""
+		# Bytes from start already searched for a line ending.
+		searched = 0
+		while True:
+			buf = self.buf
+			i = buf.find(b"\n", self.start +searched, self.end)
+			if i >= 0:
+				j = i -1 if i > self.start and buf[i-1] == 13 else i
+				line = bytes(buf[self.start:j])
+				self.start = i +1
+				return line
+			searched = self.end -self.start
+			if self.eof or not self._fill():
+				if self.start == self.end: return None
+				line = bytes(buf[self.start:self.end])
+				self.start = self.end
+				return line
+
+	def waitLine(self, timeout):
+		"""Wait up to timeout seconds until readline() can return without blocking.
+		Returns False on timeout. The socket's blocking mode is left alone,
+		so a sender thread may keep using the same socket.
+		"""
+		deadline = time.monotonic() +timeout
+		while not self.eof and self.buf.find(b"\n", self.start, self.end) < 0:
+			left = deadline -time.monotonic()
+			if left <= 0: return False
+			ready,w,x = select.select([self.sock], [], [], left)
+			if ready: self._fill()
+		return True
+
+	def readlines(self):
+		"""Return all complete lines now buffered, reading first if there are none.
+		Returns an empty list at end of stream.
+		Splitting a whole chunk at once is much cheaper than finding one line at a time.
+		"""
+		while True:
+			buf = self.buf
+			i = buf.rfind(b"\n", self.start, self.end)
+			if i >= 0:
+				chunk = bytes(buf[self.start:i])
+				self.start = i +1
+				if b"\r" in chunk: chunk = chunk.replace(b"\r\n", b"\n")
+				lines = chunk.split(b"\n")
+				if lines[-1][-1:] == b"\r": lines[-1] = lines[-1][:-1]
+				return lines
+			if self.eof or not self._fill():
+				if self.start == self.end: return []
+				line = bytes(buf[self.start:self.end])
+				self.start = self.end
+				return [line]
+
+	def __iter__(self):
+		while True:
+			lines = self.readlines()
+			if not lines: return
+			yield from lines
+
+
+class LineWriter(object):
+	"""Queues encoded lines for one socket and sends them from one thread,
+	joining whatever is queued (up to maxFlush bytes) into each sendall() call.
+	When more than maxQueued bytes are waiting, because the kernel send buffer is full
+	and sendall() is blocked, writers wait: that is the backpressure.
+	Call run() from the thread that should do the sending.
+	After a send error, onError(message) is called once and further writes return False.
+	"""
+	def __init__(self, sock, maxQueued=1048576, maxFlush=65536, onError=None):
+		self.sock = sock
+		self.maxQueued = maxQueued
+		self.maxFlush = maxFlush
+		self.onError = onError
+		self.q = deque()
+		self.queued = 0
+		self.cond = threading.Condition()
+		self.closed = False
+		self.sending = False
+		self.flushes = 0
+		self.linesSent = 0
+		self.bytesSent = 0
+		self.maxLinesPerFlush = 0
+		self.waits = 0
+		self.waitSecs = 0.0
+
+	def write(self, bline):
+		"""Queue one encoded line, with its line ending. Returns False if the writer is closed.
+		"""
+		return self.writeLines([bline])
+
+	def writeLines(self, blines):
+		"""Queue encoded lines in order, waiting as needed for room.
+		Returns False if the writer is or becomes closed.
+		"""
+		with self.cond:
+			for bline in blines:
+				if self.queued and self.queued +len(bline) > self.maxQueued:
+					self.waits += 1
+					t0 = time.perf_counter()
+					while not self.closed and self.queued and self.queued +len(bline) > self.maxQueued:
+						self.cond.wait()
+					self.waitSecs += time.perf_counter() -t0
+				if self.closed: return False
+				self.q.append(bline)
+				self.queued += len(bline)
+				self.cond.notify_all()
+		return True
+
+	def drain(self, timeout=None):
+		"""Wait until everything queued has been sent. Returns False on timeout or close.
+		"""
+		with self.cond:
+			self.cond.wait_for(lambda: self.closed or not (self.q or self.sending), timeout)
+			return not (self.q or self.sending)
+
+	def close(self):
+		"""Stop sending; unsent lines are dropped and waiting writers released.
+		"""
+		with self.cond:
+			self.closed = True
+			self.q.clear()
+			self.queued = 0
+			self.cond.notify_all()
+
+	def run(self):
+		"""Send queued lines until closed.
+		"""
+		q = self.q
+		while True:
+			with self.cond:
+				while not q and not self.closed:
+					self.cond.wait()
+				if self.closed: return
+				batch = [q.popleft()]
+				size = len(batch[0])
+				while q and size +len(q[0]) <= self.maxFlush:
+					bline = q.popleft()
+					batch.append(bline)
+					size += len(bline)
+				self.sending = True
+			try:
+				self.sock.sendall(b"".join(batch))
+			except (OSError, ValueError) as e:
+				self.close()
+				if self.onError: self.onError("Error during send: %s" % (str(e)))
+				return
+			with self.cond:
+				self.sending = False
+				if self.closed: return
+				self.queued -= size
+				self.flushes += 1
+				self.linesSent += len(batch)
+				self.bytesSent += size
+				self.maxLinesPerFlush = max(self.maxLinesPerFlush, len(batch))
+				self.cond.notify_all()
+
+	def status(self):
+		"""Return a one-line summary of what has been sent and how.
+		"""
+		flushes = self.flushes or 1
+		return "Sent {0} lines, {1} bytes in {2} writes ({3:.1f} lines, {4:.0f} bytes per write, max {5} lines); queued {6} bytes; waited for room {7} times, {8:.2f} s".format(
+			self.linesSent, self.bytesSent, self.flushes,
+			self.linesSent / flushes, self.bytesSent / flushes, self.maxLinesPerFlush,
+			self.queued, self.waits, self.waitSecs
+		)
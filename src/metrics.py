@@ -0,0 +1,189 @@
+"""Local HTTP exporter of TTCom metrics in Prometheus text format.
+
+Serves GET /metrics from a stdlib HTTP server, on the loopback interface unless told otherwise.
+Everything exported is read from counters that their own threads already keep
+(per-server timing histograms, reconnect counts, ping round trips, trigger statistics),
+so event processing takes no lock and does no extra work for the exporter;
+a scrape reads those values without stopping the writers and may see them mid-update by one event.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def escape(value):
+	"""Escape a label value for the text exposition format.
+	"""
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricSet(object):
+	"""Collects samples for one scrape and renders them in the text exposition format.
+	"""
+	def __init__(self):
+		# Metric name -> [type, help, [(labels, value), ...]], in insertion order.
+		self.metrics = {}
+
+	def add(self, name, mtype, helpText, value, **labels):
+		m = self.metrics.get(name)
+		if m is None:
+			m = self.metrics[name] = [mtype, helpText, []]
+		m[2].append((labels, value))
+
+	def addSummary(self, name, helpText, hist, **labels):
+		"""Add a histogram of nanoseconds as a summary in seconds.
+		"""
+		for q in (0.5, 0.9, 0.99):
+			self.add(name, "summary", helpText, hist.percentile(q * 100) / 1e9, quantile=q, **labels)
+		self.add(name +"_sum", "", "", hist.total / 1e9, **labels)
+		self.add(name +"_count", "", "", hist.count, **labels)
+
+	def render(self):
+		buf = []
+		for name,(mtype,helpText,samples) in self.metrics.items():
+			if mtype:
+				buf.append("# HELP %s %s" % (name, helpText))
+				buf.append("# TYPE %s %s" % (name, mtype))
+			for labels,value in samples:
+				if labels:
+					labels = "{%s}" % (",".join('%s="%s"' % (k, escape(v)) for k,v in sorted(labels.items())))
+				else: labels = ""
+				buf.append("%s%s %s" % (name, labels, repr(float(value)) if isinstance(value, float) else value))
+		return "\n".join(buf) +"\n"
+
+
+def collect(servers):
+	"""Return a MetricSet describing the given TeamtalkServer objects and the process-wide queues.
+	"""
+	from ttapi import ServerState
+	from mplib.mycmd import mq
+	from mplib.speech import speaker
+	from connmgr import reconnects
+	ms = MetricSet()
+	# Samples are grouped by metric name, so one pass over the servers suffices.
+	for server in servers:
+		shortname = server.shortname
+		state = server.state
+		for s in ServerState.states:
+			ms.add("ttcom_server_state", "gauge", "1 for the connection state each server is in.", int(s == state), server=shortname, state=s)
+		ms.add("ttcom_server_users", "gauge", "Users on each server, including this client.", len(server.users), server=shortname)
+		for event,phases in list(server.perf.events.items()):
+			h = phases.get("total")
+			if not h: continue
+			ms.add("ttcom_events_total", "counter", "Events processed by type.", h.count, server=shortname, event=event)
+			ms.add("ttcom_event_processing_seconds_total", "counter", "Time spent processing events by type.", h.total / 1e9, server=shortname, event=event)
+		ms.add("ttcom_reconnect_attempts_total", "counter", "Automatic reconnect attempts.", server.reconnectAttempts, server=shortname)
+		ms.add("ttcom_reconnect_failures_total", "counter", "Automatic reconnect attempts that did not end logged in.", server.reconnectFailures, server=shortname)
+		conn = server.conn
+		if conn:
+			pings = conn.pings
+			if pings.last is not None:
+				ms.add("ttcom_ping_rtt_seconds", "gauge", "Latest keepalive ping round trip time.", pings.last, server=shortname)
+				ms.add("ttcom_ping_rtt_average_seconds", "gauge", "Moving average of keepalive ping round trip times.", pings.ewma, server=shortname)
+			ms.add("ttcom_pings_total", "counter", "Keepalive pings sent on the current connection.", pings.pings, server=shortname)
+			ms.add("ttcom_pongs_total", "counter", "Keepalive pongs received on the current connection.", pings.pongs, server=shortname)
+			ms.add("ttcom_link_failing", "gauge", "1 when ping statistics suggest the link is failing.", int(bool(conn.linkWarning)), server=shortname)
+		triggers = getattr(server, "triggers", None)
+		if triggers:
+			for triggerName,matchName,stats in triggers.statRows():
+				if matchName: continue
+				ms.add("ttcom_trigger_hits_total", "counter", "Events that matched each trigger.", stats.hits, server=shortname, trigger=triggerName)
+		if server.perf.logWrites.count:
+			ms.addSummary("ttcom_log_write_seconds", "Time to write each event to ttcom.log.", server.perf.logWrites, server=shortname)
+	ms.add("ttcom_message_queue_depth", "gauge", "Messages waiting to be printed.", len(mq))
+	ms.add("ttcom_speech_queue_depth", "gauge", "Utterances waiting to be spoken.", speaker.pending())
+	ms.add("ttcom_reconnects_scheduled", "gauge", "Servers with a reconnect attempt scheduled.", reconnects.scheduled())
+	return ms
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+	"""Serves /metrics; everything else is 404.
+	"""
+	def do_GET(self):
+		if self.path.split("?")[0] != "/metrics":
+			self.send_error(404)
+			return
+		try: body = collect(self.server.getServers()).render().encode("utf-8")
+		except Exception as e:
+			self.send_error(500, str(e))
+			return
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		# Scrapes would otherwise print to the console.
+		pass
+
+
+class MetricsExporter(object):
+	"""Runs the HTTP listener in its own thread.
+	getServers is called on each scrape and returns the TeamtalkServer objects to report.
+	"""
+	def __init__(self, getServers, host="127.0.0.1", port=9464):
+		self.getServers = getServers
+		self.host = host
+		self.port = port
+		self.httpd = None
+		self.thread = None
+
+	def start(self):
+		"""Start listening; raises OSError if the address cannot be used.
+		A port of 0 picks a free one, which is then in self.port.
+		"""
+		self.httpd = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+		self.httpd.daemon_threads = True
+		self.httpd.getServers = self.getServers
+		self.port = self.httpd.server_address[1]
+		self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def stop(self):
+		if not self.httpd: return
+		self.httpd.shutdown()
+		self.httpd.server_close()
+		self.httpd = None
+
+
+def parseAddress(val, defaultHost="127.0.0.1"):
+	"""Return (host, port) from "port" or "host:port".
+	Raises ValueError for anything else.
+	"""
+	host,sep,port = val.strip().rpartition(":")
+	return (host or defaultHost), int(port)
+
+exporter = None
+
+def setExporter(val, getServers):
+	"""Start, move, or (for "" or 0) stop the exporter per an option value.
+	Returns a message describing the result.
+	"""
+	global exporter
+	if exporter:
+		exporter.stop()
+		exporter = None
+	if not val.strip() or val.strip() == "0":
+		return "Metrics exporter off."
+	host,port = parseAddress(val)
+	exporter = MetricsExporter(getServers, host, port).start()
+	return "Metrics at http://%s:%d/metrics" % (host, exporter.port)
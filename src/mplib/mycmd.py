@@ -33,21 +33,18 @@ if sys.platform == 'win32':
 		del os.environ['TZ']
 
 # Full locale handling using user defaults.
-if sys.platform == 'win32':
-	from accessible_output2.outputs import auto
 import locale
 locale.setlocale(locale.LC_ALL, '')
 
-if sys.platform == 'win32':
-	output=auto.Auto()
 import subprocess, time, re, shlex, tempfile
+from collections import deque, OrderedDict
 from cmd import Cmd
 import argparse
 import threading
 try: from win32api import SetConsoleTitle
 except ImportError: pass
 import __main__
-from mplib import log
+from mplib import log, speech
 from conf import conf
 
 class classproperty(object):
@@ -641,7 +638,8 @@ When a numbered list of options appears followed by a prompt to make one or more
 		except: pass
 		if not speakEvents: speakEvents = 0
 		if int(speakEvents) != 0:
-			mq_vo.extend(args)
+			for item in args:
+				if item is not None: say(str(item), priority=None)
 		cls.msg(*args, **kwargs)
 
 	@classmethod
@@ -661,12 +659,11 @@ When a numbered list of options appears followed by a prompt to make one or more
 			else:
 				s += str(item)
 		if not started: return
-		s1 = s
-		s1 = format(s1, indent1=indent1, indent2=indent2)
 		if kwargs.get("fromEvent"):
-			mq.append(s1)
+			# Formatting is done when the queue is flushed.
+			mq.append(s, indent1, indent2)
 		else:
-			print(s1)
+			print(format(s, indent1=indent1, indent2=indent2))
 
 	@classmethod
 	def msgErrOnly(cls, *args, **kwargs):
@@ -784,41 +781,102 @@ __builtins__["input"] = input
 
 # Formatter for output.
 import textwrap
-fmt = textwrap.TextWrapper()
-def format(text, indent1=None, indent2=None, width=79):
+# Wrap width for format(); 0 means lines are never wrapped, for log and pipe consumers.
+wrapWidth = 79
+# TextWrappers by (initial_indent, subsequent_indent, width), never modified once made.
+_wrappers = {}
+# Lines containing any of these need TextWrapper's whitespace handling.
+_specialWhitespace = re.compile(r'[\t\x0b\x0c\r]')
+
+def setWrapWidth(width):
+	"""Set the width at which format() wraps lines; 0 turns wrapping off.
+	"""
+	global wrapWidth
+	wrapWidth = max(0, int(width))
+
+def _wrapper(indent1, indent2, width):
+	key = (indent1, indent2, width)
+	try: return _wrappers[key]
+	except KeyError: pass
+	if len(_wrappers) > 256: _wrappers.clear()
+	fmt = textwrap.TextWrapper(width=width, initial_indent=indent1, subsequent_indent=indent2)
+	_wrappers[key] = fmt
+	return fmt
+
+def format(text, indent1=None, indent2=None, width=None):
 	"""
 	Format text for output to screen and/or log file.
 	Individual lines are wrapped with indent.
+	Lines that already fit are not passed through textwrap.
 	"""
 	if indent1 is None:
 		indent1 = ""
 		indent2 = "   "
 	elif indent2 is None:
 		indent2 = indent1 +"   "
-	fmt.width = width
-	lines = text.splitlines()
+	if width is None: width = wrapWidth
 	wlines = []
-	for line in lines:
+	for line in text.splitlines():
+		if not width:
+			wlines.append(indent1 +line)
+			continue
+		if _specialWhitespace.search(line) is None:
+			# Fast path: what TextWrapper would produce for a line that fits.
+			stripped = line.rstrip(" ")
+			if not stripped:
+				wlines.append("")
+				continue
+			if len(indent1) +len(stripped) <= width:
+				wlines.append(indent1 +stripped)
+				continue
 		lineIndent = " " * (len(line) -len(line.lstrip()))
-		fmt.initial_indent = indent1
-		fmt.subsequent_indent = indent2 +lineIndent
-		wlines.append("\n".join(fmt.wrap(line)))
-	text = "\n".join(wlines)
-	return text
-
-class MessageQueue(list):
-	def __init__(self, *args, **kwargs):
+		wlines.append("\n".join(_wrapper(indent1, indent2 +lineIndent, width).wrap(line)))
+	return "\n".join(wlines)
+
+class MessageQueue(object):
+	"""Queue of pending asynchronous output.
+	Messages are stored unformatted and rendered when flushed,
+	and each flush writes all pending messages with one write call.
+	When coalescing is enabled (see setCoalescing()) and messages arrive faster than the threshold rate,
+	bursts of join/leave/login/logout messages from one server are held briefly and printed as counts,
+	e.g., "[srv] 37 users joined /lobby/".
+	Any other message first releases what is held, so output stays in arrival order.
+	"""
+	# (regexp, summary format) pairs for coalescable messages.
+	# The regexp must define srv, and may define where; other text varies by user.
+	coalescePatterns = [
+		(re.compile(r'^\[(?P<srv>[^]]+)\] .+ joined (?P<where>.+)$'), "[{srv}] {n} users joined {where}"),
+		(re.compile(r'^\[(?P<srv>[^]]+)\] .+ left (?P<where>.+)$'), "[{srv}] {n} users left {where}"),
+		(re.compile(r'^\[(?P<srv>[^]]+)\] .+ logged in$'), "[{srv}] {n} users logged in"),
+		(re.compile(r'^\[(?P<srv>[^]]+)\] .+ logged out$'), "[{srv}] {n} users logged out"),
+	]
+
+	def __init__(self):
 		self.holdAsyncOutput = False
-		speechQueue = False
-		if "speechQueue" in kwargs:
-			speechQueue = kwargs["speechQueue"]
-			del kwargs["speechQueue"]
-		self.speechQueue = speechQueue
-		list.__init__(self, *args, **kwargs)
-		if speechQueue:
-			self.thr = threading.Timer(0, self.watch)
-			self.thr.setDaemon(True)
-			self.thr.start()
+		# Callable given the text of each flush in place of writing it to sys.stdout, or None.
+		self.sink = None
+		self._q = deque()
+		self._flushLock = threading.Lock()
+		# Coalescing state; see setCoalescing().
+		self.coalesceRate = 0
+		self.coalesceWindow = 1.0
+		self._arrivals = deque()
+		self._buckets = OrderedDict()
+		self._bucketLock = threading.Lock()
+		self._bucketTimer = None
+
+	def __len__(self):
+		return len(self._q)
+
+	def setCoalescing(self, rate, window=1.0):
+		"""Coalesce bursts once more than rate messages arrive per second; 0 disables.
+		Coalesced messages are held for window seconds.
+		"""
+		try: rate = int(rate or 0)
+		except ValueError: rate = 0
+		self.coalesceRate = rate
+		self.coalesceWindow = window
+		if not rate: self._flushBuckets()
 
 	def output(self, nmsgs=0):
 		"""
@@ -832,28 +890,101 @@ class MessageQueue(list):
 		"""
 		if nmsgs == 0:
 			if self.holdAsyncOutput:
-				nmsgs = 0
-			else:
-				nmsgs = -1
-		while len(self) and nmsgs != 0:
-			s = self.pop(0)
-			print(s)
-			if nmsgs > 0:
-				nmsgs -= 1
-
-	def watch(self):
+				return
+			nmsgs = -1
 		while True:
-				while len(self):
-					m = self.pop(0)
-					say(m)
-				time.sleep(0.1)
+			if nmsgs < 0:
+				# A thread already flushing will pick up what we queued.
+				if not self._flushLock.acquire(blocking=False): return
+			else:
+				self._flushLock.acquire()
+			try:
+				batch = []
+				while self._q and nmsgs != 0:
+					batch.append(self._q.popleft())
+					if nmsgs > 0:
+						nmsgs -= 1
+				if batch:
+					text = "\n".join([self.render(item) for item in batch]) +"\n"
+					if self.sink:
+						self.sink(text)
+					else:
+						out = sys.stdout
+						out.write(text)
+						out.flush()
+			finally:
+				self._flushLock.release()
+			# Catch messages queued while we held the lock.
+			if nmsgs >= 0 or not self._q:
+				return
 
-	def append(self, *args, **kwargs):
-		list.append(self, *args, **kwargs)
+	@staticmethod
+	def render(item):
+		"""Format one queued item for output.
+		Items are strings or (text, indent1, indent2) tuples.
+		"""
+		if isinstance(item, tuple): return format(*item)
+		return format(item)
+
+	def append(self, item, indent1=None, indent2=None):
+		"""Queue a message for output. Output happens immediately unless held.
+		"""
+		if indent1 is not None or indent2 is not None:
+			item = (item, indent1, indent2)
+		if self.coalesceRate and self._coalesce(item):
+			return
+		# Held messages arrived first, so they go out first.
+		if self._buckets: self._flushBuckets()
+		self._q.append(item)
+		self.output()
+
+	def extend(self, items):
+		for item in items:
+			self.append(item)
+
+	def _coalesce(self, item):
+		"""Hold item for coalescing if a burst is under way.
+		Returns True if item was held.
+		"""
+		now = time.monotonic()
+		arrivals = self._arrivals
+		arrivals.append(now)
+		while arrivals and now -arrivals[0] > 1.0:
+			arrivals.popleft()
+		if len(arrivals) <= self.coalesceRate:
+			return False
+		text = item[0] if isinstance(item, tuple) else item
+		for regexp,summary in self.coalescePatterns:
+			m = regexp.match(text)
+			if not m: continue
+			key = (summary, m.group("srv"), m.groupdict().get("where"))
+			with self._bucketLock:
+				self._buckets.setdefault(key, []).append(item)
+				if not self._bucketTimer:
+					self._bucketTimer = threading.Timer(self.coalesceWindow, self._flushBuckets)
+					self._bucketTimer.daemon = True
+					self._bucketTimer.start()
+			return True
+		return False
+
+	def _flushBuckets(self):
+		"""Queue held messages, one summary line per burst.
+		"""
+		with self._bucketLock:
+			buckets = self._buckets
+			self._buckets = OrderedDict()
+			if self._bucketTimer: self._bucketTimer.cancel()
+			self._bucketTimer = None
+		if not buckets: return
+		for key,items in buckets.items():
+			summary,srv,where = key
+			if len(items) == 1:
+				self._q.append(items[0])
+			else:
+				self._q.append(summary.format(srv=srv, where=where, n=len(items)))
 		self.output()
 
 mq = MessageQueue()
-mq_vo = MessageQueue(speechQueue=True)
 
 def pendingMessageCount():
 	return len(mq)
@@ -899,28 +1030,16 @@ def errTrace(e=None):
 		e = e.tb_next
 	return ", ".join(trc)
 
-def say(*args):
+def say(*args, **kwargs):
 	"""
-	On MacOS, speak via the default Mac voice.
-	On Windows. speak via SayTools if available.
+	Speak through the platform's speech channel (see mplib.speech).
+	Speech is queued and this returns at once.
+	Pass priority=None to rank by content, e.g., events; the default is speech.HIGH.
 	"""
 	try: s = " ".join(args)
 	except TypeError: s = str(args)
 	s = re.sub(r'[A-Z_]+', cleanForSpeech, s)
-	plat = sys.platform
-	if (plat == "cygwin" or plat.startswith("win")):
-		if s!="" and s!=" ":
-			try: output.speak(s)
-			except: print(__main__.err())
-	elif plat == "darwin": # MacOS
-		cmd = ["say",]
-		sprefix = os.environ.get("SAYPREFIX")
-		if sprefix: s=sprefix+s
-		subprocess.Popen(cmd, stdin=subprocess.PIPE, text=True).communicate(s)
-	else:
-		sprefix = os.environ.get("SAYPREFIX")
-		if sprefix: s=sprefix+" "+s
-		subprocess.Popen("spd-say "+s)
+	speech.speaker.say(s, kwargs.get("priority", speech.HIGH))
 
 def cleanForSpeech(m):
 	"""
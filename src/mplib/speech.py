@@ -0,0 +1,283 @@
+"""Speech output through one long-lived synthesizer channel.
+
+Utterances are queued by priority and spoken by a single thread in batches.
+Utterances that wait longer than the speaker's maxAge are dropped unspoken,
+so speech does not fall minutes behind a busy server.
+
+Backends:
+	speechd: Speech Dispatcher through the speechd Python module (one SSIP connection).
+	spd-say: One long-lived "spd-say -e" process fed a line per batch.
+	say: MacOS say, one process per batch rather than per utterance.
+	ao2: accessible_output2 (Windows screen readers and SAPI).
+	stub: Records what would be spoken; for testing.
+The default is taken from the TTCOM_SPEECH_BACKEND environment variable if set,
+else chosen by platform.
+"""
+
+import os, re, sys, time
+import threading
+import subprocess
+from collections import deque
+
+# Priorities, most urgent first.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# (regexp, priority) pairs tried in order by classify().
+classifyPatterns = [
+	(re.compile(r'(User|Channel) message from |\*\*\* |has kicked you'), HIGH),
+	(re.compile(r' (joined|left) /| logged (in|out)$|^(\[[^]]*\] )?User .+ typing'), LOW),
+]
+
+def classify(text):
+	"""Return the priority for an utterance: messages before status, joins and leaves last.
+	"""
+	for regexp,priority in classifyPatterns:
+		if regexp.search(text): return priority
+	return NORMAL
+
+
+class SpeechError(Exception):
+	"""A speech backend could not be started or used.
+	"""
+	pass
+
+
+def prefixed(text, sep=" "):
+	"""Apply the SAYPREFIX environment variable, used to pick a voice or rate.
+	"""
+	sprefix = os.environ.get("SAYPREFIX")
+	if sprefix: return sprefix +sep +text
+	return text
+
+
+class StubBackend(object):
+	"""Backend that speaks nothing but records each batch.
+	"""
+	name = "stub"
+	# Whether speak() returns only when speech is done.
+	blocking = True
+
+	def __init__(self):
+		self.spoken = []
+
+	def speak(self, texts):
+		self.spoken.append(list(texts))
+
+	def close(self):
+		pass
+
+
+class SpeechdBackend(object):
+	"""Speech Dispatcher over one SSIP connection.
+	speak() waits for the batch to finish so the queue, not the synthesizer, holds backlog.
+	"""
+	name = "speechd"
+	blocking = True
+
+	def __init__(self, timeout=60):
+		import speechd
+		self._speechd = speechd
+		self.timeout = timeout
+		try: self.client = speechd.SSIPClient("ttcom")
+		except Exception as e: raise SpeechError(str(e))
+
+	def speak(self, texts):
+		done = threading.Event()
+		cb = lambda *args: done.set()
+		CT = self._speechd.CallbackType
+		self.client.speak(prefixed(". ".join(texts)), callback=cb, event_types=(CT.END, CT.CANCEL))
+		done.wait(self.timeout)
+
+	def close(self):
+		self.client.close()
+
+
+class SpdSayBackend(object):
+	"""One spd-say process in pipe mode; each batch is written as one line.
+	The process is restarted only if it dies.
+	"""
+	name = "spd-say"
+	blocking = False
+
+	def __init__(self):
+		self.proc = None
+
+	def speak(self, texts):
+		if not self.proc or self.proc.poll() is not None:
+			try: self.proc = subprocess.Popen(["spd-say", "-e"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+			except OSError as e: raise SpeechError(str(e))
+		line = prefixed(". ".join(texts)).replace("\n", " ")
+		try:
+			self.proc.stdin.write(line +"\n")
+			self.proc.stdin.flush()
+		except (OSError, ValueError):
+			self.proc = None
+			raise
+
+	def close(self):
+		if not self.proc: return
+		try: self.proc.stdin.close()
+		except OSError: pass
+		self.proc = None
+
+
+class SayBackend(object):
+	"""MacOS say, one process per batch.
+	"""
+	name = "say"
+	blocking = True
+
+	def speak(self, texts):
+		subprocess.Popen(["say"], stdin=subprocess.PIPE, text=True).communicate(prefixed("\n".join(texts), ""))
+
+	def close(self):
+		pass
+
+
+class Ao2Backend(object):
+	"""accessible_output2, which speaks through the running screen reader or SAPI.
+	"""
+	name = "ao2"
+	blocking = False
+
+	def __init__(self):
+		from accessible_output2.outputs import auto
+		self.output = auto.Auto()
+
+	def speak(self, texts):
+		self.output.speak(". ".join(texts))
+
+	def close(self):
+		pass
+
+
+def makeBackend(spec):
+	"""Make a backend from a spec string; see the module doc string for names.
+	"auto" picks one for this platform.
+	"""
+	kind = spec.strip().lower()
+	if kind == "auto":
+		plat = sys.platform
+		if plat == "cygwin" or plat.startswith("win"): return Ao2Backend()
+		if plat == "darwin": return SayBackend()
+		try: return SpeechdBackend()
+		except (ImportError, SpeechError): return SpdSayBackend()
+	if kind == "stub": return StubBackend()
+	if kind == "speechd": return SpeechdBackend()
+	if kind == "spd-say": return SpdSayBackend()
+	if kind == "say": return SayBackend()
+	if kind == "ao2": return Ao2Backend()
+	raise ValueError("Unknown speech backend: " +spec)
+
+
+class Speaker(object):
+	"""Queues utterances by priority and speaks them in batches from one thread.
+	Each batch holds up to maxBatch utterances, most urgent first.
+	Utterances older than maxAge seconds are dropped; 0 keeps everything.
+	For backends that return before speech ends, the thread waits about as long
+	as the batch should take to speak (charsPerSecond) before sending more.
+	"""
+	def __init__(self, backend=None, maxAge=30.0, maxBatch=5, charsPerSecond=15.0, classify=classify):
+		self._backend = backend
+		self.maxAge = maxAge
+		self.maxBatch = maxBatch
+		self.charsPerSecond = charsPerSecond
+		self.classify = classify
+		self.queues = [deque(), deque(), deque()]
+		self.cond = threading.Condition()
+		self.thread = None
+		self.spoken = 0
+		self.dropped = 0
+		self.batches = 0
+		self.errors = 0
+		# Why the configured backend could not be made, if it could not.
+		self.backendError = ""
+
+	@property
+	def backend(self):
+		"""The speech backend, made on first use.
+		If the configured backend can't be made, spd-say is used instead
+		and the reason is kept in backendError for status().
+		"""
+		if self._backend is None:
+			spec = os.environ.get("TTCOM_SPEECH_BACKEND", "auto")
+			try: self._backend = makeBackend(spec)
+			except Exception as e:
+				self.backendError = "{0} failed: {1}".format(spec, e)
+				self._backend = SpdSayBackend()
+		return self._backend
+
+	def say(self, text, priority=None):
+		"""Queue text for speaking. Priority defaults to classify(text).
+		"""
+		if not text or not text.strip(): return
+		if priority is None: priority = self.classify(text)
+		with self.cond:
+			self.queues[priority].append((time.monotonic(), text))
+			if not self.thread:
+				self.thread = threading.Thread(target=self.run, name="speech")
+				self.thread.daemon = True
+				self.thread.start()
+			self.cond.notify()
+
+	def pending(self):
+		"""Return the number of queued utterances.
+		"""
+		with self.cond:
+			return sum(len(q) for q in self.queues)
+
+	def clear(self):
+		"""Drop everything not yet spoken.
+		"""
+		with self.cond:
+			for q in self.queues:
+				self.dropped += len(q)
+				q.clear()
+
+	def _nextBatch(self):
+		"""Remove and return the next batch, dropping stale utterances.
+		Call with self.cond held.
+		"""
+		now = time.monotonic()
+		batch = []
+		for q in self.queues:
+			if self.maxAge:
+				while q and now -q[0][0] > self.maxAge:
+					q.popleft()
+					self.dropped += 1
+			while q and len(batch) < self.maxBatch:
+				batch.append(q.popleft()[1])
+		return batch
+
+	def run(self):
+		"""Speak queued utterances. Runs in its own thread.
+		"""
+		while True:
+			with self.cond:
+				while not any(self.queues):
+					self.cond.wait()
+				batch = self._nextBatch()
+			if not batch: continue
+			try:
+				backend = self.backend
+				backend.speak(batch)
+			except Exception:
+				self.errors += 1
+				continue
+			self.batches += 1
+			self.spoken += len(batch)
+			if not backend.blocking and self.charsPerSecond:
+				time.sleep(sum(len(t) for t in batch) / self.charsPerSecond)
+
+	def status(self):
+		"""Return a one-line summary of speech queue state.
+		"""
+		name = self._backend.name if self._backend else "(not started)"
+		if self.backendError: name += " ({0})".format(self.backendError)
+		return "Speech backend {0}, pending {1}, spoken {2} in {3} batches, dropped {4}, errors {5}".format(
+			name, self.pending(), self.spoken, self.batches, self.dropped, self.errors
+		)
+
+speaker = Speaker()
@@ -0,0 +1,95 @@
+"""N-gram substring index for searching names without scanning them all.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+# Length of the indexed substrings. Queries of N or more characters intersect the posting sets
+# for their N-grams and then check the few texts left; shorter queries scan the texts.
+N = 3
+
+
+def grams(text, n=N):
+	"""Return the set of n-character substrings of text.
+	"""
+	return set(text[i:i+n] for i in range(len(text) -n +1))
+
+
+class NgramIndex(object):
+	"""Case-insensitive substring search over short texts, each stored under a key.
+	Each substring of N characters maps to the set of keys whose text contains it.
+	Changes and searches must not overlap; callers hold their own lock.
+	"""
+	def __init__(self):
+		# Key -> lower-cased text.
+		self.texts = {}
+		# N-gram -> set of keys.
+		self.postings = {}
+
+	def __len__(self):
+		return len(self.texts)
+
+	def set(self, key, text):
+		"""Index text under key, replacing any text it had.
+		"""
+		text = text.lower()
+		old = self.texts.get(key)
+		if old == text: return
+		newGrams = grams(text)
+		if old is not None:
+			oldGrams = grams(old)
+			self._unpost(key, oldGrams -newGrams)
+			newGrams -= oldGrams
+		self.texts[key] = text
+		postings = self.postings
+		for g in newGrams:
+			keys = postings.get(g)
+			if keys is None: keys = postings[g] = set()
+			keys.add(key)
+
+	def remove(self, key):
+		old = self.texts.pop(key, None)
+		if old is not None: self._unpost(key, grams(old))
+
+	def _unpost(self, key, gramSet):
+		postings = self.postings
+		for g in gramSet:
+			keys = postings.get(g)
+			if keys is None: continue
+			keys.discard(key)
+			if not keys: del postings[g]
+
+	def clear(self):
+		self.texts = {}
+		self.postings = {}
+
+	def search(self, query):
+		"""Return a list of the keys whose text contains query, ignoring case.
+		An empty query matches every key.
+		"""
+		q = query.lower()
+		if len(q) < N:
+			return [k for k,text in self.texts.items() if q in text]
+		sets = []
+		for i in range(len(q) -N +1):
+			keys = self.postings.get(q[i:i+N])
+			if not keys: return []
+			sets.append(keys)
+		sets.sort(key=len)
+		keys = sets[0].intersection(*sets[1:])
+		if len(q) == N: return list(keys)
+		texts = self.texts
+		return [k for k in keys if q in texts[k]]
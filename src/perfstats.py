@@ -0,0 +1,169 @@
+"""Low-overhead timing histograms for event processing.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import threading
+from mplib.TableFormatter import TableFormatter
+
+# Phases of TeamtalkServer.processLine() that are timed, in processing order.
+# handler excludes output, which is timed separately.
+PHASES = ("parse", "hookPre", "handler", "hookPost", "output", "total")
+
+# Sub-buckets per power of two; 8 gives values to within 12.5%.
+SUB_BITS = 3
+SUB_COUNT = 1 << SUB_BITS
+
+
+def bucketIndex(v):
+	"""Return the histogram bucket for a non-negative integer value.
+	Values below SUB_COUNT get a bucket each;
+	above that, each power of two is split into SUB_COUNT equal buckets.
+	"""
+	if v < SUB_COUNT: return v
+	exp = v.bit_length() -SUB_BITS
+	return exp * SUB_COUNT +(v >> (exp -1) & (SUB_COUNT -1))
+
+def bucketLimit(i):
+	"""Return the largest value that falls in bucket i.
+	"""
+	if i < SUB_COUNT: return i
+	exp,sub = divmod(i, SUB_COUNT)
+	return ((SUB_COUNT +sub +1) << (exp -1)) -1
+
+
+class Histogram(object):
+	"""A fixed-bucket, HDR-style histogram of non-negative integers (nanoseconds here).
+	Recording is a bucket computation and a few additions.
+	Buckets are kept sparsely, since timings cluster in a few of them.
+	Percentiles are reported as the top of the bucket they fall in.
+	"""
+	__slots__ = ("counts", "count", "total", "max")
+
+	def __init__(self):
+		# Bucket index -> count.
+		self.counts = {}
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def record(self, v):
+		i = bucketIndex(v)
+		counts = self.counts
+		counts[i] = counts.get(i, 0) +1
+		self.count += 1
+		self.total += v
+		if v > self.max: self.max = v
+
+	def merge(self, other):
+		"""Add another histogram's counts to this one.
+		"""
+		counts = self.counts
+		for i,n in other.counts.copy().items():
+			counts[i] = counts.get(i, 0) +n
+		self.count += other.count
+		self.total += other.total
+		self.max = max(self.max, other.max)
+
+	def percentile(self, pct):
+		"""Return the pct (0-100) percentile, no larger than the maximum recorded.
+		"""
+		if not self.count: return 0
+		target = max(1, int(round(self.count * pct / 100.0)))
+		seen = 0
+		counts = self.counts.copy()
+		for i in sorted(counts):
+			seen += counts[i]
+			if seen >= target: return min(bucketLimit(i), self.max)
+		return self.max
+
+	def toDict(self):
+		"""Return a JSON-ready summary, including the non-empty buckets by upper limit.
+		"""
+		return {
+			"count": self.count, "total": self.total, "max": self.max,
+			"p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+			"buckets": dict((str(bucketLimit(i)), n) for i,n in sorted(self.counts.copy().items()))
+		}
+
+
+class ServerPerf(object):
+	"""Histograms by event type and phase for one server.
+	Only the thread running processLine() records, so recording takes no lock;
+	reset() swaps in a fresh table.
+	"""
+	def __init__(self):
+		self.events = {}
+		# Time taken by ttcom.log writes for this server's events.
+		self.logWrites = Histogram()
+
+	def histogram(self, event, phase):
+		phases = self.events.get(event)
+		if phases is None:
+			phases = self.events[event] = {}
+		h = phases.get(phase)
+		if h is None:
+			h = phases[phase] = Histogram()
+		return h
+
+	def record(self, event, phase, ns):
+		self.histogram(event, phase).record(ns)
+
+	def reset(self):
+		self.events = {}
+		self.logWrites = Histogram()
+
+	def merge(self, other):
+		"""Add another ServerPerf's histograms to this one.
+		"""
+		self.logWrites.merge(other.logWrites)
+		for event,phases in list(other.events.items()):
+			for phase,h in list(phases.items()):
+				self.histogram(event, phase).merge(h)
+
+	def report(self, title):
+		"""Return a table of p50/p99/max per event type, busiest first,
+		with each event's phases on the rows below its total.
+		"""
+		tbl = TableFormatter(title, [
+			"Event", "Phase", "Count", "p50 us", "p99 us", "Max us", "Total ms"
+		])
+		us = lambda ns: "{0:.1f}".format(ns / 1e3)
+		events = list(self.events.items())
+		events.sort(key=lambda i: -(i[1].get("total") or Histogram()).total)
+		for event,phases in events:
+			label = event
+			for phase in ("total",) +PHASES[:-1]:
+				h = phases.get(phase)
+				if not h: continue
+				tbl.addRow([
+					label, phase, str(h.count),
+					us(h.percentile(50)), us(h.percentile(99)), us(h.max),
+					"{0:.1f}".format(h.total / 1e6)
+				])
+				label = ""
+		return tbl.format(2)
+
+	def toDict(self):
+		return dict((event, dict((phase, h.toDict()) for phase,h in list(phases.items())))
+			for event,phases in list(self.events.items())
+		)
+
+
+# Per-thread accumulator for output time inside the event being dispatched.
+# processLine() sets outputNs to 0 before dispatch; output code adds to it when it is present.
+dispatch = threading.local()
@@ -17,37 +17,216 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """
 
-import os
-from subprocess import call, PIPE
+import os, time, wave
+from subprocess import Popen, run, PIPE, DEVNULL, CalledProcessError
 import threading
-from queue import Queue, Empty
-from mplib.mycmd import MyCmd
-callWithRetry = MyCmd.callWithRetry
-
-def consumer():
-	"""The consumer for the sound file queue. Runs in its own thread.
-	"""
-	while (True):
-		lst = []
-		# Wait for a file name.
-		lst.append(queue.get())
-		# Collect as many as are immediately available after that one.
-		while True:
-			try: lst.append(queue.get(block=False))
-			except Empty: break
-		cmd = ["play", "-q"]
-		cmd.extend(lst)
-		try: call(cmd, stdin=PIPE, stdout=PIPE, text=True)
+from queue import Queue
+from sound.soundcache import SoundCache
+
+class NullSink(object):
+	"""Sink that discards audio. Useful for headless use and testing.
+	"""
+	def __init__(self):
+		self.bytesWritten = 0
+
+	def write(self, pcm):
+		self.bytesWritten += len(pcm)
+
+	def close(self):
+		pass
+
+class WavFileSink(NullSink):
+	"""Sink that appends all audio to a single WAV file.
+	"""
+	def __init__(self, fname, rate=44100, channels=2, width=2):
+		NullSink.__init__(self)
+		self.wf = wave.open(fname, "wb")
+		self.wf.setnchannels(channels)
+		self.wf.setsampwidth(width)
+		self.wf.setframerate(rate)
+
+	def write(self, pcm):
+		self.wf.writeframes(pcm)
+		NullSink.write(self, pcm)
+
+	def close(self):
+		self.wf.close()
+
+class SoxSink(NullSink):
+	"""Sink that feeds raw PCM to one long-lived SoX play process over a pipe.
+	The process is restarted only if it dies.
+	"""
+	def __init__(self, rate=44100, channels=2, width=2):
+		NullSink.__init__(self)
+		self.cmd = ["play", "-q", "-t", "raw", "-r", str(rate), "-e", "signed",
+			"-b", str(8*width), "-c", str(channels), "-"]
+		self.proc = None
+
+	def write(self, pcm):
+		if not self.proc or self.proc.poll() is not None:
+			self.proc = Popen(self.cmd, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+		try:
+			self.proc.stdin.write(pcm)
+			self.proc.stdin.flush()
+		except (OSError, ValueError):
+			self.proc = None
+			raise
+		NullSink.write(self, pcm)
+
+	def close(self):
+		if not self.proc: return
+		try: self.proc.stdin.close()
 		except OSError: pass
+		self.proc = None
 
-def sendFile(fname):
-	"""Add a file to the play queue.
+class PcmCache(SoundCache):
+	"""SoundCache of PCM already converted to an AudioWorker's sink format.
+	Unlike SoundCache, files are loaded one at a time as they are played,
+	and a file changed on disk since it was converted is converted again.
+	"""
+	def __init__(self, worker, maxBytes=32 * 1024 * 1024):
+		SoundCache.__init__(self, maxBytes)
+		self.worker = worker
+		# Path -> modification time of the file when it was converted.
+		self._mtimes = {}
+
+	def get(self, filename):
+		"""Return the PCM for filename, converting it if it is not cached or has changed.
+		Returns None if the file can't be read or converted.
+		"""
+		key = self._key(filename)
+		try: mtime = os.path.getmtime(key)
+		except OSError: return None
+		with self._lock:
+			data = self._data.get(key)
+			if data is not None and self._mtimes.get(key) == mtime:
+				self._data.move_to_end(key)
+				self.hits += 1
+				return data
+			self.misses += 1
+		data = self._read(key)
+		if data is not None:
+			self._store(key, data)
+			with self._lock: self._mtimes[key] = mtime
+		return data
+
+	def preload(self, pack):
+		"""Do nothing; any directory may be played from, so only files actually played are converted.
+		"""
+		pass
+
+	def _read(self, key):
+		try: return self.worker.convert(key)
+		except (OSError, CalledProcessError): return None
+
+class AudioWorker(object):
+	"""A long-lived thread that plays queued sounds through one sink.
+	Queue items are file paths or already-decoded PCM bytes in the sink's format.
+	WAV files in the sink's format are read directly;
+	anything else is converted with SoX (without opening the audio device).
+	Converted sounds are kept in a PcmCache.
+	Files are played in the order received.
 	"""
-	queue.put(fname)
+	def __init__(self, sink=None, rate=44100, channels=2, width=2):
+		self.rate = rate
+		self.channels = channels
+		self.width = width
+		if sink is None: sink = SoxSink(rate, channels, width)
+		self.sink = sink
+		self.cache = PcmCache(self)
+		self.queue = Queue()
+		self.played = 0
+		self.errors = 0
+		self.lastLatency = 0.0
+		self.maxLatency = 0.0
+		self.totalLatency = 0.0
+		self.th = threading.Thread(target=self.consumer)
+		self.th.name = "audioWorker"
+		# Let the play queue die quietly on program exit.
+		self.th.daemon = True
+		self.th.start()
+
+	def send(self, item):
+		"""Queue a file path or a PCM buffer for playing.
+		"""
+		self.queue.put((item, time.perf_counter()))
+
+	def consumer(self):
+		"""Play queued items. Runs in its own thread.
+		"""
+		while True:
+			item,queued = self.queue.get()
+			if item is None: break
+			try:
+				self.sink.write(self.decode(item))
+				latency = time.perf_counter() -queued
+			except Exception:
+				self.errors += 1
+				continue
+			self.played += 1
+			self.lastLatency = latency
+			self.totalLatency += latency
+			self.maxLatency = max(self.maxLatency, latency)
+		self.sink.close()
+
+	def decode(self, item):
+		"""Return PCM bytes in the sink's format for a queue item.
+		"""
+		if isinstance(item, (bytes, bytearray, memoryview)): return bytes(item)
+		pcm = self.cache.get(item)
+		if pcm is None: raise IOError("Cannot read or convert " +item)
+		return pcm
+
+	def convert(self, fname):
+		"""Read or convert a sound file to PCM bytes in the sink's format.
+		"""
+		try:
+			with wave.open(fname, "rb") as wf:
+				if (wf.getframerate() == self.rate
+				and wf.getnchannels() == self.channels
+				and wf.getsampwidth() == self.width):
+					return wf.readframes(wf.getnframes())
+		except (wave.Error, EOFError):
+			pass
+		cmd = ["sox", fname, "-t", "raw", "-r", str(self.rate), "-e", "signed",
+			"-b", str(8*self.width), "-c", str(self.channels), "-"]
+		return run(cmd, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, check=True).stdout
+
+	def stop(self):
+		"""End the worker thread after the queue drains and close the sink.
+		"""
+		self.queue.put((None, 0))
+		self.th.join()
 
-queue = Queue()
-th = threading.Thread(target=consumer)
-# Let the play queue die quietly on program exit.
-th.daemon = True
-th.start()
+	def status(self):
+		"""Return a one-line summary of queue depth and play latency.
+		"""
+		avg = self.totalLatency / self.played if self.played else 0.0
+		return "Queue depth {0}, played {1}, errors {2}, latency last {3:.1f} ms, avg {4:.1f} ms, max {5:.1f} ms".format(
+			self.queue.qsize(), self.played, self.errors,
+			self.lastLatency*1000, avg*1000, self.maxLatency*1000
+		)
 
+worker = None
+_lock = threading.Lock()
+
+def getWorker():
+	"""Return the audio worker, starting it on first use.
+	"""
+	global worker
+	with _lock:
+		if worker is None: worker = AudioWorker()
+		return worker
+
+def setSink(sink):
+	"""Replace the audio worker with one using the given sink, such as NullSink() or WavFileSink(fname).
+	"""
+	global worker
+	with _lock:
+		old,worker = worker,AudioWorker(sink)
+	if old: old.stop()
+
+def sendFile(fname):
+	"""Add a file to the play queue.
+	"""
+	getWorker().send(fname)
@@ -0,0 +1,455 @@
+"""Sharded mode: servers split across worker processes so event processing can use several CPU cores.
+
+Start with "ttcom.py -j N" for N worker processes, or -j 0 for one per CPU core.
+Each server belongs to one worker, chosen from a hash of its shortname, and each worker runs
+an ordinary TTComCmd object over just its servers. The main process owns the console:
+it runs the commands listed in ShardRouter.localCommands itself,
+sends every other command to the worker holding the current server, relays that command's output
+and prompts, and prints events as workers send them.
+allSummarize, shortSummary, and find gather from every worker and print merged results.
+Other commands that look across servers see only the current server's worker.
+Workers log events to ttcom.shardN.log instead of ttcom.log, and serve no metrics.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import sys, shlex, signal, time, zlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from queue import Queue, Empty
+from conf import conf
+from TTComCmd import TTComCmd
+from mplib.mycmd import CommandError, mq, err
+from mplib.TableFormatter import TableFormatter
+
+
+def shardOf(shortname, count):
+	"""Return the index of the worker, of count, that handles a server.
+	Stable across runs, so a server keeps its worker and log file.
+	"""
+	return zlib.crc32(shortname.lower().encode("utf-8")) % count
+
+
+def mergeSummaries(datas):
+	"""Merge TTComCmd.summaryData() results from several workers into one.
+	"""
+	merged = {"servers": 0, "stateCounts": OrderedDict(), "offs": {}, "empties": [], "sums": [], "linkWarnings": []}
+	for data in datas:
+		merged["servers"] += data["servers"]
+		for state,n in data["stateCounts"].items():
+			merged["stateCounts"][state] = merged["stateCounts"].get(state, 0) +n
+		for state,names in data["offs"].items():
+			merged["offs"].setdefault(state, []).extend(names)
+		for k in ["empties", "sums", "linkWarnings"]:
+			merged[k].extend(data[k])
+	for names in merged["offs"].values():
+		names.sort()
+	merged["empties"].sort()
+	merged["sums"].sort(key=lambda s: s[0])
+	merged["linkWarnings"].sort()
+	return merged
+
+
+class WorkerPipe(object):
+	"""The worker end of the pipe to the main process.
+	Event threads and the command loop both send, so sends are serialized.
+	"""
+	def __init__(self, conn):
+		self.conn = conn
+		self.lock = threading.Lock()
+
+	def send(self, msg):
+		with self.lock:
+			try: self.conn.send(msg)
+			except (OSError, EOFError): pass
+
+
+class WorkerOutput(object):
+	"""Stands in for sys.stdout in a worker.
+	Output of the command being run is gathered for its reply;
+	anything else, e.g., from connection threads, goes to the main process right away.
+	"""
+	encoding = "utf-8"
+
+	def __init__(self, pipe):
+		self.pipe = pipe
+		self.cmdThread = threading.current_thread()
+		# Output of the running command, or None between commands.
+		self.buf = None
+
+	def write(self, text):
+		if self.buf is not None and threading.current_thread() is self.cmdThread:
+			self.buf.append(text)
+		elif text:
+			self.pipe.send(("print", text))
+		return len(text)
+
+	def take(self):
+		"""Return and clear the gathered command output.
+		"""
+		text = "".join(self.buf or [])
+		self.buf = []
+		return text
+
+	def flush(self):
+		pass
+
+	def isatty(self):
+		return False
+
+
+class WorkerInput(object):
+	"""Stands in for sys.stdin in a worker: prompts are answered from the main process's console.
+	"""
+	encoding = "utf-8"
+
+	def __init__(self, pipe, output):
+		self.pipe = pipe
+		self.output = output
+
+	def readline(self):
+		self.pipe.send(("prompt", self.output.take()))
+		try: msg = self.pipe.conn.recv()
+		except (OSError, EOFError): return ""
+		if msg[0] != "input": return ""
+		return msg[1]
+
+	def isatty(self):
+		return False
+
+
+class WorkerCmd(TTComCmd):
+	"""TTComCmd as run in a worker process: events go to the main process to be printed and spoken there.
+	"""
+	pipe = None
+
+	@classmethod
+	def msgFromEvent(cls, *args):
+		text = " ".join([str(item) for item in args if item is not None])
+		if text: cls.pipe.send(("event", text))
+
+
+def workerMain(index, count, conn, noAutoLogins, logins, name, version):
+	"""Run one worker process until told to quit or the main process goes away.
+	Messages from the main process:
+		("cmd", line, curShortname, seq): Run a command; answered by ("done", output, curShortname, stop, seq),
+			after any ("prompt", text) messages, each answered with ("input", line).
+		("current", curShortname): The current server changed.
+		("summary", short, seq): Answered by ("summary", summaryData(short), seq).
+		("find", text, prefix, limit, seq): Answered by ("found", findUsers(text, prefix, limit), seq).
+		("option", name, value): An option changed.
+		("quit",): Stop.
+	Unprompted messages to the main process: ("ready",), ("event", text), ("print", text).
+	"""
+	# Ctrl+C is for the main process's console.
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	conf.name = name
+	conf.version = version
+	pipe = WorkerPipe(conn)
+	out = WorkerOutput(pipe)
+	sys.stdout = out
+	sys.stdin = WorkerInput(pipe, out)
+	mq.sink = lambda text: pipe.send(("print", text))
+	WorkerCmd.pipe = pipe
+	app = WorkerCmd(noAutoLogins, logins, shard=(index, count))
+	app.stdout = sys.stdout
+	pipe.send(("ready",))
+	while True:
+		try: msg = conn.recv()
+		except (OSError, EOFError): break
+		kind = msg[0]
+		if kind == "cmd":
+			line,app._curShortname = msg[1],msg[2]
+			out.buf = []
+			try: stop = app.onecmd(line)
+			finally:
+				text = out.take()
+				out.buf = None
+			pipe.send(("done", text, app._curShortname, bool(stop), msg[3]))
+		elif kind == "current":
+			app._curShortname = msg[1]
+		elif kind == "summary":
+			pipe.send(("summary", app.summaryData(msg[1]), msg[2]))
+		elif kind == "find":
+			pipe.send(("found", app.findUsers(msg[1], msg[2], msg[3]), msg[4]))
+		elif kind == "option":
+			app.applyOption(msg[1], msg[2])
+		elif kind == "quit":
+			break
+
+
+class ShardWorker(object):
+	"""The main process's handle on one worker process.
+	"""
+	# Reply kinds that end with the sequence number of the request they answer.
+	numberedReplies = set(["done", "summary", "found"])
+
+	def __init__(self, router, index, count):
+		self.router = router
+		self.index = index
+		self.count = count
+		self.process = None
+		self.conn = None
+		self.sendLock = threading.Lock()
+		# Replies to commands and summary requests.
+		self.replies = Queue()
+		# Sequence number of the last request sent.
+		self.seq = 0
+		self.ready = threading.Event()
+		self.alive = False
+
+	def start(self, noAutoLogins, logins):
+		ctx = multiprocessing.get_context("spawn")
+		self.conn,child = ctx.Pipe()
+		self.process = ctx.Process(
+			target=workerMain, name="shard%d" % (self.index),
+			args=(self.index, self.count, child, noAutoLogins, logins, conf.name, conf.version)
+		)
+		self.process.daemon = True
+		self.process.start()
+		child.close()
+		self.alive = True
+		th = threading.Thread(target=self.receive, name="shard%d_receive" % (self.index))
+		th.daemon = True
+		th.start()
+		return self
+
+	def send(self, msg):
+		if not self.alive:
+			raise CommandError("Shard %d is not running." % (self.index))
+		with self.sendLock:
+			self.conn.send(msg)
+
+	def request(self, msg):
+		"""Send msg with a new sequence number appended, and return the number for reply().
+		"""
+		if not self.alive:
+			raise CommandError("Shard %d is not running." % (self.index))
+		with self.sendLock:
+			self.seq += 1
+			seq = self.seq
+			self.conn.send(msg +(seq,))
+		return seq
+
+	def receive(self):
+		"""Handle messages from the worker. Runs in its own thread.
+		"""
+		while True:
+			try: msg = self.conn.recv()
+			except (OSError, EOFError): break
+			kind = msg[0]
+			if kind == "event":
+				self.router.msgFromEvent(msg[1])
+			elif kind == "print":
+				text = msg[1].rstrip("\n")
+				if text: mq.append(text)
+			elif kind == "ready":
+				self.ready.set()
+			else:
+				self.replies.put(msg)
+		wasAlive = self.alive
+		self.alive = False
+		self.ready.set()
+		self.replies.put(("exit",))
+		if wasAlive and not self.router.stopping:
+			self.router.msgFromEvent("Shard %d worker stopped" % (self.index))
+
+	def reply(self, seq, timeout=None):
+		"""Return the next reply from the worker to request seq, or ("exit",) if it stopped or timed out.
+		Late replies to earlier requests, such as one that timed out, are discarded.
+		"""
+		deadline = time.monotonic() +timeout if timeout is not None else None
+		while True:
+			left = max(0, deadline -time.monotonic()) if deadline is not None else None
+			try: msg = self.replies.get(timeout=left)
+			except Empty: return ("exit",)
+			if msg[0] in self.numberedReplies and msg[-1] != seq: continue
+			return msg
+
+	def stop(self, timeout=5.0):
+		if self.alive:
+			try: self.send(("quit",))
+			except (OSError, CommandError): pass
+		if self.process:
+			self.process.join(timeout)
+			if self.process.is_alive(): self.process.terminate()
+
+
+class ShardRouter(TTComCmd):
+	"""TTComCmd for the main process in sharded mode: it has no servers of its own
+	and runs most commands in the worker holding the current server.
+	"""
+	# Commands run in this process; lower case.
+	localCommands = set([
+		"help", "about", "version", "quit", "exit", "eof", "python", "errtrace",
+		"option", "server", "summary", "refresh", "allsummarize", "shortsummary", "find", "shards"
+	])
+
+	# The ttdaemon.ControlDaemon serving this object's commands, if any.
+	daemon = None
+
+	def __init__(self, noAutoLogins=False, logins=[], count=2):
+		self.count = count
+		self.workers = []
+		self.stopping = False
+		TTComCmd.__init__(self, noAutoLogins, logins)
+
+	def readServers(self, logins=[]):
+		"""Start the workers, which read their own servers, and wait for them to log in.
+		"""
+		names = list(conf.servers().keys())
+		if not self._curShortname and names: self._curShortname = names[0]
+		self.workers = [ShardWorker(self, i, self.count).start(self.noAutoLogins, logins) for i in range(self.count)]
+		for worker in self.workers:
+			# Startup logins wait up to 10 seconds, and process startup takes a few more.
+			worker.ready.wait(60)
+		if not names:
+			print("Warning: No servers defined. Make sure you have created and filled out the configuration file " +conf.inipath)
+
+	def ownerOf(self, shortname):
+		return self.workers[shardOf(shortname, self.count)]
+
+	def shortnameMatch(self, s):
+		"""serverMatch() for this process: returns a shortname from the configuration.
+		"""
+		names = list(conf.servers().keys())
+		if s in names: return s
+		return self.selectMatch([n for n in names if s.lower() in n.lower()], "Select a Server")
+
+	def onecmd(self, line):
+		if isinstance(line, list): line = self.lineFromArgs(line)
+		try:
+			cmd,arg,fixed = self.parseline(self.precmd(line))
+			if not cmd or cmd.lower() in self.localCommands or cmd.lower() not in self._commands():
+				return TTComCmd.onecmd(self, line)
+			if not self._curShortname:
+				raise CommandError("No current server has been set.")
+			return self.forward(self.ownerOf(self._curShortname), fixed)
+		except KeyboardInterrupt:
+			self.msg("Keyboard interrupt")
+		except Exception:
+			self.msg(err())
+
+	def forward(self, worker, line):
+		"""Run a command line in a worker, relaying its output and prompts here.
+		Returns the command's stop flag.
+		"""
+		oldname = self._curShortname
+		seq = worker.request(("cmd", line, self._curShortname))
+		while True:
+			msg = worker.reply(seq)
+			kind = msg[0]
+			if kind == "prompt":
+				sys.stdout.write(msg[1])
+				sys.stdout.flush()
+				worker.send(("input", sys.stdin.readline()))
+			elif kind == "done":
+				sys.stdout.write(msg[1])
+				self._curShortname = msg[2]
+				if self._curShortname != oldname:
+					for w in self.workers:
+						if w is not worker and w.alive: w.send(("current", self._curShortname))
+				return msg[3]
+			elif kind == "exit":
+				raise CommandError("Shard %d stopped while running a command." % (worker.index))
+
+	def do_server(self, line):
+		args = shlex.split(line)
+		if not args:
+			print("Current server is %s" % (self._curShortname))
+			return
+		shortname = self.shortnameMatch(args[0])
+		rest = line.split(None, 1)[1] if len(args) > 1 else ""
+		return self.forward(self.ownerOf(shortname), ("server %s %s" % (shortname, rest)).strip())
+	do_server.__doc__ = TTComCmd.do_server.__doc__
+
+	def do_summary(self, line=""):
+		shortname = self.shortnameMatch(line.strip()) if line.strip() else self._curShortname
+		if not shortname: raise CommandError("No current server has been set.")
+		self.forward(self.ownerOf(shortname), "summary " +shortname)
+	do_summary.__doc__ = TTComCmd.do_summary.__doc__
+
+	def do_refresh(self, line=""):
+		byWorker = OrderedDict((w, []) for w in self.workers)
+		for s in line.split():
+			shortname = self.shortnameMatch(s)
+			byWorker[self.ownerOf(shortname)].append(shortname)
+		for worker,shortnames in byWorker.items():
+			if line.split() and not shortnames: continue
+			self.forward(worker, " ".join(["refresh"] +shortnames))
+	do_refresh.__doc__ = TTComCmd.do_refresh.__doc__
+
+	def gather(self, msg, replyKind):
+		"""Send msg to every running worker and return a list of what their replyKind replies carry.
+		"""
+		workers = [w for w in self.workers if w.alive]
+		seqs = [worker.request(msg) for worker in workers]
+		results = []
+		for worker,seq in zip(workers, seqs):
+			reply = worker.reply(seq, 30)
+			if reply[0] == replyKind: results.append(reply[1])
+			else: print("Shard %d did not answer." % (worker.index))
+		return results
+
+	def summaryData(self, short=False):
+		"""Gather summaryData() from every worker and merge it.
+		"""
+		return mergeSummaries(self.gather(("summary", short), "summary"))
+
+	def findUsers(self, text, prefix=False, limit=None):
+		"""Gather findUsers() from every worker.
+		"""
+		total,rows = 0, []
+		for found in self.gather(("find", text, prefix, limit), "found"):
+			total += found[0]
+			rows.extend(found[1])
+		rows.sort(key=lambda r: (r[0].lower(), r[2].lower(), r[3].lower()))
+		if limit is not None: rows = rows[:limit]
+		return total, rows
+
+	def applyOption(self, opt, val):
+		if opt == "metricsPort":
+			if val.strip() and val.strip() != "0": print("The metrics exporter is not available in sharded mode.")
+			return
+		TTComCmd.applyOption(self, opt, val)
+		for worker in self.workers:
+			if worker.alive: worker.send(("option", opt, val))
+
+	def do_shards(self, line=""):
+		"""List the worker processes and the servers each one handles.
+		"""
+		names = list(conf.servers().keys())
+		tbl = TableFormatter("Shards", ["Shard", "PID", "State", "Servers", "Names"])
+		for w in self.workers:
+			mine = sorted([n for n in names if shardOf(n, self.count) == w.index])
+			tbl.addRow([
+				str(w.index), str(w.process.pid) if w.process else "",
+				"running" if w.alive else "stopped",
+				str(len(mine)), ", ".join(mine)
+			])
+		self.msg(tbl.format(2))
+
+	def do_quit(self, line):
+		if self.daemon and not self.daemon.stopped.is_set():
+			# A control client is leaving; the daemon and its workers stay up for the others.
+			return TTComCmd.do_quit(self, line)
+		self.stopping = True
+		for worker in self.workers:
+			worker.stop()
+		return TTComCmd.do_quit(self, line)
+	do_quit.__doc__ = TTComCmd.do_quit.__doc__
@@ -0,0 +1,188 @@
+# Pluggable audio backends for Sound and SoundPool.
+# Nothing touches the audio device until the first sound is opened.
+#
+# Backends:
+#	bass: sound_lib/BASS output (the default).
+#	null: Accepts and "plays" sounds without producing audio.
+#	file:<path>: Like null, but appends one line per played sound to <path>.
+# The default is taken from the TTCOM_SOUND_BACKEND environment variable if set.
+# If BASS can't be loaded, the null backend is used instead.
+
+import os
+import threading
+import time
+
+
+class SoundError(Exception):
+	"""A backend could not open or control a sound.
+	"""
+	pass
+
+
+class NullStream(object):
+	"""Stream object for backends that produce no audio.
+	Implements the subset of the sound_lib stream interface that Sound uses.
+	Sounds finish as soon as they start, so pools reap them right away.
+	"""
+	def __init__(self, backend, name, freq=44100):
+		self.backend = backend
+		self.name = name
+		self.freq = freq
+		self.looping = False
+		self.volume = 1.0
+		self.pan = 0.0
+		self.is_playing = False
+
+	def get_frequency(self):
+		return self.freq
+
+	def set_frequency(self, freq):
+		self.freq = freq
+		return True
+
+	def set_volume(self, vol):
+		self.volume = vol
+		return True
+
+	def get_pan(self):
+		return self.pan
+
+	def set_pan(self, pan):
+		self.pan = pan
+		return True
+
+	def set_position(self, pos):
+		return True
+
+	def play(self):
+		self.backend.dispatched(self)
+		self.is_playing = self.looping
+		return True
+
+	def stop(self):
+		self.is_playing = False
+		return True
+
+	def pause(self):
+		self.is_playing = False
+		return True
+
+	def resume(self):
+		return self.play()
+
+	def free(self):
+		self.is_playing = False
+
+
+class NullBackend(object):
+	"""Backend that produces no audio but counts what would have played.
+	"""
+	name = "null"
+
+	def __init__(self):
+		self.dispatches = 0
+		self.lastDispatch = 0.0
+
+	def open(self, filename):
+		if not os.path.isfile(filename):
+			raise SoundError("File not found: " +filename)
+		return NullStream(self, filename)
+
+	def openMemory(self, data, name=""):
+		return NullStream(self, name or "<memory>")
+
+	def dispatched(self, stream):
+		"""Called by a stream when it starts playing.
+		"""
+		self.dispatches += 1
+		self.lastDispatch = time.perf_counter()
+
+
+class FileSinkBackend(NullBackend):
+	"""Backend that logs each played sound to a file instead of producing audio.
+	Line format: perf_counter seconds, tab, sound name, tab, volume.
+	"""
+	name = "file"
+
+	def __init__(self, path):
+		NullBackend.__init__(self)
+		self.path = path
+		self._lock = threading.Lock()
+		self._f = open(path, "a", encoding="utf-8")
+
+	def dispatched(self, stream):
+		NullBackend.dispatched(self, stream)
+		with self._lock:
+			self._f.write("%.6f\t%s\t%.3f\n" % (self.lastDispatch, stream.name, stream.volume))
+			self._f.flush()
+
+
+class BassBackend(object):
+	"""Backend using sound_lib (BASS). The output device is opened on first use.
+	"""
+	name = "bass"
+
+	def __init__(self):
+		import sound_lib
+		from sound_lib import output, stream
+		self._main = sound_lib.main
+		self._stream = stream
+		self._output = output
+		self.device = None
+		self._lock = threading.Lock()
+
+	def _init(self):
+		with self._lock:
+			if self.device is None:
+				try: self.device = self._output.Output()
+				except self._main.BassError as e: raise SoundError(str(e))
+
+	def open(self, filename):
+		self._init()
+		try: return self._stream.FileStream(file=filename)
+		except self._main.BassError as e: raise SoundError(str(e))
+
+	def openMemory(self, data, name=""):
+		"""data must be a ctypes buffer that outlives the stream.
+		"""
+		import ctypes
+		self._init()
+		try: return self._stream.FileStream(mem=True, file=ctypes.addressof(data), length=len(data))
+		except self._main.BassError as e: raise SoundError(str(e))
+
+
+_backend = None
+_lock = threading.Lock()
+
+def makeBackend(spec):
+	"""Make a backend from a spec string: "bass", "null", or "file:<path>".
+	"""
+	kind,sep,arg = spec.partition(":")
+	kind = kind.strip().lower()
+	if kind == "bass": return BassBackend()
+	if kind == "null": return NullBackend()
+	if kind == "file":
+		if not arg: raise ValueError("The file sound backend needs a path, e.g., file:sounds.log")
+		return FileSinkBackend(arg)
+	raise ValueError("Unknown sound backend: " +spec)
+
+def getBackend():
+	"""Return the current backend, creating the default one on first use.
+	"""
+	global _backend
+	with _lock:
+		if _backend is None:
+			spec = os.environ.get("TTCOM_SOUND_BACKEND", "bass")
+			try: _backend = makeBackend(spec)
+			except (ImportError, OSError): _backend = NullBackend()
+		return _backend
+
+def setBackend(backend):
+	"""Replace the current backend with a backend object or spec string.
+	Streams already open keep using the backend that opened them.
+	"""
+	global _backend
+	if isinstance(backend, str): backend = makeBackend(backend)
+	with _lock:
+		_backend = backend
+	return backend
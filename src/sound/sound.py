@@ -4,16 +4,15 @@
 
 import os
 import math
-import sound_lib
-from sound_lib import output, stream
+import time
 import ctypes
+from . import backend
 
 
-global generic_output
-generic_output =output.Output()
 class Sound(object):
 	def __init__(self):
 		self.handle = None
+		self.data = None
 		self.freq = 44100
 
 	def load(self, filename=""):
@@ -23,19 +22,25 @@ class Sound(object):
 				return False
 		try:
 			if isinstance(filename, str): # Asume path on disk.
-				self.handle = stream.FileStream(file=filename)
-		except sound_lib.main.BassError:
+				self.handle = backend.getBackend().open(filename)
+		except backend.SoundError:
 			return False
 		self.freq = self.handle.get_frequency()
 		return self.is_active
 
-	def stream(self, data):
+	def stream(self, data, name=""):
 		if self.is_active:
 			self.close()
 		if not data:
 			return False
-		data = ctypes.create_string_buffer(data)
-		self.handle = stream.FileStream(mem=True, file=ctypes.addressof(data), length=len(data))
+		# BASS reads from this buffer while playing, so it must outlive the stream.
+		self.data = ctypes.create_string_buffer(data, len(data))
+		try:
+			self.handle = backend.getBackend().openMemory(self.data, name)
+		except backend.SoundError:
+			self.data = None
+			return False
+		self.freq = self.handle.get_frequency()
 		return self.is_active
 
 	def play(self):
@@ -0,0 +1,95 @@
+# In-memory sound pack cache for SoundPool.
+# Keeps the raw bytes of each sound so playing one does not reopen it from disk.
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class SoundCache(object):
+	"""LRU cache of sound file contents, keyed by file path.
+	The first request for a file in a pack directory preloads every .wav in that directory.
+	maxBytes caps total memory; least recently used sounds are evicted first.
+	"""
+	def __init__(self, maxBytes=16 * 1024 * 1024):
+		self.maxBytes = maxBytes
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self._data = OrderedDict()
+		self._packs = set()
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _key(filename):
+		return os.path.normpath(filename)
+
+	def get(self, filename):
+		"""Return the bytes for filename, loading its pack if needed.
+		Returns None if the file can't be read or is larger than the cache.
+		"""
+		key = self._key(filename)
+		with self._lock:
+			data = self._data.get(key)
+			if data is not None:
+				self._data.move_to_end(key)
+				self.hits += 1
+				return data
+			self.misses += 1
+			pack = os.path.dirname(key)
+			preload = pack not in self._packs
+			if preload: self._packs.add(pack)
+		if preload: self.preload(pack)
+		with self._lock:
+			data = self._data.get(key)
+		if data is None:
+			data = self._read(key)
+			if data is not None: self._store(key, data)
+		return data
+
+	def preload(self, pack):
+		"""Load every .wav file in the pack directory into the cache.
+		"""
+		try: names = sorted(os.listdir(pack))
+		except OSError: return
+		for name in names:
+			if not name.lower().endswith(".wav"): continue
+			key = self._key(os.path.join(pack, name))
+			data = self._read(key)
+			if data is not None: self._store(key, data)
+
+	def invalidate(self, pack=None):
+		"""Drop cached sounds from the given pack directory, or everything if pack is None.
+		"""
+		with self._lock:
+			if pack is None:
+				self._data.clear()
+				self._packs.clear()
+				self.size = 0
+				return
+			pack = self._key(pack)
+			self._packs.discard(pack)
+			for key in [k for k in self._data if os.path.dirname(k) == pack]:
+				self.size -= len(self._data.pop(key))
+
+	def _read(self, key):
+		try:
+			with open(key, "rb") as f:
+				return f.read()
+		except (IOError, OSError):
+			return None
+
+	def _store(self, key, data):
+		"""Add data under key, evicting least recently used entries to stay under maxBytes.
+		"""
+		if len(data) > self.maxBytes: return
+		with self._lock:
+			old = self._data.pop(key, None)
+			if old is not None: self.size -= len(old)
+			self._data[key] = data
+			self.size += len(data)
+			while self.size > self.maxBytes:
+				k,v = self._data.popitem(last=False)
+				self.size -= len(v)
+				self.evictions += 1
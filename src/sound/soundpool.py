@@ -2,7 +2,10 @@
 # Originally written by Blastbay
 # Python port and increased functionality courtesy of Americranian
 
+import threading
+import time
 from . import sound
+from .soundcache import SoundCache
 
 class SoundPoolItem:
 	def __init__(self, filename, **kwargbs):
@@ -17,15 +20,62 @@ class SoundPoolItem:
 		self.stationary = kwargbs.get("stationary", False)
 		self.persistent = kwargbs.get("persistent", False)
 		self.paused = kwargbs.get("paused", False)
+		# Voice slot in the owning SoundPool, or None when not playing from one.
+		self.slot = None
+		self.started = 0.0
+		# True between taking a slot and starting playback, so sweeps leave it alone.
+		self.loading = False
 
 	def reset(self, pack="sounds/"):
+		self.handle.close()
 		self.__init__("")
 
 
 class SoundPool(object):
-	def __init__(self):
-		self.items = []
-		self.clean_frequency = 3
+	"""A fixed number of voice slots for playing sounds.
+	Free slots are kept on a free list, so taking and releasing a voice is O(1).
+	When all voices are busy, the oldest voice that is neither looping nor persistent is stopped and reused.
+	Requests for a sound that started less than coalesce_window seconds ago
+	return the voice already playing it instead of starting another;
+	so a burst of identical join sounds plays once.
+	Finished voices are reaped by a sweep over the busy slots,
+	run at most every sweep_interval seconds or when no slot is free.
+	"""
+	def __init__(self, max_voices=16, coalesce_window=0.15, sweep_interval=0.5):
+		self.max_voices = max_voices
+		self.coalesce_window = coalesce_window
+		self.sweep_interval = sweep_interval
+		self.slots = [None] * max_voices
+		self.free = list(range(max_voices -1, -1, -1))
+		# filename -> item most recently started for it, for coalescing.
+		self.recent = {}
+		self.last_sweep = 0.0
+		self.coalesced = 0
+		self.stolen = 0
+		self.cache = SoundCache()
+		self._lock = threading.RLock()
+
+	def set_max_voices(self, max_voices):
+		"""Change the number of voice slots.
+		Shrinking stops the voices in the slots removed.
+		"""
+		with self._lock:
+			for i in self.slots[max_voices:]:
+				if i: self._release(i)
+			old = len(self.slots)
+			if max_voices < old:
+				del self.slots[max_voices:]
+			else:
+				self.slots.extend([None] * (max_voices -old))
+			self.free = [slot for slot in range(max_voices -1, -1, -1) if self.slots[slot] is None]
+			self.max_voices = max_voices
+
+	@property
+	def items(self):
+		"""The voices currently in use, oldest first.
+		"""
+		with self._lock:
+			return sorted([i for i in self.slots if i], key=lambda i: i.started)
 
 	def play_stationary(self, filename, looping=False, persistent=False):
 		return self.play_stationary_extended(filename, looping, 0, 0, 0, 100, persistent)
@@ -40,26 +90,41 @@ class SoundPool(object):
 		start_pitch,
 		persistent=False,
 	):
-		self.clean_frequency -= 1
-		if self.clean_frequency <= 0:
-			try:
-				self.clean_unused()
-			except:
-				pass
-		s = SoundPoolItem(
-			filename=filename,
-			looping=looping,
-			start_offset=offset,
-			start_pan=start_pan,
-			start_volume=start_volume,
-			start_pitch=start_pitch,
-			persistent=persistent,
-			stationary=True,
-		)
+		now = time.monotonic()
+		with self._lock:
+			if not looping and not persistent:
+				prev = self.recent.get(filename)
+				if (prev is not None and prev.slot is not None
+				and now -prev.started < self.coalesce_window):
+					self.coalesced += 1
+					return prev
+			if now -self.last_sweep >= self.sweep_interval or not self.free:
+				self.clean_unused(now)
+			slot = self._take_slot()
+			if slot is None:
+				return -1
+			s = SoundPoolItem(
+				filename=filename,
+				looping=looping,
+				start_offset=offset,
+				start_pan=start_pan,
+				start_volume=start_volume,
+				start_pitch=start_pitch,
+				persistent=persistent,
+				stationary=True,
+			)
+			s.slot = slot
+			s.started = now
+			s.loading = True
+			self.slots[slot] = s
+			if not looping and not persistent:
+				self.recent[filename] = s
 		try:
-			s.handle.load(filename)
+			data = self.cache.get(filename)
+			if data: s.handle.stream(data, filename)
+			else: s.handle.load(filename)
 		except:
-			s.reset()
+			self.destroy_sound(s)
 			return -1
 		if s.start_offset > 0:
 			s.handle.position = s.start_offset
@@ -72,12 +137,41 @@ class SoundPool(object):
 			s.handle.play_looped()
 		else:
 			s.handle.play()
-		self.items.append(s)
+		s.loading = False
 		return s
 
+	def _take_slot(self):
+		"""Return a free slot index, stealing the oldest stealable voice if none are free.
+		Returns None if every voice is looping, persistent, or still loading.
+		Call with self._lock held.
+		"""
+		if self.free:
+			return self.free.pop()
+		victims = [i for i in self.slots if i and not i.looping and not i.persistent and not i.loading]
+		if not victims:
+			return None
+		victim = min(victims, key=lambda i: i.started)
+		self.stolen += 1
+		self._release(victim)
+		return self.free.pop()
+
+	def _release(self, s):
+		"""Stop and free an item and return its slot to the free list.
+		Call with self._lock held.
+		"""
+		slot = s.slot
+		if slot is not None and self.slots[slot] is s:
+			self.slots[slot] = None
+			self.free.append(slot)
+		if self.recent.get(s.filename) is s:
+			del self.recent[s.filename]
+		s.reset()
+
 	def sound_is_active(self, s):
 		if s.looping == False and s.handle == None:
 			return False
+		if s.looping == False and not s.handle.handle:
+			return False
 		if s.looping == False and not s.handle.handle.is_playing:
 			return False
 		return True
@@ -119,8 +213,9 @@ class SoundPool(object):
 				self.resume_sound(i)
 
 	def destroy_all(self):
-		for i in self.items:
-			i.reset()
+		with self._lock:
+			for i in self.items:
+				self._release(i)
 
 	def update_sound_start_values(self, s, start_pan, start_volume, start_pitch):
 		s.start_pan = start_pan
@@ -136,27 +231,29 @@ class SoundPool(object):
 		return True
 
 	def destroy_sound(self, s):
-		s.reset()
+		with self._lock:
+			self._release(s)
 		return True
 
-	def clean_unused(self):
-		if len(self.items) == 0:
-			return
-		for i in self.items:
-			if i.looping:
-				continue
-			if i.persistent:
-				continue
-			if i.handle.handle == None or not i.handle.handle.is_playing and not i.paused:
-				self.items.remove(i)
-				self.clean_frequency = 3
+	def clean_unused(self, now=None):
+		"""Reap finished voices. Only busy slots are examined.
+		"""
+		with self._lock:
+			self.last_sweep = now if now is not None else time.monotonic()
+			for i in self.slots:
+				if not i:
+					continue
+				if i.looping:
+					continue
+				if i.persistent or i.loading:
+					continue
+				if i.handle.handle == None or not i.handle.handle.is_playing and not i.paused:
+					self._release(i)
 
 	def update_audio_system(self):
 		self.clean_unused()
 
 	def get_source_object(self, filename):
-		if len(self.items) == 0:
-			return None
 		for i in self.items:
 			if i.filename == filename:
 				return i
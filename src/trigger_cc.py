@@ -43,7 +43,7 @@ Examples of what can be done from Trigger methods:
 self.runCommand("system play ...")
 self.server.outputFromEvent("Blah that prints only if server isn't silenced.")
 self.server.errorFromEvent("blah that prints even for silent servers.")
-mycmd_say("Blah") but warning, that might suspend TTCom a while.
+mycmd_say("Blah") (speech is queued, so this returns at once).
 time.sleep(0.5)
 self.server.send[WithWait]("kick userid=%s" % (event.parms.userid))
 (That one can serve to "ban" someone by more than just IP address.)
@@ -69,6 +69,7 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import importlib
+from time import perf_counter_ns
 
 class TriggerBase(object):
 	def __init__(self, server, event, runCommand):
@@ -95,7 +96,10 @@ except NameError:
 	except ImportError:
 		pass
 
-def apply(server, parmline, runCommand):
+def apply(server, parmline, runCommand, timer=None):
+	"""Run custom trigger classes for an event.
+	If timer is passed, it is called as timer(className, elapsedNs) after each class runs.
+	"""
 	# Is there custom code at all?
 	try: customCode
 	except NameError: return
@@ -103,8 +107,18 @@ def apply(server, parmline, runCommand):
 	func = "customCode.Trigger_" +server.shortname
 	try: func = eval(func)
 	except AttributeError: func = None
-	if func: func(server, parmline, runCommand)
+	if func: _run(func, server, parmline, runCommand, timer)
 	# And finally, an all-server Trigger class?
 	try: customCode.Trigger
 	except AttributeError: return
-	customCode.Trigger(server, parmline, runCommand)
+	_run(customCode.Trigger, server, parmline, runCommand, timer)
+
+def _run(cls, server, parmline, runCommand, timer):
+	"""Instantiate one custom trigger class, timing it if requested.
+	"""
+	if not timer:
+		cls(server, parmline, runCommand)
+		return
+	t0 = perf_counter_ns()
+	try: cls(server, parmline, runCommand)
+	finally: timer(cls.__name__, perf_counter_ns() -t0)
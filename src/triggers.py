@@ -19,7 +19,7 @@ with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
 import threading
-from time import sleep
+from time import sleep, perf_counter_ns
 from parmline import ParmLine
 from mplib.mycmd import say as mycmd_say
 from collections import OrderedDict
@@ -42,6 +42,27 @@ class Struct(object):
 		return not self.__eq__(other)
 
 
+class TriggerStats(object):
+	"""Counters for one trigger, match, or custom code class.
+	Times are cumulative nanoseconds from time.perf_counter_ns().
+	"""
+	__slots__ = ("evals", "hits", "matchNs", "actionNs")
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.evals = 0
+		self.hits = 0
+		self.matchNs = 0
+		self.actionNs = 0
+
+	def cost(self):
+		"""Total time spent on this item in nanoseconds.
+		"""
+		return self.matchNs +self.actionNs
+
+
 class Trigger(object):
 	"""Match/action triggers for a server.
 	All objects in this class are created by Triggers objects.
@@ -53,6 +74,9 @@ class Trigger(object):
 		self.name = name
 		self.matches = OrderedDict()
 		self.actions = OrderedDict()
+		# Profiling counters; kept out of matches so equality checks ignore them.
+		self.stats = TriggerStats()
+		self.matchStats = OrderedDict()
 
 	def __hash__(self):
 		"""For sets.
@@ -84,6 +108,7 @@ class Trigger(object):
 		match.value = matchSpec
 		# This allows replacements by exact name match.
 		self.matches[matchName] = match
+		self.matchStats[matchName] = TriggerStats()
 
 	def addAction(self, actionSpec, actionName=""):
 		"""Add one action to this trigger.
@@ -99,9 +124,21 @@ class Trigger(object):
 
 	def apply(self, parmline):
 		"""Apply actions if and only if there is a match.
+		Updates self.stats and self.matchStats as it goes.
 		"""
+		stats = self.stats
+		stats.evals += 1
 		for match in self.matches.values():
-			if not self._isMatch(match, parmline): continue
+			mstats = self.matchStats[match.name]
+			t0 = perf_counter_ns()
+			isMatch = self._isMatch(match, parmline)
+			t1 = perf_counter_ns()
+			mstats.evals += 1
+			mstats.matchNs += t1 -t0
+			stats.matchNs += t1 -t0
+			if not isMatch: continue
+			mstats.hits += 1
+			stats.hits += 1
 			uinfo = ""
 			if parmline.parms.get("userid"):
 				uinfo = " (userid %s)" % (parmline.parms.userid)
@@ -119,9 +156,19 @@ class Trigger(object):
 				actionData.match = match
 				actionData.action = action
 				self._doAction(actionData)
+			t2 = perf_counter_ns()
+			mstats.actionNs += t2 -t1
+			stats.actionNs += t2 -t1
 			return True
 		return False
 
+	def resetStats(self):
+		"""Zero the profiling counters for this trigger and its matches.
+		"""
+		self.stats.reset()
+		for mstats in self.matchStats.values():
+			mstats.reset()
+
 	def _isMatch(self, match, eventline):
 		"""Return True on a match.
 		match is a name,value struct where value is a
@@ -254,6 +301,8 @@ class Triggers(object):
 		self.triggers = OrderedDict()
 		self.thr = None
 		self._q = []
+		# Profiling counters for ttcom_triggers classes, by class name.
+		self.customStats = OrderedDict()
 
 	def __hash__(self):
 		"""For sets.
@@ -296,6 +345,20 @@ class Triggers(object):
 		trigger = self.get(triggerName)
 		trigger.addAction(actionSpec, actionName)
 
+	def addConfigLine(self, key, value):
+		"""Add a "match name.sub" or "action name.sub" configuration line.
+		Returns False, adding nothing, if key names neither.
+		"""
+		if not (key.lower().startswith("match ") or key.lower().startswith("action ")):
+			return False
+		which,what = key.split(None, 1)
+		triggerName,sep,subname = what.partition(".")
+		if which.lower() == "match":
+			self.addMatch(triggerName, ParmLine(value), subname)
+		else:  # action
+			self.addAction(triggerName, value, subname)
+		return True
+
 	def apply(self, parmline):
 		"""Apply actions where there is a match.
 		As many match/action sets as match will have their actions applied.
@@ -303,7 +366,41 @@ class Triggers(object):
 		# config file triggers first.
 		[trigger.apply(parmline) for trigger in self.triggers.values()]
 		# Then custom code triggers if any.
-		trigger_cc.apply(self.server, parmline, self.runCommand)
+		trigger_cc.apply(self.server, parmline, self.runCommand, self._recordCustom)
+
+	def _recordCustom(self, className, elapsedNs):
+		"""Record one run of a custom code trigger class.
+		Called by trigger_cc.apply().
+		Matching and actions are not separable in custom code,
+		so all of the time counts as action time.
+		"""
+		stats = self.customStats.get(className)
+		if stats is None:
+			stats = self.customStats[className] = TriggerStats()
+		stats.evals += 1
+		stats.hits += 1
+		stats.actionNs += elapsedNs
+
+	def statRows(self):
+		"""Return (triggerName, matchName, TriggerStats) tuples for everything profiled here.
+		matchName is "" for whole-trigger totals.
+		Custom code classes are named like "ttcom_triggers.Trigger_srv".
+		"""
+		rows = []
+		for trigger in self.triggers.values():
+			rows.append((trigger.name, "", trigger.stats))
+			for matchName,mstats in trigger.matchStats.items():
+				rows.append((trigger.name, matchName, mstats))
+		for className,stats in self.customStats.items():
+			rows.append(("ttcom_triggers." +className, "", stats))
+		return rows
+
+	def resetStats(self):
+		"""Zero all profiling counters for this server's triggers.
+		"""
+		for trigger in self.triggers.values():
+			trigger.resetStats()
+		self.customStats.clear()
 
 	@classmethod
 	def loadCustomCode(cls):
@@ -319,6 +416,7 @@ class Triggers(object):
 			thr = threading.Thread(target=self._queueWatch)
 			thr.daemon = True
 			thr.start()
+			self.thr = thr
 
 	def _queueWatch(self):
 		"""Watch the queue for things to do.
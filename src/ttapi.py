@@ -25,6 +25,11 @@ import threading
 from tt_attrdict import AttrDict
 from parmline import ParmLine
 from conf import conf
+from connmgr import Backoff, PingTracker, reconnects
+from framing import LineReader, LineWriter
+import perfstats
+from userindex import userIndex
+from ngrams import NgramIndex
 
 from mplib import log
 from sound import soundpool
@@ -115,12 +120,19 @@ class TeamTalkServerConnection(object):
 		self.shuttingDown = False
 		self.sock = None
 		self.sockfile = None
+		self.outbound = None
 		self.welcomeParms = None
 		self.userid = None
 		self.usertimeout = None
 		self.disconnectReason = ""
 		self.threads = {}
 		self.curid = None
+		# Keepalive round trips; see checkLink().
+		self.pings = PingTracker()
+		self.pingInterval = None
+		self.linkWarning = ""
+		# The pinger and watcher threads both call checkLink().
+		self.linkLock = threading.Lock()
 
 	def __del__(self):
 		"""Called when this object is garbage-collected.
@@ -198,7 +210,7 @@ class TeamTalkServerConnection(object):
 		if self.encrypted:
 			ssock = self.SSLContext.wrap_socket(self.sock, server_hostname=self.host)
 			self.sock = ssock
-		self.sockfile = self.sock.makefile("r", encoding="utf-8")
+		self.sockfile = LineReader(self.sock)
 		# Signal connection.
 		self.state = "notifyConnect"
 		self.notifyCaller('_connected_ ipaddr="{0}" tcpport={1}'.format(*self.sock.getpeername()))
@@ -207,6 +219,9 @@ class TeamTalkServerConnection(object):
 			self.state = "welcomeWait"
 			self.sock.settimeout(20)
 			welcomeLine = self.sockfile.readline()
+			if welcomeLine is None:
+				raise IOError("Connection closed before welcome line")
+			welcomeLine = welcomeLine.decode("utf-8", "replace")
 			self.state = "notifyWelcome"
 			if welcomeLine.startswith("teamtalk "):
 				welcomeLine = "welcome " +welcomeLine[9:]
@@ -220,12 +235,16 @@ class TeamTalkServerConnection(object):
 			self.userid = welcomeLine.parms.userid
 			self.usertimeout = int(welcomeLine.parms.usertimeout)
 			self.protocol = welcomeLine.parms.protocol
+			# No timeouts after connect so packets don't split up.
+			# This must precede starting the threads, since changing the timeout during a read
+			# can make that read fail with EAGAIN.
+			self.sock.settimeout(None)
 			self.state = "makeThreads"
+			self.outbound = LineWriter(self.sock, onError=self.disconnect)
+			self.newThread(self.sender)
 			self.newThread(self.watcher)
 			self.newThread(self.pinger)
 			self.state = "connected"
-			# No timeouts after connect so packets don't split up.
-			self.sock.settimeout(None)
 		except Exception as e:
 			self.state = "disconnecting"
 			self.disconnect()
@@ -240,6 +259,7 @@ class TeamTalkServerConnection(object):
 		disconnectReason instance variable for examination by the
 		object's creator after a disconnect.
 		"""
+		if self.outbound: self.outbound.close()
 		if not self.callback: return
 		self.disconnectReason = reason
 		self.notifyCaller("_disconnected_")
@@ -252,18 +272,33 @@ class TeamTalkServerConnection(object):
 		This runs in its own thread.
 		"""
 		while not self.threadEnding():
-			try: self.sock.send(b"ping\r\n")
-			except socket.error as e:
-				self.disconnect("Error during ping: %s" % (str(e)))
-				return
+			self.checkLink()
+			self.pings.sent()
+			# A failed send has already disconnected.
+			if not self.outbound.write(b"ping\r\n"): return
 			pingtime = float(self.usertimeout)
 			# 0.5 sec for very short usertimeouts, 3/4 of usertimeout otherwise.
 			# 0.3 works for timeout=0, which stock tt clients can't handle!
 			if pingtime < 1: pingtime = 0.3
 			elif pingtime < 1.5: pingtime = 0.5
 			else: pingtime *= 0.75
+			self.pingInterval = pingtime
 			time.sleep(pingtime)
 
+	def checkLink(self):
+		"""Tell the parent once when ping round trips or unanswered pings suggest the link is failing,
+		and once when it recovers. The description is kept in linkWarning.
+		"""
+		if not self.pingInterval: return
+		with self.linkLock:
+			warning = self.pings.health(self.pingInterval)
+			wasWarning = self.linkWarning
+			self.linkWarning = warning
+			if bool(warning) == bool(wasWarning) or not hasattr(self.parent, "outputFromEvent"): return
+			if warning: text = "Link may be failing: %s" % (warning)
+			else: text = "Link recovered: %s" % (self.pings.summary())
+		self.parent.outputFromEvent(text)
+
 	def _isConnected(self):
 		"""Returns True if this stream appears to be connected.
 		There might be a better way to write this.
@@ -274,32 +309,39 @@ class TeamTalkServerConnection(object):
 		except: pass
 		return (fileno is not None)
 
+	# First bytes of the lines watcher() must examine: pong, begin, and end.
+	markerStarts = frozenset([b"p", b"P", b"b", b"B", b"e", b"E"])
+
 	def watcher(self):
 		"""Handles all inbound text.
 		Eats pongs that answer pings sent by this object.
+		Lines are checked for pongs and begin/end markers as bytes,
+		and only decoded when passed on.
 		Runs as its own thread.
 		"""
 		err = None
 		try:
-			for line in self.sockfile:
-				if not line:
-					# This probably won't happen; EOF should end the loop.
-					self.disconnect("EOF encountered during read")
+			for bline in self.sockfile:
+				if self.threadEnding():
+					self.disconnect("Shutting down")
 					return
+				if bline[:1] in self.markerStarts:
+					ll = bline.rstrip().lower()
+					if ll == b"pong":
+						# Pongs sent as part of a user command should be in an id block.
+						if not self.curid:
+							rtt = self.pings.answered()
+							# Only a warning to clear or a slow round trip can change link health here.
+							if self.linkWarning or (rtt and rtt > self.pings.slowFloor): self.checkLink()
+							continue
+					elif ll.startswith(b"begin id="):
+						self.curid = ll[9:].decode("utf-8", "replace")
+					elif ll.startswith(b"end id="):
+						self.curid = None
+				line = bline.decode("utf-8", "replace")
 				if line.startswith("teamtalk "):
 					# TeamTalk 5 protocol starts with this instead of welcome.
 					line = "welcome " +line[9:]
-				if self.threadEnding():
-					self.disconnect("Shutting down")
-					return
-				ll = line.rstrip().lower()
-				if ll.startswith("begin id="):
-					self.curid = ll.split("=")[1]
-				elif ll.startswith("end id="):
-					self.curid = None
-				elif not self.curid and ll == "pong":
-					# Pongs sent as part of a user command should be in an id block.
-					continue
 				self.notifyCaller(line)
 		except IOError as e:
 			err = e
@@ -309,19 +351,113 @@ class TeamTalkServerConnection(object):
 		else:
 			self.disconnect("EOF during read")
 
+	def sender(self):
+		"""Sends queued outbound lines; see framing.LineWriter.
+		Runs as its own thread.
+		"""
+		self.outbound.run()
+
 	def send(self, line):
 		"""Send a command to this server.
 		line is a plain text line without line ending.
-		Returns True on success and False on error.
-		disconnect() is called on an IOError.
+		The line is queued and sent whole by the sender thread.
+		Returns True on success and False if the connection is down.
+		A send error calls disconnect().
 		"""
-		line = str(line).rstrip() +"\r\n"
-		bline = line.encode("utf-8")
-		try: self.sock.send(bline)
-		except IOError:
-			self.disconnect("Error during send")
+		return self.sendLines([line])
+
+	def sendLines(self, lines):
+		"""Send several commands, as for send(), coalesced into as few writes as possible.
+		Waits for room when much is already queued.
+		"""
+		if not self.outbound:
+			self.disconnect("Error during send: not connected")
 			return False
-		return True
+		return self.outbound.writeLines([(str(line).rstrip() +"\r\n").encode("utf-8") for line in lines])
+
+
+class TrackedDict(dict):
+	"""A server's users, channels, or files, remembering which keys were reached since the last snapshot.
+	Event handlers change entries in place, so any entry reached by key counts as possibly changed,
+	and StateSnapshot recopies only those.
+	"""
+	def __init__(self, *args):
+		dict.__init__(self, *args)
+		self.dirty = set()
+		# Set when so many keys were touched that a full copy is cheaper to track.
+		self.whole = False
+
+	def _touch(self, k):
+		dirty = self.dirty
+		dirty.add(k)
+		if len(dirty) > 1000 and len(dirty) > 2 * len(self):
+			self.whole = True
+			dirty.clear()
+
+	def __getitem__(self, k):
+		self._touch(k)
+		return dict.__getitem__(self, k)
+
+	def __setitem__(self, k, v):
+		self._touch(k)
+		dict.__setitem__(self, k, v)
+
+	def __delitem__(self, k):
+		self._touch(k)
+		dict.__delitem__(self, k)
+
+	def get(self, k, d=None):
+		self._touch(k)
+		return dict.get(self, k, d)
+
+	def setdefault(self, k, d=None):
+		self._touch(k)
+		return dict.setdefault(self, k, d)
+
+	def pop(self, k, *d):
+		self._touch(k)
+		return dict.pop(self, k, *d)
+
+
+def copyEntries(src, prevCopy=None, prevSrc=None):
+	"""Return a dict of copies of src's entries, made with stateLock held.
+	If prevCopy was made from this same TrackedDict, only touched entries are copied again;
+	the rest are shared with prevCopy.
+	"""
+	dirty = getattr(src, "dirty", None)
+	if dirty is None or prevCopy is None or src is not prevSrc or src.whole:
+		if dirty is not None:
+			src.dirty = set()
+			src.whole = False
+		return dict((k, AttrDict(v)) for k,v in dict.items(src))
+	# Readers may still touch keys outside the lock; those touches change nothing.
+	keys = list(dirty)
+	src.dirty = set()
+	copy = dict(prevCopy)
+	for k in keys:
+		v = dict.get(src, k)
+		if v is None: copy.pop(k, None)
+		else: copy[k] = AttrDict(v)
+	return copy
+
+
+class StateSnapshot(object):
+	"""Copies of a server's users, channels, and files as they stood between two events.
+	Each user, channel, and file is copied too, so later events do not change a snapshot.
+	Given the previous snapshot, entries no event touched since are shared with it rather than copied.
+	Treat snapshots as read-only; they are shared by everyone who asks for one before the next event.
+	"""
+	def __init__(self, server, prev=None):
+		self.version = server.stateVersion
+		self.sources = (server.users, server.channels, server.files)
+		if server.me and isinstance(server.users, TrackedDict):
+			# self.me is changed without going through users.
+			server.users.dirty.add(server.me.userid)
+		prevs = prev.sources if prev else (None, None, None)
+		self.users = copyEntries(server.users, prev and prev.users, prevs[0])
+		self.channels = copyEntries(server.channels, prev and prev.channels, prevs[1])
+		self.files = copyEntries(server.files, prev and prev.files, prevs[2])
+		self.me = self.users.get(server.me.userid) if server.me else None
 
 
 class TeamtalkServer(object):
@@ -330,6 +466,8 @@ class TeamtalkServer(object):
 	and processLine() handles incoming lines from the server.
 	processLine also dispatches incoming events (each line is an
 	event) to the various event_*() methods in this class.
+	Event methods change users, channels, and files while holding stateLock;
+	other threads should read them through snapshot() rather than iterate them directly.
 	"""
 
 	def _getState(self): return self._state()
@@ -346,6 +484,21 @@ class TeamtalkServer(object):
 		self.lastError = None
 		self.curID = 0
 		self.waitID = 0
+		# Held while users, channels, and files change; stateVersion counts the changes.
+		self.stateLock = threading.RLock()
+		self.stateVersion = 0
+		self._snapshot = None
+		# Set by readers that found the snapshot stale while an event was being handled;
+		# the event thread then makes one as it finishes and notifies snapshotReady.
+		self._snapshotWanted = False
+		self.snapshotReady = threading.Condition()
+		# Event processing timings; see processLine().
+		self.perf = perfstats.ServerPerf()
+		# perf_counter_ns() time of the latest inbound line, or None.
+		self.lastEventNs = None
+		# Automatic reconnect counts, kept by connmgr.reconnects.
+		self.reconnectAttempts = 0
+		self.reconnectFailures = 0
 		self.soundsdir = "default"
 		self.sound_volume=0
 		self.play_sounds = 0
@@ -372,9 +525,24 @@ class TeamtalkServer(object):
 		self.loginParms = parms
 		self.disconnect()
 
+	@staticmethod
+	def soundPack(soundsdir):
+		"""Return the directory path of the named sound pack.
+		"""
+		return "sounds/" +soundsdir
+
+	def changeSoundsdir(self, soundsdir):
+		"""Switch this server to another sound pack.
+		Cached sounds for the old and new packs are dropped so the new one is read fresh from disk.
+		"""
+		if soundsdir == self.soundsdir: return
+		pool.cache.invalidate(self.soundPack(self.soundsdir))
+		pool.cache.invalidate(self.soundPack(soundsdir))
+		self.soundsdir = soundsdir
+
 	def play(self,soundname):
 		if self.play_sounds==1:
-			pool.play_stationary_extended("sounds/"+self.soundsdir+"/"+soundname,False,0,0,self.sound_volume,100)
+			pool.play_stationary_extended(self.soundPack(self.soundsdir)+"/"+soundname,False,0,0,self.sound_volume,100)
 
 	def clear(self):
 		"""Clear this object (on init or disconnect).
@@ -386,10 +554,14 @@ class TeamtalkServer(object):
 		self.ev_loggedOut.clear()
 		self.state = "disconnected"
 		self.info = AttrDict()
-		self.channels = dict()
-		self.users = dict()
-		self.files = dict()
-		self.me = None
+		with self.stateLock:
+			self.channels = TrackedDict()
+			self.users = TrackedDict()
+			self.files = TrackedDict()
+			self.me = None
+			self.stateVersion += 1
+			self.clearIndexes()
+			userIndex.removeServer(self)
 
 	def disconnect(self):
 		"""Disconnect from server and clean up.
@@ -403,14 +575,16 @@ class TeamtalkServer(object):
 		"""Called to destroy this object.
 		"""
 		self.autoLogin = 0
+		reconnects.cancel(self)
 		self.disconnect()
 
 	def connect(self, retry=False):
 		"""Connect to the server.
 		Returns True if there is a connection on exit and False if not.
 		If retry is True, tries until successful.
-		The pause between retries is 10 seconds.
+		The pause between retries starts at 2 seconds and doubles up to a minute, with jitter.
 		"""
+		backoff = Backoff()
 		while True:
 			if self.conn:
 				if self.conn.threadEnding():
@@ -427,7 +601,7 @@ class TeamtalkServer(object):
 				self.state = "disconnected"
 				self.conn = None
 				if retry:
-					time.sleep(10)
+					time.sleep(backoff.next())
 					continue
 				return False
 			self.state = "connected"
@@ -491,9 +665,14 @@ class TeamtalkServer(object):
 		then dispatches the event to a method named event_<eventname>.
 		If no such method exists for an event, handles this condition.
 		"""
+		perf = time.perf_counter_ns
+		record = self.perf.record
+		tStart = self.lastEventNs = perf()
 		parmline = ParmLine(line)
+		tParsed = perf()
 		# When collecting text, don't dispatch events.
 		if self._handleCollection(parmline):
+			record("(collected)", "parse", tParsed -tStart)
 			return
 		# When we internally set an id and this is a start/end-block
 		# line for it, don't call hookEvents for it.
@@ -503,6 +682,7 @@ class TeamtalkServer(object):
 		)
 		if not isOurBlockMarker:
 			self.hookEvents(parmline, False)
+		tHooked = perf()
 		# Protect from rogue transmissions, or somebody could execute random code here.
 		# This would require a custom TeamTalk server though.
 		# This check makes sure nothing but underscores and letters
@@ -514,25 +694,170 @@ class TeamtalkServer(object):
 		except:
 			self.errorFromEvent("Unrecognized line:  %s" % (line))
 			return
+		# Timings are only recorded for recognized events, so a server cannot grow the table without bound.
+		event = parmline.event
+		record(event, "parse", tParsed -tStart)
+		if not isOurBlockMarker:
+			record(event, "hookPre", tHooked -tParsed)
+		dispatch = perfstats.dispatch
+		dispatch.server,dispatch.outputNs = self, 0
+		tDispatch = perf()
 		try:
-			if not eventFunc(parmline.parms):
+			with self.stateLock:
+				handled = eventFunc(parmline.parms)
+				self.stateVersion += 1
+				self.indexEvent(event, parmline.parms)
+				wanted = self._snapshotWanted
+				if wanted:
+					self._snapshotWanted = False
+					self._makeSnapshot()
+			if wanted:
+				with self.snapshotReady: self.snapshotReady.notify_all()
+			if not handled:
 				self.outputFromEvent(line.rstrip())
 		except Exception as e:
 			self.errorFromEvent("Event dispatch failure: %s" % (line))
 			raise
 		finally:
+			tHandled = perf()
+			outputNs = dispatch.outputNs
+			dispatch.server = None
+			record(event, "handler", tHandled -tDispatch -outputNs)
+			if outputNs:
+				record(event, "output", outputNs)
 			if not isOurBlockMarker:
 				self.hookEvents(parmline, True)
+				record(event, "hookPost", perf() -tHandled)
+			record(event, "total", perf() -tStart)
+
+	def snapshot(self):
+		"""Return a StateSnapshot of users, channels, and files.
+		A snapshot is made at most once per event, so reads between events cost nothing.
+		Only entries changed since the last snapshot are copied. While an event is being handled,
+		readers do not queue for stateLock but wait for the event thread to make the snapshot as it finishes.
+		"""
+		while True:
+			snap = self._snapshot
+			if snap and snap.version == self.stateVersion: return snap
+			if self.stateLock.acquire(False):
+				try: return self._makeSnapshot()
+				finally: self.stateLock.release()
+			with self.snapshotReady:
+				self._snapshotWanted = True
+				snap = self._snapshot
+				if snap and snap.version == self.stateVersion: return snap
+				# The timeout covers an event that finished just before the request was seen.
+				self.snapshotReady.wait(0.05)
+
+	def _makeSnapshot(self):
+		"""Make and return a current snapshot. Called with stateLock held.
+		"""
+		snap = self._snapshot
+		if snap and snap.version == self.stateVersion: return snap
+		snap = self._snapshot = StateSnapshot(self, snap)
+		return snap
+
+	# Events that can add, change, or remove a user or channel.
+	userEvents = ("welcome", "loggedin", "loggedout", "adduser", "removeuser", "updateuser")
+	channelEvents = ("addchannel", "updatechannel", "removechannel")
+
+	def clearIndexes(self):
+		"""Empty this server's name indexes. Called with stateLock held.
+		userNames holds nonEmptyNickname(user, True) by userid;
+		channelPaths holds channelname() and channelNames its last component, by chanid.
+		"""
+		self.userNames = NgramIndex()
+		self.channelPaths = NgramIndex()
+		self.channelNames = NgramIndex()
+		# Userids and chanids changed since the indexes were last brought up to date; see flushIndexes().
+		self.pendingUsers = set()
+		self.pendingChannels = set()
+
+	def indexEvent(self, event, parms):
+		"""Note what an event may have changed for the search indexes. Called with stateLock held.
+		The indexes are brought up to date when next searched, so a login's flood of events costs little here.
+		"""
+		if event in self.channelEvents:
+			if event == "updatechannel":
+				# A rename changes the paths of the channel's subchannels too.
+				self.pendingChannels.update(dict.keys(self.channels))
+			self.pendingChannels.add(parms.chanid)
+			return
+		if event not in self.userEvents: return
+		userid = parms.get("userid")
+		if not userid:
+			# This user logged out, which empties the user and channel lists.
+			self.clearIndexes()
+			userIndex.removeServer(self)
+			for userid in dict.keys(self.users):
+				self.pendingUsers.add(userid)
+				userIndex.touch(self, userid)
+			return
+		self.pendingUsers.add(userid)
+		userIndex.touch(self, userid)
+		pending = len(self.pendingUsers)
+		if pending > 1000 and pending > 2 * len(self.users):
+			# Mostly users already gone; don't let them pile up when nobody searches.
+			self.flushIndexes()
+
+	def flushIndexes(self):
+		"""Index the users and channels changed since the last flush. Called with stateLock held.
+		"""
+		for userid in self.pendingUsers: self.indexUser(userid)
+		self.pendingUsers.clear()
+		for chanid in self.pendingChannels: self.indexChannel(chanid)
+		self.pendingChannels.clear()
+
+	def indexUser(self, userid):
+		user = dict.get(self.users, userid)
+		if user: self.userNames.set(userid, self.nonEmptyNickname(user, True))
+		else: self.userNames.remove(userid)
+
+	def indexChannel(self, chanid):
+		path = None
+		if chanid in self.channels:
+			# A TT5 path is built from parents, which may not have arrived yet.
+			try: path = self.channelname(chanid)
+			except KeyError: pass
+		if path is not None:
+			self.channelPaths.set(chanid, path)
+			self.channelNames.set(chanid, path[:-1].rpartition("/")[2])
+		else:
+			self.channelPaths.remove(chanid)
+			self.channelNames.remove(chanid)
+
+	def matchUsers(self, text):
+		"""Return copies of the users whose nonEmptyNickname(user, True) contains text, ignoring case.
+		"""
+		with self.stateLock:
+			self.flushIndexes()
+			users = self.users
+			return [AttrDict(dict.get(users, userid)) for userid in self.userNames.search(text) if userid in users]
+
+	def matchChannels(self, text, fullPath=True):
+		"""Return copies of the channels whose channelname() contains text, ignoring case;
+		with fullPath=False, whose last path component does.
+		"""
+		with self.stateLock:
+			self.flushIndexes()
+			index = self.channelPaths if fullPath else self.channelNames
+			channels = self.channels
+			return [AttrDict(dict.get(channels, chanid)) for chanid in index.search(text) if chanid in channels]
+
+	def _chargeOutput(self, tStart):
+		"""Charge output time since tStart to the event this thread is dispatching for this server, if any.
+		"""
+		dispatch = perfstats.dispatch
+		if getattr(dispatch, "server", None) is self:
+			dispatch.outputNs += time.perf_counter_ns() -tStart
 
 	def _handleRecycling(self, force=False):
 		"""Handle autoLogin-on-logout as appropriate.
+		The attempt is timed and limited by the reconnect scheduler (see connmgr).
 		"""
 		if force or (self.autoLogin and not self.manualCM):
 			self.outputFromEvent("Reconnecting")
-			task = lambda: self.login(True)
-			th = threading.Timer(5, task)
-			th.setDaemon(True)
-			th.start()
+			reconnects.schedule(self, force)
 
 	def _handleCollection(self, parmline):
 		"""Manages the process of collecting a command response.
@@ -766,36 +1091,44 @@ class TeamtalkServer(object):
 	def outputFromEvent(self, line, raw=False):
 		"""For event output. See output() for details.
 		"""
+		tStart = time.perf_counter_ns()
 		log.log("ttcom",self.shortname+": "+line)
 		log.log(self.shortname,line)
 		self.output(line, raw, fromEvent=True)
+		self._chargeOutput(tStart)
 
 	def errorFromEvent(self, line, raw=False):
 		"""For event error output. See output() for details.
 		"""
+		tStart = time.perf_counter_ns()
 		self.output(line, raw, fromEvent=True)
+		self._chargeOutput(tStart)
 
 	def summarizeChannels(self):
 		"""Summarize who is where on this server.
 		This current user is omitted.
 		"""
+		self.output(self.channelSummary())
+
+	def channelSummary(self):
+		"""Return the text summarizeChannels() prints, without the server name.
+		"""
 		if self.state != "loggedIn":
 			state = self.state
 			if self.conn and self.conn.state and self.conn.state != self.state:
 				state += "/" +self.conn.state
-			self.output(state)
-			return
-		users = [u for u in self.users.values() if u.userid != self.me.userid]
+			return state
+		snap = self.snapshot()
+		users = [u for u in snap.users.values() if u.userid != self.me.userid]
 		if not len(users):
-			self.output("No users are connected.")
-			return
+			return "No users are connected."
 		activeChannels = {}
 		for user in users:
 			channel = user.get("channel")
 			if channel is None:
 				cid = user.get("chanid")
 				# ToDo: The next line threw a KeyError once, Jan 29 2019, on Laura's server.
-				if cid: channel = self.channels[cid].channel
+				if cid: channel = snap.channels[cid].channel
 			if not channel: channel = ""
 			activeChannels.setdefault(channel, [])
 			activeChannels[channel].append(self.nonEmptyNickname(user, shortenFacebook=True))
@@ -819,8 +1152,17 @@ class TeamtalkServer(object):
 					n,
 					", ".join(people)
 				))
-		lines.insert(0, "Users %d, active channels %d:" % (nusers, nchannels))
-		self.output("\n".join(lines))
+		lines.insert(0, "Users %d, active channels %d%s:" % (nusers, nchannels, self.linkSummary()))
+		return "\n".join(lines)
+
+	def linkSummary(self):
+		"""Return ping round trip information for summaries, starting with a comma, or "".
+		"""
+		if not self.conn: return ""
+		buf = self.conn.pings.summary()
+		if self.conn.linkWarning: buf += "; link may be failing: " +self.conn.linkWarning
+		if not buf: return ""
+		return ", " +buf
 
 	def summarizeVersions(self, proto=None):
 		"""Summarize users by TeamTalk packet protocol, client name, and client version on this server.
@@ -833,7 +1175,7 @@ class TeamtalkServer(object):
 				state += "/" +self.conn.state
 			self.output(state)
 			return
-		users = [u for u in self.users.values() if u.userid != self.me.userid]
+		users = [u for u in self.snapshot().users.values() if u.userid != self.me.userid]
 		if not len(users):
 			self.output("No users are connected.")
 			return
@@ -1462,8 +1804,8 @@ class TeamtalkServer(object):
 			# This is a logout of this user.
 			self.outputFromEvent("You are logged out")
 			self.state = "connected"
-			self.channels = dict()
-			self.users = dict()
+			self.channels = TrackedDict()
+			self.users = TrackedDict()
 			userid = self.info.userid
 			self.users.setdefault(userid, AttrDict())
 			self.me = self.users[userid]
@@ -29,15 +29,44 @@ if __name__ == "__main__":
 	del sys.argv[1:]
 	noAutoLogins = False
 	shortnames = []
-	for arg in args:
+	mode = ""
+	shardCount = 1
+	while args:
+		arg = args.pop(0)
 		if arg == "-n":
 			noAutoLogins = True
+		elif arg in ["-d", "-c"]:
+			# Daemon or client of a daemon; see ttdaemon.py.
+			mode = arg
+		elif arg.startswith("-j"):
+			# Sharded mode; see shards.py.
+			n = arg[2:] or (args.pop(0) if args else "")
+			try: shardCount = int(n) or os.cpu_count() or 1
+			except ValueError: sys.exit("-j needs a number of worker processes, or 0 for one per CPU core")
 		else:
 			noAutoLogins = True
 			shortnames.append(arg)
-	app = TTComCmd(noAutoLogins, shortnames)
+	controlSocket = conf.option("controlSocket") or "ttcom.sock"
+	if mode == "-c":
+		import ttdaemon
+		ttdaemon.runClient(controlSocket)
+		sys.exit(0)
+	if shardCount > 1:
+		from shards import ShardRouter
+		app = ShardRouter(noAutoLogins, shortnames, shardCount)
+	else:
+		app = TTComCmd(noAutoLogins, shortnames)
 	app.allowPython()
 	if shortnames:
 		cur = shortnames[-1]
 		app.onecmd("server " +cur)
+	if mode == "-d":
+		import ttdaemon
+		app.plat = app._getPlatform()
+		try: daemon = ttdaemon.ControlDaemon(app, controlSocket).start()
+		except OSError as e: sys.exit("Cannot start the daemon: %s" % (str(e)))
+		print("Listening on %s" % (daemon.path))
+		daemon.serve()
+		app.do_quit("")
+		sys.exit(0)
 	app.run()
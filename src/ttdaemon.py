@@ -0,0 +1,379 @@
+"""Headless TTCom: one process holds the server connections and serves commands over a Unix domain socket.
+
+Start the daemon with "ttcom.py -d" and connect a frontend with "ttcom.py -c".
+The socket is the controlSocket option, ttcom.sock by default, and only its owner may connect.
+Any number of clients may connect at once. Each has its own current server and its own output:
+a command's output, including selection and confirmation prompts, goes only to the client that sent it.
+Commands run one at a time, and a prompt left unanswered for two minutes cancels its command.
+Events are pushed to every client that has not turned them off;
+a client too slow to take them loses events rather than delaying the others.
+
+A client's first line chooses its framing.
+Line framing: send command lines; output comes back as text. Control lines:
+	/events on, /events off: Start or stop receiving events.
+	/shutdown: Stop the daemon.
+	quit or exit: Disconnect this client.
+JSON framing, chosen by a first line starting with "{": one JSON object per line each way.
+	From the client: {"cmd": "summary", "id": 1}, {"input": "2"} to answer a prompt,
+		{"events": false}, {"shutdown": true}.
+	From the daemon: {"type": "output", "id": 1, "text": "..."}, {"type": "prompt", "id": 1, "text": "..."},
+		{"type": "done", "id": 1}, {"type": "event", "text": "..."}, {"type": "error", "text": "..."}.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import json, os, socket, sys
+import threading
+from collections import deque
+from framing import LineReader, LineWriter
+
+# The control client whose command the current thread is running, if any.
+local = threading.local()
+
+
+class ControlClient(object):
+	"""One connected frontend.
+	"""
+	# Events are dropped for a client with more than this many bytes waiting to be sent.
+	maxEventBacklog = 262144
+	# Seconds a prompt waits for an answer before the command is canceled.
+	promptTimeout = 120
+
+	def __init__(self, daemon, sock, number):
+		self.daemon = daemon
+		self.sock = sock
+		self.name = "control%d" % (number)
+		self.reader = LineReader(sock, 4096)
+		self.writer = LineWriter(sock)
+		self.framed = False
+		self.json = False
+		self.events = True
+		self.curShortname = daemon.defaultShortname
+		self.cmdid = None
+		# Output of the running command, gathered until it finishes or prompts.
+		self.outbuf = []
+		self.outLock = threading.Lock()
+		# JSON lines that arrived while a prompt was waiting, to run afterward.
+		self.pending = deque()
+		self.dropped = 0
+		self.closed = False
+
+	def start(self):
+		for target,name in [(self.writer.run, self.name +"_sender"), (self.run, self.name)]:
+			th = threading.Thread(target=target, name=name)
+			th.daemon = True
+			th.start()
+		return self
+
+	def send(self, kind, text="", block=True):
+		"""Queue one message of the given kind: output, prompt, done, event, or error.
+		With block=False (events), the message is dropped if this client is too far behind.
+		"""
+		if self.json:
+			msg = {"type": kind}
+			if kind not in ["event", "error"]: msg["id"] = self.cmdid
+			if kind != "done": msg["text"] = text
+			data = json.dumps(msg) +"\n"
+		else:
+			if not text: return True
+			data = text if kind == "prompt" or text.endswith("\n") else text +"\n"
+		if not block and self.writer.queued > self.maxEventBacklog:
+			self.dropped += 1
+			return False
+		return self.writer.write(data.encode("utf-8"))
+
+	def addOutput(self, text):
+		with self.outLock:
+			self.outbuf.append(text)
+
+	def flushOutput(self, kind="output"):
+		"""Send gathered command output; a prompt is sent even when empty.
+		"""
+		with self.outLock:
+			text = "".join(self.outbuf)
+			self.outbuf = []
+		if text or kind == "prompt":
+			self.send(kind, text)
+
+	def readLine(self):
+		"""Return the next line from the client without its line ending, or None at end of stream.
+		"""
+		try: bline = self.reader.readline()
+		except OSError: return None
+		if bline is None: return None
+		return bline.decode("utf-8", "replace")
+
+	def readInput(self):
+		"""Answer a prompt from the running command, as sys.stdin.readline() would.
+		In JSON framing, a message that is not an input answer cancels the prompt
+		and is handled after the command finishes.
+		Commands run one at a time, so a prompt left unanswered for promptTimeout seconds is canceled
+		rather than holding up every other client.
+		"""
+		self.flushOutput("prompt")
+		try: ready = self.reader.waitLine(self.promptTimeout)
+		except OSError: ready = True
+		if not ready:
+			from mplib.mycmd import CommandError
+			raise CommandError("No answer within %d seconds; canceled." % (self.promptTimeout))
+		line = self.readLine()
+		if line is None: return ""
+		if not self.json: return line +"\n"
+		try: msg = json.loads(line)
+		except ValueError: msg = None
+		if isinstance(msg, dict) and "input" in msg:
+			return str(msg["input"]) +"\n"
+		self.pending.append(line)
+		return "\n"
+
+	def run(self):
+		"""Read and handle the client's lines until it leaves. Runs in its own thread.
+		"""
+		while not self.closed:
+			line = self.pending.popleft() if self.pending else self.readLine()
+			if line is None or not self.handleLine(line): break
+		self.close()
+
+	def handleLine(self, line):
+		"""Handle one line from the client. Returns False when the client should be disconnected.
+		"""
+		if not line.strip(): return True
+		if not self.framed:
+			self.framed = True
+			self.json = line.lstrip().startswith("{")
+		if not self.json:
+			l = line.strip().lower()
+			if l in ["/events on", "/events off"]:
+				self.events = l.endswith("on")
+				return True
+			if l == "/shutdown":
+				self.daemon.shutdown()
+				return False
+			return self.runCommand(line)
+		try: msg = json.loads(line)
+		except ValueError: msg = None
+		if not isinstance(msg, dict):
+			self.send("error", "Not a JSON object: %s" % (line))
+			return True
+		if "events" in msg: self.events = bool(msg["events"])
+		if msg.get("shutdown"):
+			self.daemon.shutdown()
+			return False
+		if "cmd" not in msg: return True
+		self.cmdid = msg.get("id")
+		return self.runCommand(str(msg["cmd"]))
+
+	def runCommand(self, line):
+		"""Run one command as this client, with this client's current server.
+		Returns False if the command was quit, exit, or the like.
+		quit, exit, and eof only disconnect this client, so they are not passed to the app.
+		"""
+		if line.strip().lower() in ["quit", "exit", "eof"]:
+			self.send("done")
+			return False
+		daemon = self.daemon
+		app = daemon.app
+		with daemon.cmdLock:
+			app._curShortname = self.curShortname
+			daemon.active = local.client = self
+			try: stop = app.onecmd(line.strip())
+			finally:
+				daemon.active = local.client = None
+				self.curShortname = app._curShortname
+		self.flushOutput()
+		self.send("done")
+		return not stop
+
+	def close(self):
+		if self.closed: return
+		self.closed = True
+		self.writer.drain(5)
+		self.writer.close()
+		try: self.sock.shutdown(socket.SHUT_RDWR)
+		except OSError: pass
+		self.sock.close()
+		self.daemon.removeClient(self)
+
+
+class RoutedOutput(object):
+	"""Stands in for sys.stdout.
+	Writes go to the control client whose command is running;
+	anything else goes to the original stream and, as events, to subscribed clients.
+	"""
+	encoding = "utf-8"
+
+	def __init__(self, daemon, stream):
+		self.daemon = daemon
+		self.stream = stream
+
+	def write(self, text):
+		client = getattr(local, "client", None) or self.daemon.active
+		if client: client.addOutput(text)
+		else:
+			try: self.stream.write(text)
+			except (OSError, ValueError): pass
+			self.daemon.broadcast(text)
+		return len(text)
+
+	def flush(self):
+		try: self.stream.flush()
+		except (OSError, ValueError): pass
+
+	def isatty(self):
+		return False
+
+
+class RoutedInput(object):
+	"""Stands in for sys.stdin so prompts are answered by the client that ran the command.
+	"""
+	encoding = "utf-8"
+
+	def readline(self):
+		client = getattr(local, "client", None)
+		if not client: return ""
+		return client.readInput()
+
+	def isatty(self):
+		return False
+
+
+class ControlDaemon(object):
+	"""Serves a TTComCmd object's commands to clients on a Unix domain socket.
+	"""
+	def __init__(self, app, path):
+		self.app = app
+		self.path = os.path.abspath(path)
+		self.defaultShortname = app._curShortname
+		self.clients = set()
+		self.clientLock = threading.Lock()
+		self.cmdLock = threading.RLock()
+		# The client whose command is running, so output from other threads during a command reaches it.
+		self.active = None
+		self.stopped = threading.Event()
+		self.sock = None
+		self.count = 0
+
+	def start(self):
+		"""Listen on the socket and route output and events to clients.
+		Raises OSError if the socket cannot be made or another daemon is using it.
+		"""
+		if not hasattr(socket, "AF_UNIX"):
+			raise OSError("Unix domain sockets are not available on this system")
+		if os.path.exists(self.path):
+			probe = socket.socket(socket.AF_UNIX)
+			try:
+				probe.connect(self.path)
+				raise OSError("A daemon is already listening on %s" % (self.path))
+			except (ConnectionRefusedError, FileNotFoundError):
+				os.unlink(self.path)
+			finally:
+				probe.close()
+		self.sock = socket.socket(socket.AF_UNIX)
+		oldmask = os.umask(0o177)
+		try: self.sock.bind(self.path)
+		finally: os.umask(oldmask)
+		self.sock.listen(16)
+		from mplib.mycmd import mq
+		mq.sink = self.broadcast
+		sys.stdout = RoutedOutput(self, sys.stdout)
+		sys.stdin = RoutedInput()
+		self.app.daemon = self
+		# cmd.Cmd writes some messages to the stdout it was created with.
+		self.app.stdout = sys.stdout
+		th = threading.Thread(target=self.acceptLoop, name="controlAccept")
+		th.daemon = True
+		th.start()
+		return self
+
+	def acceptLoop(self):
+		while not self.stopped.is_set():
+			try: sock,addr = self.sock.accept()
+			except OSError: return
+			self.count += 1
+			client = ControlClient(self, sock, self.count)
+			with self.clientLock:
+				self.clients.add(client)
+			client.start()
+
+	def removeClient(self, client):
+		with self.clientLock:
+			self.clients.discard(client)
+
+	def broadcast(self, text):
+		"""Push event text to every client receiving events.
+		"""
+		text = text.rstrip("\n")
+		if not text: return
+		with self.clientLock:
+			clients = [c for c in self.clients if c.events and c.framed]
+		for client in clients:
+			client.send("event", text, block=False)
+
+	def serve(self):
+		"""Run until shut down by a client or interrupted.
+		"""
+		try:
+			while not self.stopped.wait(1.0): pass
+		except KeyboardInterrupt:
+			pass
+		self.shutdown()
+
+	def shutdown(self):
+		if self.stopped.is_set(): return
+		self.stopped.set()
+		try: self.sock.close()
+		except OSError: pass
+		try: os.unlink(self.path)
+		except OSError: pass
+		with self.clientLock:
+			clients = list(self.clients)
+		for client in clients:
+			client.send("event", "Daemon shutting down")
+			threading.Thread(target=client.close, daemon=True).start()
+
+
+def runClient(path):
+	"""A terminal frontend: send typed lines to the daemon at path and print whatever comes back.
+	"""
+	sock = socket.socket(socket.AF_UNIX)
+	try: sock.connect(path)
+	except OSError as e:
+		sys.exit("Cannot connect to %s: %s" % (path, str(e)))
+	def receive():
+		import codecs
+		decoder = codecs.getincrementaldecoder("utf-8")("replace")
+		while True:
+			try: data = sock.recv(65536)
+			except OSError: data = b""
+			if not data: break
+			sys.stdout.write(decoder.decode(data))
+			sys.stdout.flush()
+		os._exit(0)
+	th = threading.Thread(target=receive, name="receive")
+	th.daemon = True
+	th.start()
+	try:
+		while True:
+			try: line = input()
+			except EOFError: line = "quit"
+			# mplib.mycmd's input() returns this for Ctrl+C.
+			if line == "KeyboardInterrupt": line = "quit"
+			sock.sendall((line +"\n").encode("utf-8"))
+			if line.strip().lower() in ["quit", "exit", "/shutdown"]: break
+	except KeyboardInterrupt:
+		sock.sendall(b"quit\n")
+	th.join(5)
@@ -0,0 +1,227 @@
+"""Replay recorded TTCom sessions offline through TeamtalkServer.processLine().
+
+Reads ttcom.log or ttcom.log.gz, where every inbound line is recorded as
+	<ctime timestamp>
+	  <shortname>: <line>
+and feeds each server's lines to its own offline TeamtalkServer, at recorded pace or as fast as possible.
+Nothing is sent anywhere; event output is discarded and the null sound backend is used.
+Reports events per second, per-event-type processing time percentiles, and peak memory.
+
+Usage (from the src directory):
+	python ttreplay.py [-s shortname ...] [-p speed] [-t] [-m] [logfile]
+logfile: Defaults to ttcom.log, or ttcom.log.gz if that is what exists.
+-s: Replay only this server; may be repeated.
+-p: Pace relative to the recording, e.g., 1 for real time or 10 for ten times faster; 0 (the default) is as fast as possible.
+-t: Apply each server's triggers from the configuration file; trigger actions are counted, not run.
+-m: Measure peak Python memory with tracemalloc (slower); otherwise peak process RSS is reported where available.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import gzip, os, sys, time
+from collections import defaultdict
+
+from conf import conf
+from mplib.TableFormatter import TableFormatter
+
+
+def readLog(fname):
+	"""Yield (timestamp, shortname, line) for each recorded line in a log file.
+	timestamp is the ctime string the line was recorded under.
+	A truncated gzip archive ends the replay quietly.
+	"""
+	if fname.endswith(".gz"): f = gzip.open(fname, "rt", encoding="utf-8", errors="replace")
+	else: f = open(fname, encoding="utf-8", errors="replace")
+	stamp = ""
+	try:
+		for raw in f:
+			if raw.startswith("  "):
+				shortname,sep,line = raw[2:].rstrip("\r\n").partition(": ")
+				if sep: yield stamp, shortname, line
+			elif raw.strip():
+				stamp = raw.strip()
+	except (EOFError, gzip.BadGzipFile):
+		pass
+	finally:
+		f.close()
+
+
+def percentile(values, pct):
+	"""Return the pct percentile (0-100) of a sorted list.
+	"""
+	if not values: return 0.0
+	return values[int(round((len(values) -1) * pct / 100.0))]
+
+
+def makeReplayServerClass():
+	from ttapi import TeamtalkServer
+	class ReplayServer(TeamtalkServer):
+		"""An offline TeamtalkServer: output and sends are discarded.
+		The recording does not include the login command,
+		so a welcome line puts the server into the loggingIn state as login would.
+		"""
+		def outputFromEvent(self, line, raw=False): pass
+		def errorFromEvent(self, line, raw=False): pass
+		def send(self, line): pass
+
+		def event_welcome(self, parms):
+			result = TeamtalkServer.event_welcome(self, parms)
+			self.state = "loggingIn"
+			return result
+
+		def hookEvents(self, parmline, afterDispatch):
+			triggers = getattr(self, "triggers", None)
+			if afterDispatch and triggers and parmline.event not in ["userbanned", "useraccount"]:
+				triggers.apply(parmline)
+	return ReplayServer
+
+
+def loadTriggers(shortname, runCommand):
+	"""Return a Triggers object for shortname built from the configuration file, or None.
+	"""
+	from triggers import Triggers
+	pairs = conf.servers().get(shortname)
+	if not pairs: return None
+	triggers = Triggers(runCommand)
+	for k,v in pairs:
+		triggers.addConfigLine(k, v)
+	return triggers
+
+
+class Replayer(object):
+	"""Feeds recorded lines to one offline server per shortname and times each line.
+	"""
+	def __init__(self, shortnames=None, speed=0.0, useTriggers=False):
+		self.only = set(shortnames or [])
+		self.speed = speed
+		self.useTriggers = useTriggers
+		self.servers = {}
+		self.ReplayServer = makeReplayServerClass()
+		# Event type -> list of processing times in seconds.
+		self.times = defaultdict(list)
+		self.errors = defaultdict(int)
+		self.actions = 0
+		self.lines = 0
+		self.elapsed = 0.0
+
+	def server(self, shortname):
+		server = self.servers.get(shortname)
+		if server is None:
+			server = self.ReplayServer("replay", 10333, shortname, {})
+			server.play_sounds = 1
+			if self.useTriggers:
+				triggers = loadTriggers(shortname, self.countAction)
+				if triggers:
+					triggers.server = server
+					server.triggers = triggers
+			self.servers[shortname] = server
+		return server
+
+	def countAction(self, line):
+		self.actions += 1
+
+	def run(self, records):
+		"""Replay (timestamp, shortname, line) records.
+		"""
+		perf = time.perf_counter
+		firstStamp = None
+		lastStamp,lastSecs = None,0.0
+		start = perf()
+		for stamp,shortname,line in records:
+			if shortname == "*TTCom*" or line.startswith("_send_ "): continue
+			if self.only and shortname not in self.only: continue
+			if self.speed:
+				if stamp != lastStamp:
+					try: lastSecs = time.mktime(time.strptime(stamp, "%a %b %d %H:%M:%S %Y"))
+					except ValueError: pass
+					lastStamp = stamp
+					if firstStamp is None: firstStamp = lastSecs
+				delay = (lastSecs -firstStamp) / self.speed -(perf() -start)
+				if delay > 0: time.sleep(delay)
+			server = self.server(shortname)
+			event = line.split(None, 1)[0] if line.strip() else ""
+			t0 = perf()
+			try: server.processLine(line)
+			except Exception:
+				self.errors[event] += 1
+			self.times[event].append(perf() -t0)
+			self.lines += 1
+		self.elapsed = perf() -start
+
+	def report(self):
+		"""Return the replay summary and per-event-type timing table.
+		"""
+		busy = sum(sum(t) for t in self.times.values())
+		buf = ["Replayed %d lines for %d servers in %.2f s: %.0f lines/s overall, %.0f lines/s of processing time" % (
+			self.lines, len(self.servers), self.elapsed,
+			self.lines / self.elapsed if self.elapsed else 0.0,
+			self.lines / busy if busy else 0.0
+		)]
+		if self.useTriggers: buf.append("Trigger actions: %d" % (self.actions))
+		tbl = TableFormatter("Processing time by event (microseconds)", [
+			"Event", "Count", "Errors", "p50", "p90", "p99", "Max", "Total ms"
+		])
+		us = lambda s: "{0:.1f}".format(s * 1e6)
+		for event,times in sorted(self.times.items(), key=lambda i: -sum(i[1])):
+			times.sort()
+			tbl.addRow([
+				event, str(len(times)), str(self.errors.get(event, 0)),
+				us(percentile(times, 50)), us(percentile(times, 90)), us(percentile(times, 99)), us(times[-1]),
+				"{0:.1f}".format(sum(times) * 1000)
+			])
+		buf.append(tbl.format(2))
+		return "\n".join(buf)
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="ttreplay", description="Replay recorded TTCom sessions offline through processLine().")
+	parser.add_argument("logfile", nargs="?", default="", help="Log file; ttcom.log or ttcom.log.gz by default.")
+	parser.add_argument("-s", "--server", action="append", default=[], help="Replay only this server; may be repeated.")
+	parser.add_argument("-p", "--pace", type=float, default=0.0, help="Speed relative to the recording; 0 is as fast as possible.")
+	parser.add_argument("-t", "--triggers", action="store_true", help="Apply configured triggers.")
+	parser.add_argument("-m", "--tracemalloc", action="store_true", help="Measure peak Python memory with tracemalloc.")
+	opts = parser.parse_args(args)
+	fname = opts.logfile
+	if not fname:
+		fname = "ttcom.log" if os.path.exists("ttcom.log") else "ttcom.log.gz"
+	if not os.path.exists(fname):
+		sys.exit("Log file %s not found." % (fname))
+	conf.version = "replay"
+	from sound import backend
+	backend.setBackend("null")
+	if opts.tracemalloc:
+		import tracemalloc
+		tracemalloc.start()
+	replayer = Replayer(opts.server, opts.pace, opts.triggers)
+	replayer.run(readLog(fname))
+	print(replayer.report())
+	if opts.tracemalloc:
+		current,peak = tracemalloc.get_traced_memory()
+		print("Peak traced memory %.1f MB (%.1f MB at end)" % (peak / 1e6, current / 1e6))
+	else:
+		try:
+			import resource
+			rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			# Linux reports kilobytes, MacOS bytes.
+			if sys.platform != "darwin": rss *= 1024
+			print("Peak process memory %.1f MB" % (rss / 1e6))
+		except ImportError:
+			pass
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,366 @@
+"""A local stand-in for a TeamTalk server, for load and regression testing.
+
+Speaks enough of the TeamTalk text protocol for TTCom to connect, log in, and run commands:
+the teamtalk welcome line, login with a channel and user snapshot,
+begin/end id= blocks around command replies, ping/pong, join, logout, and quit.
+Synthetic join/leave, login/logout, and message storms can be sent to all logged-in clients
+at a configurable rate.
+
+Use from code:
+	server = StandinServer(channels=20, users=500).start()
+	# Connect TeamtalkServer objects to ("127.0.0.1", server.port).
+	server.storm("joins", rate=200, duration=5).join()
+	server.stop()
+Replies can be scripted per command:
+	server.handlers["listaccounts"] = lambda session, parmline: ['useraccount username="a" usertype=1']
+A handler returns the lines to send inside the command's begin/end block, before "ok",
+or None to send nothing at all.
+
+Run standalone (from the src directory) to serve until interrupted:
+	python ttstandin.py [-p port] [-c channels] [-u users]
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import socket, threading, time
+from parmline import ParmLine
+from framing import LineReader
+
+
+def quote(s):
+	"""Quote a string value for the TeamTalk protocol.
+	"""
+	return '"' +s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") +'"'
+
+
+class StandinSession(object):
+	"""One client connection to a StandinServer.
+	"""
+	def __init__(self, server, sock, userid):
+		self.server = server
+		self.sock = sock
+		self.userid = userid
+		self.loggedIn = False
+		self.chanid = None
+		self.commands = 0
+		self.linesSent = 0
+		self._lock = threading.Lock()
+		self.closed = False
+
+	def sendLines(self, lines):
+		"""Send lines (str or bytes, without line endings) in one write.
+		Returns False if the client is gone.
+		"""
+		if self.closed: return False
+		data = b"".join([(l if isinstance(l, bytes) else l.encode("utf-8")) +b"\r\n" for l in lines])
+		try:
+			with self._lock:
+				self.sock.sendall(data)
+		except OSError:
+			self.close()
+			return False
+		self.linesSent += len(lines)
+		return True
+
+	def close(self):
+		self.closed = True
+		self.loggedIn = False
+		try: self.sock.close()
+		except OSError: pass
+
+	def run(self):
+		"""Greet the client and answer its commands. Runs in its own thread.
+		"""
+		srv = self.server
+		self.sendLines(['teamtalk userid=%d servername=%s usertimeout=%d protocol="5.6" version="5.8.0"' % (
+			self.userid, quote(srv.servername), srv.usertimeout
+		)])
+		try:
+			for bline in LineReader(self.sock):
+				line = bline.decode("utf-8", "replace").strip()
+				if not line: continue
+				self.commands += 1
+				if not self.handle(line): break
+		except OSError:
+			pass
+		self.close()
+		srv._removeSession(self)
+
+	def handle(self, line):
+		"""Answer one command. Returns False when the client should be disconnected.
+		"""
+		if line == "ping":
+			self.sendLines(["pong"])
+			return True
+		try: parmline = ParmLine(line)
+		except Exception:
+			self.sendLines(['error number=1000 message="Command not parsable"'])
+			return True
+		cmd = parmline.event.lower()
+		cmdid = parmline.parms.get("id")
+		if cmd == "quit":
+			return False
+		handler = self.server.handlers.get(cmd)
+		if handler:
+			lines = handler(self, parmline)
+		else:
+			method = getattr(self, "cmd_" +cmd, None)
+			lines = method(parmline) if method else []
+		if lines is None: return True
+		if cmdid: lines = ["begin id=%s" % (cmdid)] +lines +["ok", "end id=%s" % (cmdid)]
+		else: lines = lines +["ok"]
+		self.sendLines(lines)
+		return True
+
+	def cmd_login(self, parmline):
+		srv = self.server
+		nickname = parmline.parms.get("nickname", "Standin %d" % (self.userid))
+		username = parmline.parms.get("username", "standin%d" % (self.userid))
+		lines = ['accepted userid=%d nickname=%s username=%s usertype=2 userrights=%d ipaddr="127.0.0.1"' % (
+			self.userid, quote(nickname), quote(username), 0x3ffff
+		)]
+		lines.extend(srv.snapshot())
+		lines.append('loggedin userid=%d nickname=%s username=%s usertype=2 ipaddr="127.0.0.1"' % (
+			self.userid, quote(nickname), quote(username)
+		))
+		self.loggedIn = True
+		return lines
+
+	def cmd_logout(self, parmline):
+		self.loggedIn = False
+		return ["loggedout"]
+
+	def cmd_join(self, parmline):
+		chanid = parmline.parms.get("chanid", "1")
+		self.chanid = chanid
+		return ["joined chanid=%s" % (chanid), "adduser userid=%d chanid=%s" % (self.userid, chanid)]
+
+	def cmd_leave(self, parmline):
+		chanid,self.chanid = self.chanid,None
+		if not chanid: return ['error number=2001 message="Not in channel"']
+		return ["left chanid=%s" % (chanid), "removeuser userid=%d chanid=%s" % (self.userid, chanid)]
+
+
+class StandinServer(object):
+	"""A TeamTalk protocol stand-in listening on host:port (port 0 picks a free port).
+	Simulated users have userids from 1000 up; client sessions get userids from 1 up.
+	"""
+	def __init__(self, host="127.0.0.1", port=0, channels=10, users=100, usertimeout=60, servername="Standin"):
+		self.host = host
+		self.port = port
+		self.servername = servername
+		self.usertimeout = usertimeout
+		# chanid -> channel path; channel 1 is the root.
+		self.channels = {1: "/"}
+		for c in range(2, channels +1):
+			self.channels[c] = "/Room %d/" % (c)
+		# userid -> chanid (or None when not in a channel).
+		self.users = {}
+		for u in range(users):
+			self.users[1000 +u] = 2 +u % (channels -1) if channels > 1 else 1
+		self.nextUserid = 1000 +users
+		self.handlers = {}
+		self.sessions = []
+		self._sessionLock = threading.Lock()
+		self._stateLock = threading.Lock()
+		self.lsock = None
+		self.nextClientid = 1
+		self.stormThreads = []
+		self.stopping = threading.Event()
+
+	def start(self):
+		"""Start listening and accepting clients in the background.
+		"""
+		self.lsock = socket.socket()
+		self.lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.lsock.bind((self.host, self.port))
+		self.lsock.listen(128)
+		self.port = self.lsock.getsockname()[1]
+		th = threading.Thread(target=self.acceptor, name="standinAccept")
+		th.daemon = True
+		th.start()
+		return self
+
+	def stop(self):
+		"""Stop storms, close all clients, and stop listening.
+		"""
+		self.stopping.set()
+		for th in self.stormThreads: th.join()
+		try: self.lsock.close()
+		except OSError: pass
+		with self._sessionLock:
+			sessions = list(self.sessions)
+		for s in sessions: s.close()
+
+	def acceptor(self):
+		while not self.stopping.is_set():
+			try: sock,addr = self.lsock.accept()
+			except OSError: return
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			with self._sessionLock:
+				session = StandinSession(self, sock, self.nextClientid)
+				self.nextClientid += 1
+				self.sessions.append(session)
+			th = threading.Thread(target=session.run, name="standinSession%d" % (session.userid))
+			th.daemon = True
+			th.start()
+
+	def _removeSession(self, session):
+		with self._sessionLock:
+			try: self.sessions.remove(session)
+			except ValueError: pass
+
+	def loggedInSessions(self):
+		with self._sessionLock:
+			return [s for s in self.sessions if s.loggedIn]
+
+	def snapshot(self):
+		"""Return the serverupdate, addchannel, loggedin, and adduser lines a login receives.
+		"""
+		lines = ['serverupdate servername=%s maxusers=10000 motd="Stand-in server" usertimeout=%d' % (quote(self.servername), self.usertimeout)]
+		for chanid,path in sorted(self.channels.items()):
+			parentid = 0 if chanid == 1 else 1
+			lines.append("addchannel chanid=%d channel=%s parentid=%d topic=\"\" protected=0 type=0 maxusers=1000" % (chanid, quote(path), parentid))
+		with self._stateLock:
+			users = sorted(self.users.items())
+		for userid,chanid in users:
+			lines.append(self.userLine(userid))
+		for userid,chanid in users:
+			if chanid: lines.append("adduser userid=%d chanid=%d" % (userid, chanid))
+		return lines
+
+	def userLine(self, userid):
+		"""Return the loggedin line for a simulated user.
+		"""
+		return 'loggedin userid=%d nickname="User %d" username="user%d" usertype=1 ipaddr="10.0.%d.%d" version="5.8.0"' % (
+			userid, userid, userid, userid // 256 % 256, userid % 256
+		)
+
+	def broadcast(self, lines):
+		"""Send lines to every logged-in client. Returns the number of clients reached.
+		"""
+		lines = [l.encode("utf-8") if isinstance(l, str) else l for l in lines]
+		n = 0
+		for s in self.loggedInSessions():
+			if s.sendLines(lines): n += 1
+		return n
+
+	def stormLines(self, kind, i):
+		"""Return the lines for step i of a storm, updating simulated state.
+		Kinds:
+			joins: A simulated user moves to another channel (removeuser then adduser).
+			logins: A new user logs in and joins a channel, or a simulated user leaves and logs out.
+			messages: A channel message from a simulated user.
+		Steps that need a simulated user return no lines when there are none.
+		"""
+		chanids = [c for c in self.channels if c != 1] or [1]
+		with self._stateLock:
+			if not self.users and not (kind == "logins" and i % 2 == 0):
+				return []
+			if kind == "joins":
+				userid = 1000 +i % max(1, len(self.users))
+				if userid not in self.users: userid = next(iter(self.users))
+				old = self.users[userid]
+				new = chanids[(chanids.index(old) +1) % len(chanids)] if old in chanids else chanids[0]
+				self.users[userid] = new
+				lines = []
+				if old: lines.append("removeuser userid=%d chanid=%d" % (userid, old))
+				lines.append("adduser userid=%d chanid=%d" % (userid, new))
+				return lines
+			if kind == "logins":
+				if i % 2 == 0:
+					userid = self.nextUserid
+					self.nextUserid += 1
+					chanid = chanids[i // 2 % len(chanids)]
+					self.users[userid] = chanid
+					return [self.userLine(userid), "adduser userid=%d chanid=%d" % (userid, chanid)]
+				userid = max(self.users)
+				chanid = self.users.pop(userid)
+				lines = []
+				if chanid: lines.append("removeuser userid=%d chanid=%d" % (userid, chanid))
+				lines.append("loggedout userid=%d" % (userid))
+				return lines
+			if kind == "messages":
+				userid = 1000 +i % max(1, len(self.users))
+				chanid = self.users.get(userid) or 1
+				return ['messagedeliver type=2 srcuserid=%d destuserid=0 chanid=%d content="Storm message %d"' % (userid, chanid, i)]
+		raise ValueError("Unknown storm kind: " +kind)
+
+	def storm(self, kind, rate=100, duration=None, count=None):
+		"""Start a Storm of the given kind (see stormLines()) and return it.
+		"""
+		th = Storm(self, kind, rate, duration, count)
+		self.stormThreads.append(th)
+		th.start()
+		return th
+
+
+class Storm(threading.Thread):
+	"""Sends storm steps to all logged-in clients at rate steps per second
+	until duration seconds pass, count steps are sent, or the server stops.
+	Rate 0 sends as fast as possible. steps counts the steps taken so far,
+	and skipped how many of those sent nothing because there were no simulated users.
+	Steps due in the same 10 ms tick go out in one write per client.
+	"""
+	def __init__(self, server, kind, rate=100, duration=None, count=None):
+		threading.Thread.__init__(self, name="standinStorm_" +kind)
+		self.daemon = True
+		self.server = server
+		self.kind = kind
+		self.rate = rate
+		self.duration = duration
+		self.count = count
+		self.steps = 0
+		self.skipped = 0
+
+	def run(self):
+		srv = self.server
+		start = time.perf_counter()
+		i = 0
+		while not srv.stopping.is_set():
+			now = time.perf_counter()
+			if self.duration is not None and now -start >= self.duration: break
+			if self.count is not None and i >= self.count: break
+			due = int((now -start) * self.rate) +1 if self.rate else i +100
+			if self.count is not None: due = min(due, self.count)
+			lines = []
+			while i < due:
+				stepLines = srv.stormLines(self.kind, i)
+				if not stepLines: self.skipped += 1
+				lines.extend(stepLines)
+				i += 1
+			if lines: srv.broadcast(lines)
+			self.steps = i
+			if self.rate: time.sleep(0.01)
+
+
+def main(args=None):
+	parser = argparse.ArgumentParser(prog="ttstandin", description="Local TeamTalk protocol stand-in server.")
+	parser.add_argument("-p", "--port", type=int, default=10333, help="TCP port to listen on.")
+	parser.add_argument("-c", "--channels", type=int, default=10, help="Simulated channels.")
+	parser.add_argument("-u", "--users", type=int, default=100, help="Simulated users.")
+	opts = parser.parse_args(args)
+	server = StandinServer(port=opts.port, channels=opts.channels, users=opts.users).start()
+	print("Stand-in TeamTalk server on %s:%d; press Ctrl+C to stop." % (server.host, server.port))
+	try:
+		while True: time.sleep(1)
+	except KeyboardInterrupt:
+		server.stop()
+
+if __name__ == "__main__":
+	main()
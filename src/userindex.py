@@ -0,0 +1,146 @@
+"""Index of the users on every server, for finding people across servers at once.
+
+Copyright (C) 2011-2019 Doug Lee
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by the
+Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+for more details.
+
+You should have received a copy of the GNU General Public License along
+with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import heapq, threading
+from ngrams import NgramIndex
+from tt_attrdict import AttrDict
+
+# Starts each indexed field, so a prefix search is a substring search for SEP +prefix.
+SEP = "\n"
+
+
+class UserIndex(object):
+	"""Nickname, username, and IP address of every user on every server, by (server, userid).
+	TeamtalkServer.indexEvent() notes changed users from each server's event thread through touch(),
+	and search() indexes them before it looks, so event threads do no indexing.
+	"""
+	# Touched users that start a background flush.
+	maxPending = 50000
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.ngrams = NgramIndex()
+		# (server, userid) -> (nickname, username, ipaddr).
+		self.records = {}
+		# (server, userid) -> (shortname, nickname, username), lower-cased, for sorting results.
+		self.sortKeys = {}
+		# Server -> set of its userids here.
+		self.byServer = {}
+		# Server -> how many times removeServer() has cleared it.
+		self.generations = {}
+		# (server, userid) pairs touched since the last flush(), guarded by pendingLock.
+		# pendingLock is never held while taking another lock, so event threads may take it under stateLock.
+		self.pending = set()
+		self.pendingLock = threading.Lock()
+		self.flushing = False
+		# Keeps flushes in order, so an older read of a user cannot overwrite a newer one.
+		self.flushLock = threading.Lock()
+
+	def __len__(self):
+		self.flush()
+		return len(self.records)
+
+	def touch(self, server, userid):
+		"""Note that a server's user was added, changed, or removed.
+		When many pile up with no searches to flush them, a background thread does.
+		"""
+		with self.pendingLock:
+			self.pending.add((server, userid))
+			if len(self.pending) < self.maxPending or self.flushing: return
+			self.flushing = True
+		th = threading.Thread(target=self._backgroundFlush, name="userIndexFlush")
+		th.daemon = True
+		th.start()
+
+	def _backgroundFlush(self):
+		try: self.flush()
+		finally: self.flushing = False
+
+	def flush(self):
+		"""Index the users touched since the last flush, reading each under its server's stateLock.
+		"""
+		with self.flushLock:
+			with self.pendingLock:
+				pending,self.pending = self.pending, set()
+			byServer = {}
+			for server,userid in pending: byServer.setdefault(server, []).append(userid)
+			for server,userids in byServer.items():
+				with server.stateLock:
+					generation = self.generations.get(server, 0)
+					users = [(userid, dict.get(server.users, userid)) for userid in userids]
+					users = [(userid, AttrDict(user) if user else None) for userid,user in users]
+				with self.lock:
+					# Skip what was read before the server was cleared.
+					if self.generations.get(server, 0) != generation: continue
+					for userid,user in users:
+						if user: self._update(server, user)
+						else: self._remove(server, userid)
+
+	def _update(self, server, user):
+		"""Add or refresh one user of a server. Called with lock held.
+		"""
+		key = (server, user.userid)
+		rec = (user.get("nickname") or "", user.get("username") or "", user.get("ipaddr") or "")
+		if self.records.get(key) == rec: return
+		self.records[key] = rec
+		self.sortKeys[key] = (server.shortname.lower(), rec[0].lower(), rec[1].lower())
+		self.byServer.setdefault(server, set()).add(user.userid)
+		self.ngrams.set(key, SEP +SEP.join(rec))
+
+	def _remove(self, server, userid):
+		"""Drop one user of a server. Called with lock held.
+		"""
+		key = (server, userid)
+		if self.records.pop(key, None) is None: return
+		del self.sortKeys[key]
+		self.byServer[server].discard(userid)
+		self.ngrams.remove(key)
+
+	def removeServer(self, server):
+		"""Drop all of a server's users, e.g., on disconnect. Called with the server's stateLock held.
+		"""
+		with self.pendingLock:
+			self.pending = set(pair for pair in self.pending if pair[0] is not server)
+		with self.lock:
+			self.generations[server] = self.generations.get(server, 0) +1
+			for userid in self.byServer.pop(server, ()):
+				key = (server, userid)
+				del self.records[key]
+				del self.sortKeys[key]
+				self.ngrams.remove(key)
+
+	def search(self, query, prefix=False, limit=None):
+		"""Find users with query in their nickname, username, or IP address,
+		or with prefix=True, at the start of one, ignoring case.
+		Returns (total, rows): how many users match, and (server, userid, nickname, username, ipaddr) tuples
+		sorted by server shortname and then nickname, only the first limit of them if limit is given.
+		"""
+		if prefix: query = SEP +query
+		self.flush()
+		with self.lock:
+			keys = self.ngrams.search(query)
+			sortKeys = self.sortKeys
+			if limit is not None and len(keys) > limit:
+				found = heapq.nsmallest(limit, keys, key=sortKeys.__getitem__)
+			else:
+				found = sorted(keys, key=sortKeys.__getitem__)
+			rows = [k +self.records[k] for k in found]
+		return len(keys), rows
+
+userIndex = UserIndex()